@@ -31,7 +31,24 @@ except ImportError:
     from trollius import From, Return
 import os
 import random
-import dbm
+try:
+    import dbm
+except ImportError:
+    import anydbm as dbm
+import tempfile
+import inspect
+import types
+import json
+import zlib
+import multiprocessing
+try:
+    import uvloop
+except ImportError:
+    uvloop = None
+try:
+    import tracemalloc
+except ImportError:
+    tracemalloc = None
 
 import importlib.machinery  # noqa
 loader = importlib.machinery.SourceFileLoader(
@@ -54,6 +71,7 @@ loop = asyncio.get_event_loop()
 client   = ktasync.KyotoTycoon.embedded(["test.kch"])
 #client   = ktasync.KyotoTycoon(host="harry")
 orig     = kyototycoon.KyotoTycoon(host=client.host, port=client.port)
+sync     = ktasync.SyncKyotoTycoon(host=client.host, port=client.port)
 dbm_file = dbm.open("test.dbm", "c")
 
 def _create_request():
@@ -68,23 +86,21 @@ def _create_request():
         yield dict_
     file_.close()
 
-@asyncio.coroutine
-def prepare():
+async def prepare():
     """Helper"""
     requests = _create_request()
     for req in requests:
-        yield from client.set_bulk_kv(req)
+        await client.set_bulk_kv(req)
         # pypy #yield From(client.set_bulk_kv(req))
 
 def benchmark_get_bulk():
     """Standard bulk test"""
 
-    @asyncio.coroutine
-    def doit():
+    async def doit():
         """Helper"""
         requests = _create_request()
         for req in requests:
-            res = yield from client.get_bulk_keys(req.keys())
+            res = await client.get_bulk_keys(req.keys())
             # pypy #res = yield From(client.get_bulk_keys(req.keys()))
 
     loop.run_until_complete(prepare())
@@ -102,12 +118,11 @@ def benchmark_batch_get_bulk():
 
     requests = _create_request()
 
-    @asyncio.coroutine
-    def doit(step):
+    async def doit(step):
         """Helper"""
         for _ in range(step):
             req = next(requests)
-            res = yield from client.get_bulk_keys(req.keys())
+            res = await client.get_bulk_keys(req.keys())
             # pypy #res = yield From(client.get_bulk_keys(req.keys()))
 
     loop.run_until_complete(prepare())
@@ -117,7 +132,7 @@ def benchmark_batch_get_bulk():
     step = int(NUM_REQUESTS / NUM_BATCH)
     for _ in range(NUM_BATCH):
         batchs.append(doit(step))
-    loop.run_until_complete(asyncio.wait(batchs))
+    loop.run_until_complete(asyncio.gather(*batchs))
     print(
         'batch get_bulk qps:',
         int(NUM_REQUESTS * NUM_BULK / (time.time() - start))
@@ -129,11 +144,10 @@ def benchmark_set_bulk():
     """Standard bulk test"""
 
     requests = _create_request()
-    @asyncio.coroutine
-    def doit():
+    async def doit():
         """Helper"""
         for req in requests:
-            yield from client.set_bulk_kv(req)
+            await client.set_bulk_kv(req)
             # pypy #yield From(client.set_bulk_kv(req))
 
     start = time.time()
@@ -144,6 +158,420 @@ def benchmark_set_bulk():
     )
 
 
+def benchmark_memory_get_bulk():
+    """Memory per record of tuple and columnar results"""
+
+    if tracemalloc is None:
+        print("memory per record: tracemalloc not available")
+        return
+    keys = [key for req in _create_request() for key in req.keys()]
+    loop.run_until_complete(prepare())
+    for columnar in (False, True):
+        tracemalloc.start()
+        res = loop.run_until_complete(
+            client.get_bulk_keys(keys, columnar=columnar)
+        )
+        current, peak = tracemalloc.get_traced_memory()
+        tracemalloc.stop()
+        print(
+            '%s get_bulk bytes/record: %d (peak %d)' % (
+                "columnar" if columnar else "tuple",
+                current / len(res),
+                peak / len(res),
+            )
+        )
+        del res
+
+
+def benchmark_transports():
+    """Latency of single gets over TCP and UNIX sockets"""
+
+    unix_client = ktasync.KyotoTycoon.embedded(
+        name="unix",
+        unix_path=os.path.join(tempfile.mkdtemp(), "ktserver.sock"),
+    )
+    keys = list(next(_create_request()).keys())
+
+    async def doit(kt):
+        """Helper"""
+        for key in keys:
+            await kt.set(key, key)
+            # pypy #yield From(kt.set(key, key))
+        for _ in range(NUM_REQUESTS // NUM_BULK):
+            for key in keys:
+                await kt.get(key)
+                # pypy #yield From(kt.get(key))
+
+    for name, kt in (("tcp", client), ("unix", unix_client)):
+        start = time.time()
+        loop.run_until_complete(doit(kt))
+        print(
+            '%s get latency: %.1fus' % (
+                name,
+                (time.time() - start) * 1e6 / NUM_REQUESTS / 2,
+            )
+        )
+    unix_client.close()
+    unix_client.server.stop()
+
+
+def benchmark_socket_options():
+    """Small frame latency and large frame throughput with socket options"""
+
+    small = list(next(_create_request()).keys())
+    large = [
+        (
+            ("large%d" % i).encode(),
+            os.urandom(2 ** 20),
+            0,
+            ktasync.DEFAULT_EXPIRE,
+        ) for i in range(8)
+    ]
+    variants = (
+        ("nagle", ktasync.SocketOptions(nodelay=False)),
+        ("nodelay", ktasync.SocketOptions()),
+        ("nodelay+buffers", ktasync.SocketOptions(
+            sndbuf=2 ** 22,
+            rcvbuf=2 ** 22,
+            limit=2 ** 22,
+            write_high=2 ** 22,
+        )),
+    )
+
+    async def doit(kt):
+        """Helper"""
+        start = time.time()
+        for key in small:
+            await kt.get(key)
+            # pypy #yield From(kt.get(key))
+        latency = (time.time() - start) * 1e6 / len(small)
+        start = time.time()
+        for _ in range(4):
+            await kt.set_bulk(large)
+            await kt.get_bulk((key, 0) for key, _, _, _ in large)
+            # pypy #yield From(kt.set_bulk(large))
+            # pypy #yield From(kt.get_bulk((key, 0) for key, _, _, _ in large))
+        throughput = 4 * 2 * 8 / (time.time() - start)
+        return latency, throughput
+        # pypy #raise Return((latency, throughput))
+
+    for name, options in variants:
+        kt = ktasync.KyotoTycoon(
+            host=client.host,
+            port=client.port,
+            socket_options=options,
+        )
+        latency, throughput = loop.run_until_complete(doit(kt))
+        print(
+            'socket options %s: get latency %.1fus, large frames %.1f MB/s' % (
+                name, latency, throughput
+            )
+        )
+        kt.close()
+
+
+def _percentile(values, pct):
+    """Percentile of a list of values"""
+    values = sorted(values)
+    return values[min(len(values) - 1, int(len(values) * pct / 100.0))]
+
+
+def benchmark_priority_lanes():
+    """Interactive get latency while bulk loads run"""
+
+    requests = list(_create_request())
+    keys = list(requests[0].keys())
+
+    async def bulk(priority):
+        """Helper"""
+        for req in requests[:NUM_REQUESTS // NUM_BATCH]:
+            await client.set_bulk_kv(req, priority=priority)
+            # pypy #yield From(client.set_bulk_kv(req, priority=priority))
+
+    async def interactive(latencies):
+        """Helper"""
+        for key in keys * 4:
+            start = time.time()
+            await client.get(
+            # pypy #yield From(client.get(
+                key, priority=ktasync.PRIORITY_INTERACTIVE
+            )
+            # pypy #))
+            latencies.append(time.time() - start)
+
+    for priority in (ktasync.PRIORITY_INTERACTIVE, ktasync.PRIORITY_BATCH):
+        latencies = []
+        loop.run_until_complete(asyncio.gather(
+            interactive(latencies),
+            *[bulk(priority) for _ in range(NUM_BATCH)]
+        ))
+        print(
+            'get p99 with bulk loads in %s lane: %.1fms' % (
+                priority, _percentile(latencies, 99) * 1000
+            )
+        )
+
+
+def benchmark_split_bulk():
+    """One large get_bulk with and without splitting into frames"""
+
+    keys = [key for req in _create_request() for key in req.keys()]
+    for max_frame_records in (None, len(keys) // 8):
+        kt = ktasync.KyotoTycoon(
+            host=client.host,
+            port=client.port,
+            max_connections=8,
+            max_frame_records=max_frame_records,
+        )
+        start = time.time()
+        loop.run_until_complete(kt.get_bulk_keys(keys))
+        print(
+            'large get_bulk with max_frame_records %s qps: %d' % (
+                max_frame_records,
+                len(keys) / (time.time() - start),
+            )
+        )
+        kt.close()
+
+
+def benchmark_offload():
+    """One huge get_bulk decoded inline and on a DecodePool. The decoded
+    values are pickled back, so decoding has to be expensive compared to
+    unpickling its result (decompression, validation) to gain. The CPU time
+    of the event loop thread is the part that does not scale with the
+    processes, the speedup needs as many free cores."""
+
+    thread_time = getattr(time, "thread_time", time.time)
+    keys = [("offload%d" % i).encode() for i in range(NUM_REQUESTS * 100)]
+    value = zlib.compress(
+        json.dumps(dict(("f%d" % i, i) for i in range(200))).encode(), 9
+    )
+    for offset in range(0, len(keys), 1000):
+        loop.run_until_complete(client.set_bulk_kv(
+            dict((key, value) for key in keys[offset:offset + 1000]), 0
+        ))
+    kt = ktasync.KyotoTycoon(host=client.host, port=client.port)
+    start = time.time()
+    cpu = thread_time()
+    recs = loop.run_until_complete(kt.get_bulk_keys(keys))
+    recs = dict((key, zlib.decompress(val)) for key, val in recs.items())
+    inline = time.time() - start
+    print('huge get_bulk decoded inline: %.3fs loop cpu %.3fs' % (
+        inline, thread_time() - cpu
+    ))
+    for processes in (2, 4, 8):
+        pool = ktasync.DecodePool(processes=processes, decode=zlib.decompress)
+        # Start the processes
+        loop.run_until_complete(kt.get_bulk_keys(keys, offload=pool))
+        start = time.time()
+        cpu = thread_time()
+        loop.run_until_complete(kt.get_bulk_keys(keys, offload=pool))
+        duration = time.time() - start
+        print(
+            'huge get_bulk decoded by %d processes: %.3fs loop cpu %.3fs '
+            'speedup %.2f (%d cores)' % (
+                processes,
+                duration,
+                thread_time() - cpu,
+                inline / duration,
+                multiprocessing.cpu_count(),
+            )
+        )
+        pool.close()
+    kt.close()
+
+
+def benchmark_flight_recorder():
+    """get_bulk with and without the slow request flight recorder"""
+
+    for flight in (None, ktasync.FlightRecorder()):
+        kt = ktasync.KyotoTycoon(
+            host=client.host, port=client.port, flight_recorder=flight
+        )
+
+        async def doit():
+            """Helper"""
+            for req in _create_request():
+                await kt.get_bulk_keys(req.keys())
+                # pypy #yield From(kt.get_bulk_keys(req.keys()))
+
+        start = time.time()
+        loop.run_until_complete(doit())
+        print(
+            'get_bulk with flight recorder %s qps: %d' % (
+                "on" if flight else "off",
+                NUM_REQUESTS * NUM_BULK / (time.time() - start),
+            )
+        )
+        kt.close()
+
+
+def benchmark_drain():
+    """Per request cost of keeping cancelled replies drainable (a task and
+    shield per request) against closing the connection on cancel"""
+
+    thread_time = getattr(time, "thread_time", time.time)
+    keys = [key for req in _create_request() for key in req]
+    for drain_bytes in (0, ktasync.DRAIN_BYTES):
+        kt = ktasync.KyotoTycoon(
+            host=client.host, port=client.port, drain_bytes=drain_bytes
+        )
+
+        async def doit():
+            """Helper"""
+            for key in keys:
+                await kt.get(key)
+                # pypy #yield From(kt.get(key))
+
+        start = time.time()
+        cpu = thread_time()
+        loop.run_until_complete(doit())
+        print(
+            'get with drain_bytes %d: %.1fus/request loop cpu %.1fus' % (
+                drain_bytes,
+                (time.time() - start) * 1e6 / len(keys),
+                (thread_time() - cpu) * 1e6 / len(keys),
+            )
+        )
+        kt.close()
+
+
+def benchmark_hot_keys():
+    """Cost of hot key sampling on the encode path"""
+
+    recs = [
+        (key, val, 0, ktasync.DEFAULT_EXPIRE)
+        for req in _create_request() for key, val in req.items()
+    ]
+    for sample_every in (1, 16, 64):
+        hot = ktasync.HotKeys(sample_every=sample_every)
+        start = time.time()
+        for offset in range(0, len(recs), NUM_BULK):
+            hot.observe(ktasync.MB_SET_BULK, recs[offset:offset + NUM_BULK], 2)
+        print(
+            'hot keys sampling 1/%d: %.1fns/record' % (
+                sample_every,
+                (time.time() - start) * 1e9 / len(recs),
+            )
+        )
+
+
+def benchmark_counters():
+    """Aggregated incr against read-modify-write with get and set"""
+
+    counters = ktasync.KyotoTycoon.embedded(
+        name="counters",
+        config=ktasync.EmbeddedConfig(records=1000, scripts=True),
+    )
+    keys = [("counter%d" % i).encode("ascii") for i in range(100)]
+
+    async def naive(worker):
+        """Helper"""
+        for i in range(NUM_REQUESTS):
+            key = keys[(worker + i) % len(keys)]
+            val = await counters.get(key)
+            # pypy #val = yield From(counters.get(key))
+            val = str(int(val or 0) + 1).encode("ascii")
+            await counters.set(key, val)
+            # pypy #yield From(counters.set(key, val))
+
+    async def incr(worker):
+        """Helper"""
+        for i in range(NUM_REQUESTS):
+            await counters.incr(keys[(worker + i) % len(keys)])
+            # pypy #yield From(counters.incr(keys[(worker + i) % len(keys)]))
+
+    total = NUM_REQUESTS * NUM_BATCH
+    for name, worker in (("get/set", naive), ("incr", incr)):
+        loop.run_until_complete(counters.remove_bulk_keys(keys, 0))
+        start = time.time()
+        loop.run_until_complete(asyncio.gather(
+            *[worker(i) for i in range(NUM_BATCH)]
+        ))
+        duration = time.time() - start
+        print("counters %s: %.0f increments/s" % (name, total / duration))
+    counters.close()
+
+
+def benchmark_l2_cache():
+    """get_bulk answered by the disk cache after a cold pass"""
+
+    tmp = tempfile.mkdtemp(prefix="ktasync")
+    cache = ktasync.DiskCache(os.path.join(tmp, "cache"))
+    cached = ktasync.KyotoTycoon(
+        host=client.host, port=client.port, l2_cache=cache
+    )
+
+    async def doit():
+        """Helper"""
+        for req in _create_request():
+            await cached.get_bulk_keys(req.keys())
+            # pypy #yield From(cached.get_bulk_keys(req.keys()))
+
+    for name in ("cold", "warm"):
+        start = time.time()
+        loop.run_until_complete(doit())
+        print(
+            "l2 cache %s get_bulk qps: %d" % (
+                name, NUM_REQUESTS * NUM_BULK / (time.time() - start)
+            )
+        )
+    cached.close()
+    cache.close()
+    for name in os.listdir(tmp):
+        os.remove(os.path.join(tmp, name))
+    os.rmdir(tmp)
+
+
+def _load_variant(name, marker):
+    """Load ktasync generated with marker from the template"""
+    with open("ktasync.pyt") as templ:
+        source = templ.read().replace(marker, "")
+    module = types.ModuleType(name)
+    exec(compile(source, "ktasync.pyt", "exec"), module.__dict__)
+    return module
+
+
+def benchmark_call_overhead():
+    """Per call overhead of the native and generator based variants"""
+
+    variants = [("ktasync", ktasync)]
+    native = getattr(inspect, "iscoroutinefunction", lambda _: False)
+    if native(ktasync.KyotoTycoon.get) and hasattr(asyncio, "coroutine"):
+        # Split the marker, make aio would strip it from the literal
+        variants.append(
+            ("generator", _load_variant("ktasync_cp", "# cp" + " #"))
+        )
+    loops = [("asyncio", asyncio.new_event_loop)]
+    if uvloop is not None:
+        loops.append(("uvloop", uvloop.new_event_loop))
+    key = next(iter(next(_create_request())))
+
+    async def doit(kt):
+        """Helper"""
+        for _ in range(NUM_REQUESTS):
+            await kt.get(key)
+            # pypy #yield From(kt.get(key))
+
+    for variant, module in variants:
+        for loop_name, new_loop in loops:
+            call_loop = new_loop()
+            asyncio.set_event_loop(call_loop)
+            kt = module.KyotoTycoon(host=client.host, port=client.port)
+            start = time.time()
+            call_loop.run_until_complete(doit(kt))
+            print(
+                '%s on %s get: %.1fus/call' % (
+                    variant,
+                    loop_name,
+                    (time.time() - start) * 1e6 / NUM_REQUESTS,
+                )
+            )
+            kt.close()
+            call_loop.close()
+    asyncio.set_event_loop(loop)
+
+
 def benchmark_orig_get_bulk():
     """Original bulk test"""
 
@@ -170,6 +598,50 @@ def benchmark_orig_set_bulk():
         int(NUM_REQUESTS * NUM_BULK / (time.time() - start))
     )
 
+def benchmark_sync_get_bulk():
+    """Blocking client bulk test"""
+
+    requests = _create_request()
+    [sync.set_bulk_kv(req, db=0) for req in requests]
+
+    start = time.time()
+    requests = _create_request()
+    [sync.get_bulk_keys(req.keys(), db=0) for req in requests]
+    print(
+        'sync get_bulk qps:',
+        int(NUM_REQUESTS * NUM_BULK / (time.time() - start))
+    )
+
+
+def benchmark_sync_set_bulk():
+    """Blocking client bulk test"""
+
+    requests = _create_request()
+    start = time.time()
+    [sync.set_bulk_kv(req, db=0) for req in requests]
+    print(
+        'sync set_bulk qps:',
+        int(NUM_REQUESTS * NUM_BULK / (time.time() - start))
+    )
+
+
+def benchmark_sync_pipelined():
+    """Blocking client, one call split into pipelined frames"""
+
+    requests = list(_create_request())
+    pipelined = ktasync.SyncKyotoTycoon(
+        host=client.host, port=client.port, max_frame_records=NUM_BULK
+    )
+    keys = [key for req in requests for key in req]
+    start = time.time()
+    pipelined.get_bulk_keys(keys, db=0)
+    print(
+        'sync pipelined get_bulk qps:',
+        int(len(keys) / (time.time() - start))
+    )
+    pipelined.close()
+
+
 def benchmark_dbm_set():
     """Dbm test"""
 
@@ -203,11 +675,27 @@ def benchmark_dbm_get():
     )
 
 print("Starting")
+print("embedded startup: %.3fs" % client.server.startup_time)
 benchmark_orig_get_bulk()
 benchmark_orig_set_bulk()
+benchmark_sync_get_bulk()
+benchmark_sync_set_bulk()
+benchmark_sync_pipelined()
 benchmark_get_bulk()
 benchmark_set_bulk()
 benchmark_batch_get_bulk()
+benchmark_memory_get_bulk()
+benchmark_transports()
+benchmark_socket_options()
+benchmark_call_overhead()
+benchmark_priority_lanes()
+benchmark_split_bulk()
+benchmark_offload()
+benchmark_flight_recorder()
+benchmark_drain()
+benchmark_hot_keys()
+benchmark_counters()
+benchmark_l2_cache()
 benchmark_dbm_get()
 benchmark_dbm_set()
 #os.unlink("test.kch")
@@ -41,14 +41,17 @@ been tested with python 3.4 since it is based on the asyncio module
 introduced in 3.4. If pypy will implement asyncio in can be ported to
 pypy and possibly other implementation.
 
+ktasync.py is generated from the template ktasync.pyt: "make aio" (the
+default) generates native coroutines (async def / await, Python 3.5+), "make
+cpy" generator based coroutines for Python 3.4 and "make pypy" trollius
+coroutines for PyPy and CPython 2.7. Call use_uvloop() to run on uvloop if it
+is installed.
+
 """
 
 # TODO PEP8
 # TODO Move documentation from homepage to code
 # TODO Add some logging (tornados nice output?):w
-# TODO embed factory method that creates a ktserver and client
-#      -> find free random port automatically (within range)
-#      -> with keep alive and logging of failures
 # TODO compare original / asyincio wo batch / asyncio with batch
 # TODO Write tests
 # TODO remove that lazy stuff, since we are always lazy (batching)
@@ -59,6 +62,7 @@ pypy and possibly other implementation.
 # TODO adsy blogging
 
 
+import os
 import socket
 import random
 import struct
@@ -68,11 +72,38 @@ import subprocess
 import sys
 import time
 import atexit
+import multiprocessing
+import collections
+import heapq
+import functools
+import tempfile
+try:
+    import dbm
+except ImportError:
+    import anydbm as dbm
+import json
+import itertools
+import signal
+import warnings
+from array import array
 try:
     import asyncio
 except ImportError:
     import trollius as asyncio
     from trollius import From, Return
+try:
+    import numpy
+except ImportError:
+    numpy = None
+try:
+    import uvloop
+except ImportError:
+    uvloop = None
+try:
+    import concurrent.futures
+    from multiprocessing import shared_memory
+except ImportError:
+    shared_memory = None
 
 MB_SET_BULK     = 0xb8
 MB_GET_BULK     = 0xba
@@ -84,589 +115,4865 @@ DEFAULT_HOST    = 'localhost'
 DEFAULT_PORT    = 1978
 DEFAULT_EXPIRE  = 0x7FFFFFFFFFFFFFFF
 MAX_CONNECTIONS = 4
+# Deprecated: default port range of KyotoTycoon.embedded(range_from, range_to)
+RANGE_FROM      = 2 ** 15 - 2 ** 14
+RANGE_TO        = 2 ** 15 - 1
+RETRIES         = 2
+RETRY_BACKOFF   = 0.05
+RETRY_BACKOFF_MAX = 1.0
+# Expected value size for the byte budget of get_bulk
+VALUE_ESTIMATE  = 1024
+# Receive buffer of SyncKyotoTycoon connections
+RECV_BUFFER     = 2 ** 16
+# get_bulk replies for a DecodePool are received in chunks of up to this size
+SHARED_CHUNK    = 2 ** 20
+# SyncKyotoTycoon sends requests of at least this size with sendmsg
+SENDMSG_MIN     = 2 ** 16
+# Buffers per sendmsg call
+IOV_MAX         = 1024
+# Bulk frames sent by SyncKyotoTycoon before reading the first reply
+PIPELINE_DEPTH  = 8
+# Increments of counters are merged over this window in seconds
+COUNTER_WINDOW  = 0.001
+# Apply the merged increments early if this many counters are pending
+COUNTER_BATCH   = 1024
+# The rest of the reply of a cancelled request is read in the background if
+# it is not larger and takes not longer, else the connection is closed
+DRAIN_BYTES     = 2 ** 20
+DRAIN_TIMEOUT   = 1.0
 
 FLAG_NOREPLY = 0x01
 
-RANGE_FROM = 2 ** 15 - 2 ** 14
-RANGE_TO   = 2 ** 15 - 1
+PRIORITY_INTERACTIVE = 'interactive'
+PRIORITY_BATCH       = 'batch'
 
+READY_TIMEOUT = 10.0
+# Delays between readiness probes of the embedded server, the last one is
+# repeated until READY_TIMEOUT
+READY_BACKOFF = (0.001, 0.002, 0.005, 0.01, 0.02, 0.05)
+# A ktserver dying faster than this is restarted with a backoff
+CRASH_LOOP_TIME = 1.0
+CRASH_BACKOFF_MAX = 5.0
 
-def _l():
-    """Get the logger"""
-    return logging.getLogger("ktasync")
+_HEADER = struct.Struct('!HIIq')
+_SCRIPT_HEADER = struct.Struct('!II')
+_COUNT = struct.Struct('!I')
+# Traffic log entry: timestamp, latency, response size, request size
+_TRAFFIC = struct.Struct('!dfII')
+TRAFFIC_MAGIC = b'KTTRAFFIC1\n'
+# Upper bound of the header of a request or reply
+HEADER_SIZE = 13
 
+# Procedures for the LUA extension of ktserver (ktserver -scr file), use
+# write_script() to create the file
+LUA_PROCEDURES = """\
+-- Procedures of ktasync
 
-class KyotoTycoonError(Exception):
-    """Class for Exceptions in this module"""
+-- Returns the input records
+function echo(inmap, outmap)
+   for key, value in pairs(inmap) do
+      outmap[key] = value
+   end
+   return kt.RVSUCCESS
+end
 
+-- Adds the decimal deltas to the counters, returns the new values
+function incr(inmap, outmap)
+   for key, value in pairs(inmap) do
+      local num = kt.db:increment(key, tonumber(value))
+      if not num then
+         return kt.RVELOGIC
+      end
+      outmap[key] = string.format("%d", num)
+   end
+   return kt.RVSUCCESS
+end
 
-class KyotoTycoon(object):
-    """New connections are created using the constructor. A connection is
-    automatically closed when the object is destroyed. There is the factory
-    method embedded which creates a server and client connected to it.
+-- Scans the database db (index, default 0) for keys starting with prefix.
+-- Returns up to limit keys as k1..kn, their values as v1..vn if values is
+-- set and the last key visited as cursor if the scan is not done. Pass
+-- cursor to continue after it, the key has to exist in hash databases:
+-- RVELOGIC is returned if it was removed. Set ordered for tree databases:
+-- the scan jumps to the prefix and stops after it. At most 16 * limit
+-- records are visited per call.
+function scan(inmap, outmap)
+   local db = kt.dbs[(tonumber(inmap.db) or 0) + 1]
+   if not db then
+      return kt.RVEINVALID
+   end
+   local prefix = inmap.prefix or ""
+   local limit = tonumber(inmap.limit) or 1000
+   local budget = limit * 16
+   local cur = db:cursor()
+   local found
+   if inmap.cursor then
+      found = cur:jump(inmap.cursor)
+      if not found and not inmap.ordered then
+         -- The cursor was removed, the position in the hash is lost
+         cur:disable()
+         return kt.RVELOGIC
+      end
+      if found and cur:get_key() == inmap.cursor then
+         found = cur:step()
+      end
+   elseif inmap.ordered and prefix ~= "" then
+      found = cur:jump(prefix)
+   else
+      found = cur:jump()
+   end
+   local count = 0
+   local last
+   while found and count < limit and budget > 0 do
+      local key, value = cur:get()
+      if not key then
+         found = false
+         break
+      end
+      local head = key:sub(1, #prefix)
+      if head == prefix then
+         count = count + 1
+         outmap["k" .. count] = key
+         if inmap.values then
+            outmap["v" .. count] = value
+         end
+      elseif inmap.ordered and head > prefix then
+         found = false
+         break
+      end
+      last = key
+      budget = budget - 1
+      found = cur:step()
+   end
+   if found and last then
+      outmap.cursor = last
+   end
+   cur:disable()
+   return kt.RVSUCCESS
+end
+"""
 
-    Keys and values of database entries are python bytes. You can pickle
-    objects to bytes strings. The encoding is handled by the user when
-    converting to bytes. Usually bytes(bla, encoding="UTF-8") is safe.
+# Errors of stale or broken connections, the request may be retried
+RETRY_ERRORS = (socket.error, asyncio.IncompleteReadError)
 
-    """
 
-    _client = None
+def _l():
+    """Get the logger"""
+    return logging.getLogger("ktasync")
 
-    @staticmethod
-    def embedded(
-            args=None,
-            timeout=None,
-            max_connections=MAX_CONNECTIONS,
-            range_from=RANGE_FROM,
-            range_to=RANGE_TO
-    ):
-        """Start an embedded Kyoto Tycoon server and return a client conencted
-        to it.
 
-        :param args: Additional arguments for the Kyoto Tycoon server.
+def use_uvloop():
+    """Use uvloop as event loop if it is installed. It sets the policy and a
+    new event loop for the current thread, call it before running clients on
+    the thread's loop.
 
-        :param timeout: Optional timeout for the socket. None means no timeout
-                        (please also look at the Python socket manual).
+    :return: True if uvloop is used.
+    """
+    if uvloop is None:
+        return False
+    asyncio.set_event_loop_policy(uvloop.EventLoopPolicy())
+    asyncio.set_event_loop(asyncio.new_event_loop())
+    return True
 
-        :param max_connections: Maximum connections for io batching.
 
-        :param range_from: Port range to select a random port from (from).
+class KyotoTycoonError(Exception):
+    """Class for Exceptions in this module"""
 
-        :param range_to: Port range to select a random port from (to).
 
-        :rtype: KyotoTycoon
+class ColumnarRecords(object):
+    """Column oriented result of get_bulk.
 
-        """
-        if KyotoTycoon._client:
-            return KyotoTycoon._client
-        if not args:
-            args = []
-        tries = 0
-        sock = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
-        while tries < 20:
-            tries += 1
-            port = random.randint(range_from, range_to)
-            try:
-                sock.bind(("127.0.0.1", port))
-                sock.listen(1)
-                tries = 21
-            except OSError:
-                pass
-            finally:
-                sock.close()
-                time.sleep(0.2)
+    Instead of a tuple per record, the payloads of all records are stored in
+    one contiguous buffer and the record fields in typed arrays:
 
-        def keep_alive():
-            """Helper"""
-            while True:
-                proc = subprocess.Popen(
-                    [
-                        "ktserver",
-                        "-le",
-                        "-host",
-                        "127.0.0.1",
-                        "-port",
-                        str(port)
-                    ] + args,
-                    stderr=sys.__stderr__.fileno(),
-                    stdout=sys.__stdout__.fileno(),
-                )
-                cleanup_done = [False]
-
-                def cleanup():
-                    """Helper"""
-                    try:
-                        cleanup_done[0] = True
-                        proc.terminate()
-                        proc.wait()
-                    except ProcessLookupError:
-                        pass
-
-                atexit.register(cleanup)
-                proc.wait()
-                time.sleep(10)
-                if not cleanup_done[0]:
-                    _l().critical("ktserver died!")
+    * buffer: bytes-like object holding keys and values back to back
+    * key_offsets, key_lengths: array('I') locating the keys in buffer
+    * val_offsets, val_lengths: array('I') locating the values in buffer
+    * xts: array('q') of expiration times
+    * dbs: array('H') of database indexes
 
-        thr = threading.Thread(target=keep_alive)
-        thr.setDaemon(True)
-        thr.start()
-        tries = 0
-        while tries < 20:
-            tries += 1
-            try:
-                KyotoTycoon._client = KyotoTycoon(
-                    host="127.0.0.1",
-                    port=port,
-                    probe=True,
-                    timeout=timeout,
-                    max_connections=max_connections
-                )
-                return KyotoTycoon._client
-            except ConnectionRefusedError:
-            # pypy #except Exception:
-                time.sleep(0.2)
-        raise KyotoTycoonError("Embedded server not started!")
+    Keys and values are returned as zero-copy memoryview slices of the buffer.
+    Convert them with bytes() if they have to outlive the result.
+    """
 
     def __init__(
             self,
-            host=DEFAULT_HOST,
-            port=DEFAULT_PORT,
-            probe=False,
-            timeout=None,
-            max_connections=MAX_CONNECTIONS,
+            buffer=b'',
+            key_offsets=None,
+            key_lengths=None,
+            val_offsets=None,
+            val_lengths=None,
+            xts=None,
+            dbs=None,
     ):
-        """
-        :param host: The hostname or IP to connect to, defaults to
-                     'localhost'.
+        self.buffer      = buffer
+        self.key_offsets = key_offsets if key_offsets is not None else (
+            array('I')
+        )
+        self.key_lengths = key_lengths if key_lengths is not None else (
+            array('I')
+        )
+        self.val_offsets = val_offsets if val_offsets is not None else (
+            array('I')
+        )
+        self.val_lengths = val_lengths if val_lengths is not None else (
+            array('I')
+        )
+        self.xts         = xts if xts is not None else array('q')
+        self.dbs         = dbs if dbs is not None else array('H')
 
-        :param port: The port number, defaults to 1978 which is the default
-                     port of Kyoto Tycoon.
+    def __len__(self):
+        return len(self.xts)
 
-        :param probe: If set to True, the server connection is checked. The
-                      connections are taken from a pool. This option helps
-                      to prevent late failures.
+    def key(self, index):
+        """Key of record index as memoryview"""
+        offset = self.key_offsets[index]
+        return memoryview(self.buffer)[
+            offset:offset + self.key_lengths[index]
+        ]
 
-        :param timeout: Optional timeout for the socket. None means no timeout
-                        (please also look at the Python socket manual).
+    def value(self, index):
+        """Value of record index as memoryview"""
+        offset = self.val_offsets[index]
+        return memoryview(self.buffer)[
+            offset:offset + self.val_lengths[index]
+        ]
+
+    def __iter__(self):
+        """Iterate over records as tuples of 4 entries: (key, val, db,
+        expire), key and val are memoryviews."""
+        view = memoryview(self.buffer)
+        for koff, klen, voff, vlen, db, xt in zip(
+                self.key_offsets,
+                self.key_lengths,
+                self.val_offsets,
+                self.val_lengths,
+                self.dbs,
+                self.xts,
+        ):
+            yield (view[koff:koff + klen], view[voff:voff + vlen], db, xt)
+
+    @staticmethod
+    def concat(parts):
+        """Concatenate ColumnarRecords into one, copying the buffers.
+
+        :rtype: ColumnarRecords
         """
-        self.host            = host
-        self.port            = port
-        self.timeout         = timeout
-        self.socket          = None
-        self.loop            = asyncio.get_event_loop()
-        self.max_connections = max_connections
-        self.free_streams    = []
-        self.semaphore       = asyncio.Semaphore(max_connections)
-        if probe:
-            self._probe()
+        res = ColumnarRecords(bytearray())
+        for part in parts:
+            shift = len(res.buffer)
+            res.buffer += part.buffer
+            res.key_offsets.extend(
+                offset + shift for offset in part.key_offsets
+            )
+            res.val_offsets.extend(
+                offset + shift for offset in part.val_offsets
+            )
+            res.key_lengths.extend(part.key_lengths)
+            res.val_lengths.extend(part.val_lengths)
+            res.xts.extend(part.xts)
+            res.dbs.extend(part.dbs)
+        return res
 
-    @asyncio.coroutine
-    def set(self, key, val, db=0, expire=DEFAULT_EXPIRE, flags=0):
-        """Wrapper function around set_bulk for easily storing a single item
-        in the database.
+    def as_numpy(self):
+        """Return the same records with the arrays converted to NumPy arrays.
 
-        :param key: The key of the entry,
+        The conversion does not copy, the NumPy arrays share the memory of the
+        original arrays.
 
-        :type key: bytes
+        :rtype: ColumnarRecords
+        """
+        if numpy is None:
+            raise KyotoTycoonError("NumPy is not installed")
+        return ColumnarRecords(
+            self.buffer,
+            numpy.frombuffer(self.key_offsets, dtype=numpy.uint32),
+            numpy.frombuffer(self.key_lengths, dtype=numpy.uint32),
+            numpy.frombuffer(self.val_offsets, dtype=numpy.uint32),
+            numpy.frombuffer(self.val_lengths, dtype=numpy.uint32),
+            numpy.frombuffer(self.xts, dtype=numpy.int64),
+            numpy.frombuffer(self.dbs, dtype=numpy.uint16),
+        )
 
-        :param val: The value of the entry
 
-        :type val: bytes
+def _decode_values(buf, offsets, lengths, decode):
+    """Apply decode to the values of buf at offsets with lengths"""
+    return [
+        decode(bytes(buf[offset:offset + length]))
+        for offset, length in zip(offsets, lengths)
+    ]
 
-        :param db: Database index to store the record in. Default to 0.
 
-        :type db: int
+def _decode_shared(name, offsets, lengths, decode):
+    """_decode_values on the shared memory name, runs in the processes of a
+    DecodePool"""
+    shm = shared_memory.SharedMemory(name)
+    try:
+        return _decode_values(shm.buf, offsets, lengths, decode)
+    finally:
+        shm.close()
 
-        :param expire: Expiration time for all entries.
-                       kyototycoon.DEFAULT_EXPIRE is 0x7FFFFFFFFFFFFFFF which
-                       means that the records should never expire in the
-                       (near) future.
 
-        :param flags: If set to kyototycoon.FLAG_NOREPLY, function will not
-                      wait for an answer of the server.
+def _grow_shared(shm, size, need):
+    """Copy the first size bytes of shm into a new shared memory of at least
+    need bytes"""
+    new = shared_memory.SharedMemory(
+        create=True, size=max(need, 2 * len(shm.buf))
+    )
+    new.buf[:size] = shm.buf[:size]
+    shm.close()
+    shm.unlink()
+    return new
 
-        :return: The number of actually stored records, or None if flags was
-                 set to kyototycoon.FLAG_NOREPLY.
-        """
-        return (yield from self.set_bulk(
-        # pypy #raise Return((yield From(self.set_bulk(
-            ((key, val, db, expire),), flags
-        ))
-        # pypy #))))
 
-    @asyncio.coroutine
-    def set_bulk_kv(self, kv, db=0, expire=DEFAULT_EXPIRE, flags=0):
-        """Wrapper function around set_bulk for simplifying the process of
-        storing multiple records with equal expiration times in the same
-        database.
+class _SharedReply(collections.namedtuple(
+        '_SharedReply', ('shm', 'size', 'records')
+)):
+    """get_bulk reply received into shared memory by
+    KyotoTycoon._read_shared with the ColumnarRecords arrays of its records,
+    decoded by DecodePool.parse"""
+    __slots__ = ()
 
-        :param kv: dict of key/value pairs.
+    def release(self):
+        """Free the shared memory of a reply that is not parsed"""
+        self.shm.close()
+        self.shm.unlink()
 
-        :param db: database index to store the values in. defaults to 0.
 
-        :param expire: Expiration time for all entries.
-                       kyototycoon.DEFAULT_EXPIRE is 0x7FFFFFFFFFFFFFFF which
-                       means that the records should never expire in the
-                       (near) future.
+def _discard_reply(res):
+    """Release the resources of a reply nobody uses"""
+    if isinstance(res, _SharedReply):
+        res.release()
 
-        :param flags: If set to kyototycoon.FLAG_NOREPLY, function will not
-                      wait for an answer of the server.
 
-        :return: The number of actually stored records, or None if flags was
-                 set to kyototycoon.FLAG_NOREPLY.
-        """
-        recs = ((key, val, db, expire) for key, val in kv.items())
-        return (yield from self.set_bulk(recs, flags))
-        # pypy #raise Return((yield From(self.set_bulk(recs, flags))))
+class DecodePool(object):
+    """Decode the values of huge get_bulk responses on a pool of processes.
 
-    @asyncio.coroutine
-    def set_bulk(self, recs, flags=0):
-        """Stores multiple records at once.
+    Pass it as offload to KyotoTycoon.get_bulk or get_bulk_keys. The
+    response is received in large chunks into a multiprocessing.shared_memory
+    buffer, the event loop only walks the record headers in place. The
+    processes get ranges of records (the offsets and lengths of their values)
+    and apply decode to the values. Only the decoded values are sent back,
+    the payload stays in the shared memory. Responses of less than
+    min_records records are decoded in the calling process.
 
-        :param recs: iterable (e.g. list) of records. Each record is a
-                     list or tuple of 4 entries: key, val, db, expire
+    decode has to be picklable (e.g. a module level function), it gets the
+    value as bytes. It is applied if the records are not returned columnar.
+    """
 
-        :param flags: If set to kyototycoon.FLAG_NOREPLY, function will not
-                      wait for an answer of the server.
+    def __init__(self, processes=None, decode=None, min_records=10000):
+        if shared_memory is None:
+            raise KyotoTycoonError("shared_memory needs Python 3.8+")
+        self.processes   = processes or multiprocessing.cpu_count()
+        self.decode      = decode
+        self.min_records = min_records
+        self.executor    = concurrent.futures.ProcessPoolExecutor(
+            self.processes
+        )
 
-        :return: The number of actually stored records, or None if flags was
-                 set to kyototycoon.FLAG_NOREPLY.
+    def range_size(self, count):
+        """Records per range of a response of count records"""
+        if count < self.min_records:
+            return max(count, 1)
+        return -(-count // self.processes)
+
+    async def parse(self, response, columnar):
+        """Decode a response read by KyotoTycoon._read_shared.
+
+        :return: ColumnarRecords over the shared memory and the list of
+                 decoded values or None
         """
-        sr, sw = yield from self._pop_streams()
-        # pypy #sr, sw = yield From(self._pop_streams())
+        shm, size, res = response
+        decode = None if columnar else self.decode
+        count = len(res)
+        step = self.range_size(count)
         try:
-            request = [struct.pack('!BI', MB_SET_BULK, flags), None]
-
-            cnt = 0
-            for key, val, db, xt in recs:
-                assert isinstance(key, bytes), "Please pass bytes as key"
-                assert isinstance(val, bytes), "Please pass bytes as value"
-                request.append(
-                    struct.pack('!HIIq', db, len(key), len(val), xt)
+            if decode is None:
+                decoded = None
+            elif step < count:
+                parts = await asyncio.gather(*[
+                # pypy #parts = yield From(asyncio.gather(*[
+                    asyncio.wrap_future(self.executor.submit(
+                        _decode_shared,
+                        shm.name,
+                        res.val_offsets[start:start + step],
+                        res.val_lengths[start:start + step],
+                        decode,
+                    ))
+                    for start in range(0, count, step)
+                ])
+                # pypy #]))
+                decoded = [val for part in parts for val in part]
+            else:
+                decoded = _decode_values(
+                    shm.buf, res.val_offsets, res.val_lengths, decode
                 )
-                request.append(key)
-                request.append(val)
-                cnt += 1
+        except BaseException:
+            shm.close()
+            raise
+        finally:
+            shm.unlink()
+        res.buffer = shm.buf[:size]
+        # Keep the shared memory open as long as the records
+        res.shared_memory = shm
+        return res, decoded
+        # pypy #raise Return((res, decoded))
 
-            request[1] = struct.pack('!I', cnt)
+    @staticmethod
+    def records(res, decoded):
+        """Convert the result of parse to a list of records, releasing the
+        shared memory"""
+        if decoded is None:
+            recs = [
+                (bytes(key), bytes(val), db, xt) for key, val, db, xt in res
+            ]
+        else:
+            recs = [
+                (bytes(key), val, db, xt)
+                for (key, _, db, xt), val in zip(res, decoded)
+            ]
+        res.buffer.release()
+        res.shared_memory.close()
+        return recs
 
-            sw.write(b''.join(request))
+    def close(self):
+        """Shut the processes down"""
+        self.executor.shutdown()
 
-            if flags & FLAG_NOREPLY:
-                self._push_streams(sr, sw)
-                return None
-                # pypy #raise Return(None)
-
-            magic, = struct.unpack('!B', (
-                yield from sr.readexactly(1))
-            # pypy #    yield From(sr.readexactly(1)))
-            )
-            if magic == MB_SET_BULK:
-                recs_cnt, = struct.unpack('!I', (
-                    yield from sr.readexactly(4))
-                # pypy #    yield From(sr.readexactly(4)))
-                )
-                self._push_streams(sr, sw)
-                return recs_cnt
-                # pypy #raise Return(recs_cnt)
-            elif magic == MB_ERROR:
-                raise KyotoTycoonError(
-                    'Internal server error 0x%02x' % MB_ERROR
-                )
-            else:
-                raise KyotoTycoonError('Unknown server error')
-        finally:
-            self._release_connection()
 
-    @asyncio.coroutine
-    def get(self, key, db=0, flags=0):
-        """Wrapper function around get_bulk for easily retrieving a single
-        item from the database.
+def _set_size(rec):
+    """Encoded size of a set_bulk record"""
+    return 18 + len(rec[0]) + len(rec[1])
 
 
-        :param key: The key of the entry
-        :type  key: bytes
+def _key_size(rec):
+    """Encoded size of a get_bulk or remove_bulk record"""
+    return 6 + len(rec[0])
 
-        :param db: The database index. Defaults to 0.
 
-        :param flags: reserved and not used now. (defined by protocol)
+def _script_size(rec):
+    """Encoded size of a play_script record"""
+    return 8 + len(rec[0]) + len(rec[1])
 
-        :return: The value of the record, or None if the record could not be
-                 found in the database.
 
-        """
-        recs = yield from self.get_bulk(((key, db),), flags)
-        # pypy #recs = yield From(self.get_bulk(((key, db),), flags))
-        if not recs:
-            return None
-            # pypy #raise Return(None)
-        return recs[0][1]
-        # pypy #raise Return(recs[0][1])
+def _set_bulk_parts(recs, flags):
+    """Encode a set_bulk request as list of parts"""
+    request = [struct.pack('!BI', MB_SET_BULK, flags), None]
 
-    @asyncio.coroutine
-    def get_bulk_keys(self, keys, db=0, flags=0):
-        """Wrapper function around get_bulk for simplifying the process of
-        retrieving multiple records from the same database.
+    cnt = 0
+    for key, val, db, xt in recs:
+        assert isinstance(key, bytes), "Please pass bytes as key"
+        assert isinstance(val, bytes), "Please pass bytes as value"
+        request.append(
+            struct.pack('!HIIq', db, len(key), len(val), xt)
+        )
+        request.append(key)
+        request.append(val)
+        cnt += 1
 
-        :param keys: iterable (e.g. list) of keys.
+    request[1] = struct.pack('!I', cnt)
+    return request
 
-        :param db: database index to store the values in. defaults to 0.
 
-        :param flags: reserved and not used now. (defined by protocol)
+def _encode_set_bulk(recs, flags):
+    """Encode a set_bulk request"""
+    return b''.join(_set_bulk_parts(recs, flags))
 
-        :return: dict of key/value pairs.
-        """
-        recs = ((key, db) for key in keys)
-        recs = yield from self.get_bulk(recs, flags)
-        return dict(((key, val) for key, val, db, xt in recs))
-        # pypy #recs = yield From(self.get_bulk(recs, flags))
-        # pypy #raise Return(dict(((key, val) for key, val, db, xt in recs)))
 
-    @asyncio.coroutine
-    def get_bulk(self, recs, flags=0):
-        """Retrieves multiple records at once.
+def _keys_parts(magic, recs, flags):
+    """Encode a get_bulk or remove_bulk request as list of parts"""
+    request = [struct.pack('!BI', magic, flags), None]
 
-        :param recs: iterable (e.g. list) of record descriptions. Each
-                     record is a list or tuple of 2 entries: key,db
+    cnt = 0
+    for key, db in recs:
+        assert isinstance(key, bytes), "Please pass bytes as key"
+        request.append(struct.pack('!HI', db, len(key)))
+        request.append(key)
+        cnt += 1
 
-        :param flags: reserved and not used now. (defined by protocol)
+    request[1] = struct.pack('!I', cnt)
+    return request
 
-        :return: A list of records. Each record is a tuple of 4 entries: (key,
-                 val, db, expire)
-        """
-        sr, sw = yield from self._pop_streams()
-        # pypy #sr, sw = yield From(self._pop_streams())
-        try:
-            request = [struct.pack('!BI', MB_GET_BULK, flags), None]
 
-            cnt = 0
-            for key, db in recs:
-                assert isinstance(key, bytes), "Please pass bytes as key"
-                request.append(struct.pack('!HI', db, len(key)))
-                request.append(key)
-                cnt += 1
+def _encode_keys(magic, recs, flags):
+    """Encode a get_bulk or remove_bulk request"""
+    return b''.join(_keys_parts(magic, recs, flags))
 
-            request[1] = struct.pack('!I', cnt)
 
-            sw.write(b''.join(request))
-            res = yield from self._read_keys(sr, MB_GET_BULK)
-            # pypy #res = yield From(self._read_keys(sr, MB_GET_BULK))
-            self._push_streams(sr, sw)
-            return res
-            # pypy #raise Return(res)
-        finally:
-            self._release_connection()
+_get_running_loop = getattr(asyncio, '_get_running_loop', None)
 
-    @asyncio.coroutine
-    def _read_keys(self, sr, magic_expect):
-        """Internal function for reading key from get_bulk or play_script"""
-        data = yield from sr.readexactly(5)
-        # pypy #data = yield From(sr.readexactly(5))
-        magic, = struct.unpack('!B', data[:1])
-        if magic == magic_expect:
-            recs_cnt, = struct.unpack('!I', data[1:])
-            recs_cnt -= 1
-            recs = []
-            # Reduce yields be reading key and next header at once
-            if recs_cnt >= 0:
-                data = yield from sr.readexactly(18)
-                # pypy #data = yield From(sr.readexactly(18))
-                pre_data = 0
-                for _ in range(recs_cnt):
-                    db, key_len, val_len, xt = struct.unpack(
-                        '!HIIq', data[pre_data:]
-                    )
-                    pre_data = key_len + val_len
-                    data = yield from sr.readexactly(pre_data + 18)
-                    # pypy #data = yield From(sr.readexactly(pre_data + 18))
-                    recs.append((data[:key_len], data[key_len:], db, xt))
-                db, key_len, val_len, xt = struct.unpack(
-                    '!HIIq', data[pre_data:]
-                )
-                pre_data = key_len + val_len
-                data = yield from sr.readexactly(pre_data)
-                # pypy #data = yield From(sr.readexactly(pre_data))
-                recs.append((data[:key_len], data[key_len:], db, xt))
-            return recs
-            # pypy #raise Return(recs)
-        elif magic == MB_ERROR:
-            raise KyotoTycoonError(
-                'Internal server error 0x%02x' % MB_ERROR
-            )
-        else:
-            raise KyotoTycoonError('Unknown server error')
 
-    @asyncio.coroutine
-    def remove(self, key, db, flags=0):
-        """Wrapper function around remove_bulk for easily removing a single
-        item from the database.
+def _current_loop():
+    """The running event loop, else the event loop of the thread"""
+    loop = None
+    if _get_running_loop is not None:
+        loop = _get_running_loop()
+    if loop is None:
+        loop = asyncio.get_event_loop()
+    return loop
 
-        :param key: The key of the entry.
-        :type  key: bytes
 
-        :param db: database index to store the values in. defaults to 0.
+def _percentile(values, pct):
+    """Percentile of a list of values"""
+    values = sorted(values)
+    return values[min(len(values) - 1, int(len(values) * pct / 100.0))]
 
-        :param flags: If set to kyototycoon.FLAG_NOREPLY, function will not
-                      wait for an answer of the server.
 
-        :return: The number of removed records, or None if flags was set to
-                 kyototycoon.FLAG_NOREPLY
-        """
-        return (yield from self.remove_bulk(((key, db),), flags))
-        # pypy #raise Return((yield From(self.remove_bulk(((key, db),), flags))))
+def _sum_counts(counts):
+    """Merge the counts of split set_bulk or remove_bulk calls"""
+    if None in counts:
+        return None
+    return sum(counts)
 
-    @asyncio.coroutine
-    def remove_bulk_keys(self, keys, db, flags=0):
-        """Wrapper function around remove_bulk for simplifying the process of
-        removing multiple records from the same database.
 
-        :param keys: iterable (e.g. list) of keys.
+def write_script(path=None):
+    """Write the LUA procedures of ktasync (LUA_PROCEDURES) to a file, which
+    can be passed to ktserver -scr.
 
-        :param db: database index to store the values in. defaults to 0.
+    :param path: Path of the file, defaults to a new temporary file.
 
-        :param flags: If set to kyototycoon.FLAG_NOREPLY, function will not
-                      wait for an answer of the server.
+    :return: The path of the file.
+    """
+    if path is None:
+        fd, path = tempfile.mkstemp(suffix=".lua", prefix="ktasync")
+        os.close(fd)
+    with open(path, "w") as out:
+        out.write(LUA_PROCEDURES)
+    return path
 
-        :return: The number of removed records, or None if flags was set to
-                 kyototycoon.FLAG_NOREPLY
-        """
-        recs = ((key, db) for key in keys)
-        return (yield from self.remove_bulk(recs, flags))
-        # pypy #raise Return((yield From(self.remove_bulk(recs, flags))))
 
-    @asyncio.coroutine
-    def remove_bulk(self, recs, flags=0):
-        """Remove multiple records at once.
+def _identity(value):
+    """Codec passing values unchanged"""
+    return value
 
-        :param recs: iterable (e.g. list) of record descriptions. Each
-                     record is a list or tuple of 2 entries: key,db
 
-        :param flags: If set to kyototycoon.FLAG_NOREPLY, function will not
-                      wait for an answer of the server.
+def encode_dict(mapping):
+    """Argument codec for scripts: dict of bytes to records"""
+    return mapping.items()
 
-        :return: The number of removed records, or None if flags was set to
-                 kyototycoon.FLAG_NOREPLY
-        """
-        sr, sw = yield from self._pop_streams()
-        # pypy #sr, sw = yield From(self._pop_streams())
-        try:
 
-            request = [struct.pack('!BI', MB_REMOVE_BULK, flags), None]
+def decode_dict(recs):
+    """Result codec for scripts: records to dict"""
+    return dict(recs)
 
-            cnt = 0
-            for key, db in recs:
-                request.append(struct.pack('!HI', db, len(key)))
-                request.append(key)
-                cnt += 1
 
-            request[1] = struct.pack('!I', cnt)
+def _free_port(host):
+    """Let the OS pick a free port"""
+    sock = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+    try:
+        sock.bind((host, 0))
+        return sock.getsockname()[1]
+    finally:
+        sock.close()
 
-            sw.write(''.join(request))
 
-            if flags & FLAG_NOREPLY:
-                self._push_streams(sr, sw)
-                return None
-                # pypy #raise Return(None)
-
-            magic, = struct.unpack(
-                '!B', (yield from sr.readexactly(1))
-            # pypy #    '!B', (yield From(sr.readexactly(1)))
-            )
-            if magic == MB_REMOVE_BULK:
-                recs_cnt, = struct.unpack(
-                    '!I', (yield from sr.readexactly(4))
-                # pypy #    '!I', (yield From(sr.readexactly(4)))
+def _free_port_in(host, range_from, range_to, tries=20):
+    """Pick a random free port in [range_from, range_to]"""
+    for _ in range(tries):
+        port = random.randint(range_from, range_to)
+        sock = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+        try:
+            sock.bind((host, port))
+            return port
+        except (OSError, socket.error):
+            pass
+        finally:
+            sock.close()
+    raise KyotoTycoonError(
+        "No free port in range %d-%d" % (range_from, range_to)
+    )
+
+
+def _connect(host, port, unix_path, timeout):
+    """Connect a blocking socket over TCP or to a UNIX socket"""
+    if unix_path is None:
+        return socket.create_connection((host, port), timeout)
+    sock = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+    try:
+        sock.settimeout(timeout)
+        sock.connect(unix_path)
+    except BaseException:
+        sock.close()
+        raise
+    return sock
+
+
+def _ping(host, port, unix_path, timeout):
+    """Binary protocol round trip: an empty get_bulk"""
+    sock = _connect(host, port, unix_path, timeout)
+    try:
+        sock.sendall(struct.pack('!BII', MB_GET_BULK, 0, 0))
+        data = b''
+        while len(data) < 5:
+            recv = sock.recv(5 - len(data))
+            if not recv:
+                raise KyotoTycoonError("Connection closed by server")
+            data += recv
+        if struct.unpack('!BI', data) != (MB_GET_BULK, 0):
+            raise KyotoTycoonError("Unexpected reply from server")
+    finally:
+        sock.close()
+
+
+class EmbeddedConfig(object):
+    """Tuning profile of an embedded server.
+
+    Generates the ktserver options and the database tuning suffixes from the
+    expected number of records and the memory budget.
+
+    Database types:
+
+    * 'memhash': on-memory hash database (*), capsiz limits the memory
+    * 'memtree': on-memory tree database (%)
+    * 'hash': file hash database (.kch), msiz is the mapped memory
+    * 'tree': file tree database (.kct), pccap is the page cache
+    """
+
+    DB_TYPES = {
+        'memhash': '*',
+        'memtree': '%',
+        'hash': '.kch',
+        'tree': '.kct',
+    }
+
+    def __init__(
+            self,
+            db_type='memhash',
+            path=None,
+            records=1000000,
+            memory=64 * 2 ** 20,
+            threads=None,
+            opts=None,
+            port=None,
+            args=None,
+            unix_path=None,
+            scripts=None,
+    ):
+        """
+        :param db_type: One of 'memhash', 'memtree', 'hash' or 'tree'.
+
+        :param path: Path of the database file without extension, required
+                     by file databases.
+
+        :param records: Expected number of records.
+
+        :param memory: Memory budget in bytes.
+
+        :param threads: Number of worker threads, defaults to two per CPU.
+
+        :param opts: Database options (#opts), for example 'l' (linear) or
+                     'c' (compress). Defaults to 'l' for file hash databases.
+
+        :param port: Port of the server. None lets the OS pick a free port.
+
+        :param args: Additional arguments for the Kyoto Tycoon server.
+
+        :param unix_path: Listen on this UNIX socket instead of TCP.
+
+        :param scripts: Path of a LUA script file (ktserver -scr), True
+                        loads the procedures of ktasync (LUA_PROCEDURES).
+        """
+        if db_type not in self.DB_TYPES:
+            raise KyotoTycoonError("Unknown database type %s" % db_type)
+        if path is None and db_type in ('hash', 'tree'):
+            raise KyotoTycoonError("File databases need a path")
+        if threads is None:
+            threads = 2 * multiprocessing.cpu_count()
+        if opts is None and db_type == 'hash':
+            opts = 'l'
+        self.db_type = db_type
+        self.path    = path
+        self.records = records
+        self.memory  = memory
+        self.threads = threads
+        self.opts    = opts
+        self.port    = port
+        self.args    = list(args or [])
+        self.unix_path = unix_path
+        self.scripts   = scripts
+
+    def tuning(self):
+        """The tuning parameters of the database as list of (name, value)"""
+        records = max(1, self.records)
+        if self.db_type == 'memhash':
+            params = [('bnum', records * 2), ('capsiz', self.memory)]
+        elif self.db_type == 'memtree':
+            params = [('bnum', max(1, records // 10)), ('pccap', self.memory)]
+        elif self.db_type == 'hash':
+            params = [('bnum', records * 2), ('msiz', self.memory)]
+        else:
+            params = [
+                ('bnum', max(1, records // 10)),
+                ('msiz', self.memory // 2),
+                ('pccap', self.memory // 2),
+            ]
+        if self.opts:
+            params.append(('opts', self.opts))
+        return params
+
+    def db_spec(self):
+        """The database argument of ktserver, for example
+        'sessions.kch#bnum=2000000#msiz=67108864#opts=l'"""
+        spec = (self.path or '') + self.DB_TYPES[self.db_type]
+        return spec + ''.join(
+            '#%s=%s' % (name, value) for name, value in self.tuning()
+        )
+
+    def server_args(self):
+        """The arguments for ktserver. With scripts=True the caller has to
+        remove the temporary script file (EmbeddedServer does on stop)."""
+        return self._server_args()[0]
+
+    def _server_args(self):
+        """The arguments for ktserver and the temporary script file or None"""
+        args = ['-th', str(self.threads)]
+        scripts = self.scripts
+        temp_script = None
+        if scripts is True:
+            scripts = temp_script = write_script()
+        if scripts:
+            args += ['-scr', scripts]
+        return args + self.args + [self.db_spec()], temp_script
+
+
+class EmbeddedServer(object):
+    """Runs a ktserver process and restarts it when it dies.
+
+    If no port is given the OS picks a free one. With unix_path the server
+    listens on a UNIX socket (ktserver -host @path) instead. The server is
+    ready as soon as it answers a binary protocol request. The time it took
+    is stored in startup_time.
+    """
+
+    def __init__(
+            self,
+            args=None,
+            port=None,
+            host="127.0.0.1",
+            unix_path=None,
+            temp_files=None,
+    ):
+        """
+        :param args: Additional arguments for the Kyoto Tycoon server.
+
+        :param port: Port to listen on. None lets the OS pick a free port.
+
+        :param host: Address to listen on, defaults to '127.0.0.1'.
+
+        :param unix_path: Listen on this UNIX socket instead of TCP.
+
+        :param temp_files: Files removed when the server stops, like a
+                           temporary LUA script.
+        """
+        self.args          = list(args or [])
+        self.temp_files    = list(temp_files or [])
+        self.host          = host
+        self.fixed_port    = port is not None
+        self.port          = port
+        self.unix_path     = unix_path
+        self.proc          = None
+        self.startup_time  = None
+        self.restarts      = 0
+        self._stopped      = False
+        self._lock         = threading.Lock()
+        self._thread       = None
+
+    def _spawn(self):
+        """Start the ktserver process"""
+        if self.unix_path is not None:
+            if os.path.exists(self.unix_path):
+                os.unlink(self.unix_path)
+            listen = ["-host", "@" + self.unix_path]
+        else:
+            if self.port is None:
+                self.port = _free_port(self.host)
+            listen = ["-host", self.host, "-port", str(self.port)]
+        self.proc = subprocess.Popen(
+            ["ktserver", "-le"] + listen + self.args,
+            stderr=sys.__stderr__.fileno(),
+            stdout=sys.__stdout__.fileno(),
+        )
+
+    def start(self, timeout=READY_TIMEOUT):
+        """Start the server and wait until it is ready.
+
+        :param timeout: Seconds to wait for the server.
+
+        :return: The startup time in seconds.
+        """
+        start = time.time()
+        tries = 0
+        while True:
+            tries += 1
+            with self._lock:
+                self._spawn()
+            try:
+                self.wait_ready(timeout - (time.time() - start))
+                break
+            except KyotoTycoonError:
+                # The port may have been taken between picking and binding
+                if (
+                        self.fixed_port or
+                        self.unix_path is not None or
+                        tries >= 3 or
+                        self.proc.poll() is None
+                ):
+                    self.stop()
+                    raise
+                self.port = None
+        self.startup_time = time.time() - start
+        _l().info(
+            "ktserver ready on %s in %.3fs", self.address(), self.startup_time
+        )
+        if self._thread is None:
+            atexit.register(self.stop)
+            self._thread = threading.Thread(target=self._keep_alive)
+            self._thread.daemon = True
+            self._thread.start()
+        return self.startup_time
+
+    def wait_ready(self, timeout=READY_TIMEOUT):
+        """Wait until the server answers a binary protocol request.
+
+        :param timeout: Seconds to wait for the server.
+        """
+        deadline = time.time() + timeout
+        delays = iter(READY_BACKOFF)
+        delay = 0
+        while True:
+            if self.proc.poll() is not None:
+                raise KyotoTycoonError(
+                    "ktserver exited with %d" % self.proc.returncode
+                )
+            try:
+                _ping(
+                    self.host,
+                    self.port,
+                    self.unix_path,
+                    max(0.01, min(1.0, deadline - time.time())),
+                )
+                return
+            except (socket.error, KyotoTycoonError):
+                if time.time() >= deadline:
+                    raise KyotoTycoonError("Embedded server not started!")
+            delay = next(delays, delay)
+            time.sleep(delay)
+
+    def _keep_alive(self):
+        """Restart the server when it dies"""
+        backoff = 0
+        while True:
+            proc = self.proc
+            started = time.time()
+            proc.wait()
+            with self._lock:
+                if self._stopped:
+                    return
+                _l().critical(
+                    "ktserver died with %d, restarting", proc.returncode
+                )
+                if time.time() - started < CRASH_LOOP_TIME:
+                    backoff = min(CRASH_BACKOFF_MAX, backoff * 2 or 0.1)
+                else:
+                    backoff = 0
+            time.sleep(backoff)
+            with self._lock:
+                if self._stopped:
+                    return
+                self.restarts += 1
+                start = time.time()
+                self._spawn()
+            try:
+                self.wait_ready()
+                self.startup_time = time.time() - start
+                _l().info(
+                    "ktserver restarted on %s in %.3fs",
+                    self.address(),
+                    self.startup_time,
+                )
+            except KyotoTycoonError:
+                _l().critical("ktserver restart failed")
+
+    def address(self):
+        """Address of the server for logging"""
+        if self.unix_path is not None:
+            return self.unix_path
+        return "port %d" % self.port
+
+    def stop(self):
+        """Stop the server"""
+        with self._lock:
+            self._stopped = True
+            proc = self.proc
+        if proc is not None and proc.poll() is None:
+            try:
+                proc.terminate()
+                proc.wait()
+            except OSError:
+                pass
+        if self.unix_path is not None and os.path.exists(self.unix_path):
+            os.unlink(self.unix_path)
+        while self.temp_files:
+            path = self.temp_files.pop()
+            if os.path.exists(path):
+                os.unlink(path)
+
+
+class SocketOptions(object):
+    """Socket options applied to every pooled connection.
+
+    Options set to None keep the default of the operating system. The TCP
+    options are ignored for UNIX sockets and on platforms that do not
+    support them.
+    """
+
+    def __init__(
+            self,
+            nodelay=True,
+            sndbuf=None,
+            rcvbuf=None,
+            keepalive=None,
+            keepidle=None,
+            keepintvl=None,
+            keepcnt=None,
+            limit=None,
+            write_high=None,
+            write_low=None,
+    ):
+        """
+        :param nodelay: Set TCP_NODELAY to disable Nagle's algorithm, so small
+                        frames are sent without delay. asyncio sets it
+                        already since Python 3.6, False enables Nagle's
+                        algorithm again.
+
+        :param sndbuf: Size of the send buffer (SO_SNDBUF) in bytes.
+
+        :param rcvbuf: Size of the receive buffer (SO_RCVBUF) in bytes.
+
+        :param keepalive: Enable TCP keepalive (SO_KEEPALIVE), so idle pooled
+                          connections are not dropped silently by firewalls.
+
+        :param keepidle: Seconds of idle time before keepalive probes are
+                         sent (TCP_KEEPIDLE).
+
+        :param keepintvl: Seconds between keepalive probes (TCP_KEEPINTVL).
+
+        :param keepcnt: Number of failed probes before the connection is
+                        dropped (TCP_KEEPCNT).
+
+        :param limit: Buffer limit of the asyncio StreamReader in bytes. Large
+                      bulk frames are read with fewer pauses if the limit is
+                      higher.
+
+        :param write_high: High-water mark of the write buffer in bytes.
+
+        :param write_low: Low-water mark of the write buffer in bytes.
+        """
+        self.nodelay    = nodelay
+        self.sndbuf     = sndbuf
+        self.rcvbuf     = rcvbuf
+        self.keepalive  = keepalive
+        self.keepidle   = keepidle
+        self.keepintvl  = keepintvl
+        self.keepcnt    = keepcnt
+        self.limit      = limit
+        self.write_high = write_high
+        self.write_low  = write_low
+
+    def stream_kwargs(self):
+        """Keyword arguments for asyncio.open_connection"""
+        if self.limit is None:
+            return {}
+        return {'limit': self.limit}
+
+    def apply(self, sw):
+        """Apply the options to the socket of the stream writer sw"""
+        sock = sw.get_extra_info('socket')
+        if sock is None:
+            return
+        self.apply_socket(sock)
+        if self.write_high is not None or self.write_low is not None:
+            sw.transport.set_write_buffer_limits(
+                self.write_high, self.write_low
+            )
+
+    def apply_socket(self, sock):
+        """Apply the socket options to sock"""
+        opts = [
+            (socket.SOL_SOCKET, socket.SO_SNDBUF, self.sndbuf),
+            (socket.SOL_SOCKET, socket.SO_RCVBUF, self.rcvbuf),
+        ]
+        if sock.family in (socket.AF_INET, socket.AF_INET6):
+            tcp = socket.IPPROTO_TCP
+            opts.append((tcp, socket.TCP_NODELAY, self.nodelay))
+            opts.append(
+                (socket.SOL_SOCKET, socket.SO_KEEPALIVE, self.keepalive)
+            )
+            for name, value in (
+                    ('TCP_KEEPIDLE', self.keepidle),
+                    ('TCP_KEEPINTVL', self.keepintvl),
+                    ('TCP_KEEPCNT', self.keepcnt),
+            ):
+                if hasattr(socket, name):
+                    opts.append((tcp, getattr(socket, name), value))
+        for level, opt, value in opts:
+            if value is not None:
+                sock.setsockopt(level, opt, int(value))
+
+
+class _Lanes(object):
+    """Priority aware replacement of a semaphore limiting the connections.
+
+    Each lane (traffic class) has reserved capacity, which the other lanes
+    cannot use. Waiting requests are served by lane priority, the first lane
+    has the highest priority, and in FIFO order within a lane.
+    """
+
+    def __init__(self, max_connections, lanes):
+        self.max_connections = max_connections
+        self.order           = [name for name, _ in lanes]
+        self.reserved        = dict(lanes)
+        self.used            = dict((name, 0) for name in self.order)
+        self.waiters         = dict(
+            (name, collections.deque()) for name in self.order
+        )
+        self.total           = 0
+        reserved = sum(self.reserved.values())
+        if reserved > max_connections:
+            raise KyotoTycoonError(
+                "Lanes reserve more than max_connections connections"
+            )
+        if reserved == max_connections and (
+                min(self.reserved.values()) == 0
+        ):
+            raise KyotoTycoonError(
+                "Lanes without reserved connections would starve"
+            )
+
+    def _can_take(self, lane):
+        """Check if lane may take a connection without using the reserved
+        capacity of other lanes"""
+        held_back = sum(
+            max(0, self.reserved[other] - self.used[other])
+            for other in self.order if other != lane
+        )
+        return self.max_connections - self.total > held_back
+
+    def _take(self, lane):
+        """Account a connection"""
+        self.used[lane] += 1
+        self.total += 1
+
+    async def acquire(self, lane):
+        """Acquire a connection slot of lane"""
+        if lane not in self.used:
+            raise KyotoTycoonError("Unknown priority %s" % lane)
+        if not self.waiters[lane] and self._can_take(lane):
+            self._take(lane)
+            return
+        fut = asyncio.Future()
+        self.waiters[lane].append(fut)
+        try:
+            await fut
+            # pypy #yield From(fut)
+        except asyncio.CancelledError:
+            if fut.done() and not fut.cancelled():
+                self.release(lane)
+            elif fut in self.waiters[lane]:
+                self.waiters[lane].remove(fut)
+            raise
+
+    def release(self, lane):
+        """Release a connection slot of lane and wake waiting requests"""
+        self.used[lane] -= 1
+        self.total -= 1
+        for name in self.order:
+            waiters = self.waiters[name]
+            while waiters and self._can_take(name):
+                fut = waiters.popleft()
+                if not fut.done():
+                    self._take(name)
+                    fut.set_result(None)
+
+    def waiting(self):
+        """Number of waiting requests per lane"""
+        return dict(
+            (name, len(waiters)) for name, waiters in self.waiters.items()
+        )
+
+
+class ByteBudget(object):
+    """Client-wide budget of in-flight bytes.
+
+    Requests reserve their encoded size plus the expected size of the
+    response before they are sent and wait (async, FIFO) while the budget is
+    exhausted. A single request larger than the limit is admitted when
+    nothing else is in flight. The limit None disables the budget, only the
+    metrics are kept.
+    """
+
+    def __init__(self, limit=None):
+        """
+        :param limit: Maximum in-flight bytes or None.
+        """
+        self.limit     = limit
+        self.in_flight = 0
+        self.peak      = 0
+        self.waits     = 0
+        self.wait_time = 0.0
+        self.waiters   = collections.deque()
+
+    def _fits(self, size):
+        """Check if size bytes fit into the budget"""
+        return (
+            self.limit is None or
+            self.in_flight == 0 or
+            self.in_flight + size <= self.limit
+        )
+
+    def charge(self, size):
+        """Account size bytes without waiting"""
+        self.in_flight += size
+        if self.in_flight > self.peak:
+            self.peak = self.in_flight
+
+    async def acquire(self, size):
+        """Wait until size bytes fit into the budget and account them"""
+        if not self.waiters and self._fits(size):
+            self.charge(size)
+            return
+        fut = asyncio.Future()
+        entry = (size, fut)
+        self.waiters.append(entry)
+        self.waits += 1
+        start = time.time()
+        try:
+            await fut
+            # pypy #yield From(fut)
+        except asyncio.CancelledError:
+            if fut.done() and not fut.cancelled():
+                self.release(size)
+            elif entry in self.waiters:
+                self.waiters.remove(entry)
+            raise
+        finally:
+            self.wait_time += time.time() - start
+
+    def release(self, size):
+        """Release size bytes and wake waiting requests"""
+        self.in_flight -= size
+        while self.waiters and self._fits(self.waiters[0][0]):
+            size, fut = self.waiters.popleft()
+            if not fut.done():
+                self.charge(size)
+                fut.set_result(None)
+
+    def stats(self):
+        """Metrics of the budget as dict: limit, in_flight, peak, waiting,
+        waits (total) and wait_time (total seconds)"""
+        return {
+            'limit': self.limit,
+            'in_flight': self.in_flight,
+            'peak': self.peak,
+            'waiting': len(self.waiters),
+            'waits': self.waits,
+            'wait_time': self.wait_time,
+        }
+
+
+class Script(object):
+    """A predeclared procedure of the LUA extension.
+
+    The encoded name and its length are cached. The argument codec encode
+    turns the arguments of a call into an iterable of (key, val) records,
+    the result codec decode turns the returned records into the result.
+    Both default to passing the values unchanged.
+
+    Register scripts with KyotoTycoon.register_script() and call them by
+    name with play_script() and play_script_many().
+    """
+
+    def __init__(self, name, encode=None, decode=None, idempotent=False):
+        """
+        :param name: The name of the LUA function.
+
+        :param encode: Argument codec, callable returning records.
+
+        :param decode: Result codec, callable taking a list of records.
+
+        :param idempotent: If set to True, calls are retried on a fresh
+                           connection if the connection broke.
+        """
+        if not isinstance(name, bytes):
+            name = name.encode("UTF-8")
+        self.name       = name
+        self.name_size  = struct.pack('!I', len(name))
+        self.encode     = encode or _identity
+        self.decode     = decode or _identity
+        self.idempotent = idempotent
+
+    def request(self, recs, flags=0):
+        """Encode a call of the script with the records recs"""
+        return b''.join(self.parts(recs, flags))
+
+    def parts(self, recs, flags=0):
+        """Encode a call of the script as list of parts"""
+        request = [
+            struct.pack('!BI', MB_PLAY_SCRIPT, flags),
+            self.name_size,
+            None,
+            self.name,
+        ]
+
+        cnt = 0
+        for key, val in recs:
+            request.append(_SCRIPT_HEADER.pack(len(key), len(val)))
+            request.append(key)
+            request.append(val)
+            cnt += 1
+
+        request[2] = struct.pack('!I', cnt)
+        return request
+
+    def size(self, recs):
+        """Encoded size of a call"""
+        return HEADER_SIZE + 4 + len(self.name) + sum(
+            _script_size(rec) for rec in recs
+        )
+
+
+class SpaceSaving(object):
+    """Space-saving heavy hitters sketch.
+
+    Counts at most capacity keys. A new key replaces the key with the lowest
+    count and inherits its count, which is kept as the maximum error of the
+    estimate.
+    """
+
+    def __init__(self, capacity):
+        self.capacity = capacity
+        # key -> [count, error, bytes]
+        self.counts   = {}
+        # (count, key) min-heap, counts are corrected lazily on eviction
+        self.heap     = []
+
+    def add(self, key, nbytes=0):
+        """Count key and nbytes"""
+        counts = self.counts
+        entry = counts.get(key)
+        if entry is not None:
+            entry[0] += 1
+            entry[2] += nbytes
+            return
+        count = 0
+        if len(counts) >= self.capacity:
+            heap = self.heap
+            while True:
+                count, victim = heap[0]
+                current = counts[victim][0]
+                if current == count:
+                    break
+                heapq.heapreplace(heap, (current, victim))
+            heapq.heappop(heap)
+            del counts[victim]
+        counts[key] = [count + 1, count, nbytes]
+        heapq.heappush(self.heap, (count + 1, key))
+
+    def top(self, k):
+        """The k keys with the highest counts as list of (key, count, error,
+        bytes)"""
+        items = sorted(
+            self.counts.items(), key=lambda item: item[1][0], reverse=True
+        )
+        return [(key, e[0], e[1], e[2]) for key, e in items[:k]]
+
+
+HotKey = collections.namedtuple(
+    'HotKey', 'magic db key count rate bytes error'
+)
+
+
+class HotKeys(object):
+    """Samples the keys of set_bulk, get_bulk and remove_bulk into a
+    SpaceSaving sketch per opcode and database.
+
+    Only every sample_every-th record is looked at, so the cost on the
+    encode path is a slice of the records per request. The counts are
+    scaled back by sample_every.
+    """
+
+    def __init__(self, sample_every=16, capacity=64):
+        """
+        :param sample_every: Sample one of this many records.
+
+        :param capacity: Keys tracked per opcode and database.
+        """
+        self.sample_every = sample_every
+        self.capacity     = capacity
+        self.reset()
+
+    def reset(self):
+        """Drop all samples"""
+        self.sketches = {}
+        self.offset   = 0
+        self.started  = time.time()
+
+    def observe(self, magic, recs, db_index):
+        """Sample the records of a request.
+
+        :param magic: The opcode of the request.
+
+        :param recs: list of records, rec[0] is the key and rec[db_index]
+                     the database. Records of set_bulk (db_index 2) carry
+                     a value.
+        """
+        every = self.sample_every
+        offset = self.offset
+        cnt = len(recs)
+        self.offset = (offset - cnt) % every
+        sketches = self.sketches
+        for rec in recs[offset::every]:
+            ident = (magic, rec[db_index])
+            sketch = sketches.get(ident)
+            if sketch is None:
+                sketch = sketches[ident] = SpaceSaving(self.capacity)
+            nbytes = len(rec[0])
+            if db_index == 2:
+                nbytes += len(rec[1])
+            sketch.add(rec[0], nbytes)
+
+    def top(self, k=10, magic=None, db=None):
+        """The hottest keys with estimated rates.
+
+        :param k: Number of keys to return.
+
+        :param magic: Only keys of this opcode, for example MB_GET_BULK.
+
+        :param db: Only keys of this database.
+
+        :return: list of HotKey(magic, db, key, count, rate, bytes, error)
+                 ordered by count. count, bytes and error are estimates
+                 scaled by sample_every, rate is count per second.
+        """
+        every = self.sample_every
+        elapsed = max(time.time() - self.started, 1e-9)
+        res = []
+        for (op, op_db), sketch in self.sketches.items():
+            if magic is not None and op != magic:
+                continue
+            if db is not None and op_db != db:
+                continue
+            for key, count, error, nbytes in sketch.top(k):
+                res.append(HotKey(
+                    op,
+                    op_db,
+                    key,
+                    count * every,
+                    count * every / elapsed,
+                    nbytes * every,
+                    error * every,
+                ))
+        res.sort(key=lambda hot: hot.count, reverse=True)
+        return res[:k]
+
+
+class DiskCache(object):
+    """Persistent second-level cache of records in a dbm file.
+
+    KyotoTycoon(l2_cache=DiskCache(path)) answers get and get_bulk_keys from
+    the cache before asking the server and stores the fetched records.
+    set_bulk and remove_bulk through the client keep the cache coherent (a
+    get fetching meanwhile does not store the value it read), writes of
+    other clients are not seen: bound the staleness with max_age.
+    The expiration time of the records is honored and the cache survives
+    restarts of the process. It is bounded to max_bytes, the least recently
+    used records are evicted (after a restart in the order of storing).
+
+    The dbm file is accessed synchronously, keep it on a local disk. The
+    methods are serialized by a lock, the dbm modules are not thread-safe.
+    """
+
+    _ENTRY = struct.Struct('!dd')
+
+    def __init__(self, path, max_bytes=256 * 2 ** 20, max_age=None):
+        """
+        :param path: Path of the dbm file.
+
+        :param max_bytes: Size limit of the keys and values in bytes.
+
+        :param max_age: Seconds after which a record is fetched again even
+                        if it did not expire. None means no limit.
+        """
+        self.path      = path
+        self.max_bytes = max_bytes
+        self.max_age   = max_age
+        self.db        = dbm.open(path, 'c')
+        self.lru       = collections.OrderedDict()
+        self.size      = 0
+        self.hits      = 0
+        self.misses    = 0
+        self.evictions = 0
+        # Generation of the last write or discard of records while records
+        # are fetched, a fetch started before must not store its result
+        self.generation = 0
+        self.written    = {}
+        self.fetches    = collections.Counter()
+        self.lock       = threading.Lock()
+        self._load()
+
+    @staticmethod
+    def _key(key, db):
+        """Key of a record in the dbm file"""
+        return struct.pack('!H', db) + key
+
+    def _load(self):
+        """Index the records of the dbm file, dropping expired ones"""
+        now     = time.time()
+        entries = []
+        for name in list(self.db.keys()):
+            data = self.db[name]
+            expire, stored = self._ENTRY.unpack_from(data)
+            if self._expired(expire, stored, now):
+                del self.db[name]
+            else:
+                entries.append((stored, name, len(name) + len(data)))
+        for _, name, size in sorted(entries):
+            self.lru[name] = size
+            self.size += size
+        self._evict()
+
+    def _expired(self, expire, stored, now):
+        """Check if a record has to be fetched again"""
+        return expire <= now or (
+            self.max_age is not None and stored + self.max_age <= now
+        )
+
+    def _evict(self):
+        """Evict the least recently used records exceeding max_bytes"""
+        while self.size > self.max_bytes and self.lru:
+            name, size = self.lru.popitem(last=False)
+            del self.db[name]
+            self.size -= size
+            self.evictions += 1
+
+    def _written(self, name):
+        """Note a write or discard of a record for the fetches in flight"""
+        if self.fetches:
+            self.generation += 1
+            self.written[name] = self.generation
+
+    def _drop(self, name):
+        """Remove a record"""
+        size = self.lru.pop(name, None)
+        if size is not None:
+            del self.db[name]
+            self.size -= size
+
+    def lookup(self, recs):
+        """Split get_bulk records (key, db) into hits and misses.
+
+        :return: The hits as records (key, val, db, xt) and the missing
+                 records (key, db).
+        """
+        with self.lock:
+            now     = time.time()
+            hits    = []
+            missing = []
+            for key, db in recs:
+                name = self._key(key, db)
+                size = self.lru.pop(name, None)
+                if size is not None:
+                    data = self.db[name]
+                    expire, stored = self._ENTRY.unpack_from(data)
+                    if not self._expired(expire, stored, now):
+                        self.lru[name] = size
+                        hits.append((
+                            key,
+                            data[self._ENTRY.size:],
+                            db,
+                            int(min(expire, DEFAULT_EXPIRE)),
+                        ))
+                        continue
+                    del self.db[name]
+                    self.size -= size
+                missing.append((key, db))
+            self.hits   += len(hits)
+            self.misses += len(missing)
+            return hits, missing
+
+    def begin(self):
+        """Start fetching missed records from the server.
+
+        :return: The generation to pass to store and end.
+        """
+        with self.lock:
+            self.fetches[self.generation] += 1
+            return self.generation
+
+    def end(self, generation):
+        """Finish a fetch started with begin"""
+        with self.lock:
+            self.fetches[generation] -= 1
+            if not self.fetches[generation]:
+                del self.fetches[generation]
+            if not self.fetches:
+                self.written.clear()
+
+    def store(self, recs, relative=False, since=None):
+        """Store records (key, val, db, xt). xt is the absolute expiration
+        time returned by get_bulk, or if relative is True the expiration
+        time given to set_bulk: seconds from now, or if negative the
+        absolute time.
+
+        since is the generation returned by begin for fetched records,
+        records written or discarded after it are skipped."""
+        with self.lock:
+            now = time.time()
+            for key, val, db, xt in recs:
+                if relative:
+                    expire = -xt if xt < 0 else now + xt
+                else:
+                    expire = xt
+                name = self._key(key, db)
+                if since is None:
+                    self._written(name)
+                elif self.written.get(name, since) > since:
+                    continue
+                self._drop(name)
+                size = len(name) + self._ENTRY.size + len(val)
+                if expire <= now or size > self.max_bytes:
+                    continue
+                self.db[name] = self._ENTRY.pack(expire, now) + val
+                self.lru[name] = size
+                self.size += size
+            self._evict()
+
+    def discard(self, recs):
+        """Remove records (key, db)"""
+        with self.lock:
+            for key, db in recs:
+                name = self._key(key, db)
+                self._written(name)
+                self._drop(name)
+
+    def stats(self):
+        """Metrics of the cache"""
+        with self.lock:
+            return {
+                'records': len(self.lru),
+                'size': self.size,
+                'max_bytes': self.max_bytes,
+                'hits': self.hits,
+                'misses': self.misses,
+                'evictions': self.evictions,
+            }
+
+    def sync(self):
+        """Write the dbm file to disk"""
+        with self.lock:
+            sync = getattr(self.db, 'sync', None)
+            if sync is not None:
+                sync()
+
+    def close(self):
+        """Close the dbm file"""
+        with self.lock:
+            self.db.close()
+
+
+class Migrator(object):
+    """Copies records from a source to destination servers, for example to
+    add capacity.
+
+    The keys are read in batches by parallel get_bulk calls and written with
+    set_bulk calls of at most chunk_bytes, keeping the expiration time of
+    each record. Without shard every destination gets all records, else
+    shard(key) returns the index of the destination of a key. The copy is
+    throttled to max_records_rate and max_bytes_rate.
+
+    With a checkpoint file the number of keys copied is saved as the
+    batches complete, calling migrate() again with the same keys in the
+    same order resumes after them. The records and bytes are counted up to
+    that offset, batches completed after a missing one are copied again.
+    Keys are sampled during the copy at sample_rate, verify() compares them
+    between source and destinations.
+    """
+
+    def __init__(
+            self,
+            source,
+            destinations,
+            shard=None,
+            db=0,
+            batch=1000,
+            parallel=4,
+            chunk_bytes=4 * 2 ** 20,
+            max_records_rate=None,
+            max_bytes_rate=None,
+            checkpoint=None,
+            sample_rate=0.001,
+            priority=PRIORITY_BATCH,
+    ):
+        """
+        :param source: KyotoTycoon to read from.
+
+        :param destinations: List of KyotoTycoon to write to.
+
+        :param shard: Callable returning the index of the destination of a
+                      key. None copies all records to every destination.
+
+        :param db: Database index of the records.
+
+        :param batch: Keys per get_bulk call.
+
+        :param parallel: Number of concurrent batches.
+
+        :param chunk_bytes: Maximum encoded size of a set_bulk call.
+
+        :param max_records_rate: Limit of records per second, None means no
+                                 limit.
+
+        :param max_bytes_rate: Limit of encoded bytes per second, None means
+                               no limit.
+
+        :param checkpoint: Path of the checkpoint file, None disables
+                           checkpoints.
+
+        :param sample_rate: Fraction of the keys sampled for verify().
+
+        :param priority: Traffic class (lane) of the requests.
+        """
+        self.source           = source
+        self.destinations     = list(destinations)
+        self.shard            = shard
+        self.db               = db
+        self.batch            = batch
+        self.parallel         = parallel
+        self.chunk_bytes      = chunk_bytes
+        self.max_records_rate = max_records_rate
+        self.max_bytes_rate   = max_bytes_rate
+        self.checkpoint       = checkpoint
+        self.sample_rate      = sample_rate
+        self.priority         = priority
+        self.sample           = []
+        self.offset           = 0
+        self.records          = 0
+        self.bytes            = 0
+        self.completed        = {}
+        self.started          = None
+        self.throttled        = [0, 0]
+
+    def _load_checkpoint(self):
+        """Restore the progress of the checkpoint file"""
+        if self.checkpoint is None or not os.path.exists(self.checkpoint):
+            return
+        with open(self.checkpoint) as state_file:
+            state = json.load(state_file)
+        self.offset  = state['offset']
+        self.records = state['records']
+        self.bytes   = state['bytes']
+
+    def _save_checkpoint(self):
+        """Atomically write the progress to the checkpoint file"""
+        if self.checkpoint is None:
+            return
+        tmp = self.checkpoint + ".tmp"
+        with open(tmp, "w") as state_file:
+            json.dump({
+                'offset': self.offset,
+                'records': self.records,
+                'bytes': self.bytes,
+            }, state_file)
+        os.rename(tmp, self.checkpoint)
+
+    def _done(self, start, count, records, size):
+        """Account a copied batch of count keys, records and size bytes. The
+        checkpoint advances over the contiguous completed batches"""
+        self.completed[start] = (count, records, size)
+        advanced = False
+        while self.offset in self.completed:
+            count, records, size = self.completed.pop(self.offset)
+            self.offset  += count
+            self.records += records
+            self.bytes   += size
+            advanced = True
+        if advanced:
+            self._save_checkpoint()
+
+    async def _throttle(self, records, size):
+        """Wait until the rate limits allow records and size more"""
+        self.throttled[0] += records
+        self.throttled[1] += size
+        delay   = 0
+        elapsed = self.source.loop.time() - self.started
+        if self.max_records_rate:
+            delay = self.throttled[0] / float(self.max_records_rate) - elapsed
+        if self.max_bytes_rate:
+            delay = max(
+                delay,
+                self.throttled[1] / float(self.max_bytes_rate) - elapsed
+            )
+        if delay > 0:
+            await asyncio.sleep(delay)
+            # pypy #yield From(asyncio.sleep(delay))
+
+    async def _copy(self, keys):
+        """Copy the records of keys, returns the number of records and
+        their encoded size"""
+        recs = await self.source.get_bulk(
+        # pypy #recs = yield From(self.source.get_bulk(
+            [(key, self.db) for key in keys], priority=self.priority
+        )
+        # pypy #))
+        groups = collections.defaultdict(list)
+        size   = 0
+        for key, val, db, xt in recs:
+            # get_bulk returns the absolute expiration time, set_bulk takes
+            # it negated
+            rec = (key, val, db, xt if xt >= DEFAULT_EXPIRE else -xt)
+            size += _set_size(rec)
+            if self.shard is None:
+                for index in range(len(self.destinations)):
+                    groups[index].append(rec)
+            else:
+                groups[self.shard(key)].append(rec)
+            if random.random() < self.sample_rate:
+                self.sample.append(key)
+        await self._throttle(len(recs), size)
+        # pypy #yield From(self._throttle(len(recs), size))
+        writes = []
+        for index, group in groups.items():
+            chunk      = []
+            chunk_size = 0
+            for rec in group:
+                rec_size = _set_size(rec)
+                if chunk and chunk_size + rec_size > self.chunk_bytes:
+                    writes.append((index, chunk))
+                    chunk      = []
+                    chunk_size = 0
+                chunk.append(rec)
+                chunk_size += rec_size
+            if chunk:
+                writes.append((index, chunk))
+        await asyncio.gather(*[
+        # pypy #yield From(asyncio.gather(*[
+            self.destinations[index].set_bulk(
+                chunk, idempotent=True, priority=self.priority
+            ) for index, chunk in writes
+        ])
+        # pypy #]))
+        return len(recs), size
+        # pypy #raise Return((len(recs), size))
+
+    def _batches(self, keys, start):
+        """Split keys into batches, yields (offset, batch)"""
+        while True:
+            batch = list(itertools.islice(keys, self.batch))
+            if not batch:
+                return
+            yield start, batch
+            start += len(batch)
+
+    async def migrate(self, keys):
+        """Copy the records of keys, resuming after the checkpoint.
+
+        :param keys: Iterable of the keys to copy, in the same order when
+                     resuming.
+
+        :return: The stats() of the migration.
+        """
+        self._load_checkpoint()
+        self.completed = {}
+        self.started   = self.source.loop.time()
+        self.throttled = [0, 0]
+        batches = self._batches(
+            itertools.islice(keys, self.offset, None), self.offset
+        )
+
+        async def worker():
+            """Copy batches until all are taken"""
+            for start, batch in batches:
+                records, size = await self._copy(batch)
+                # pypy #records, size = yield From(self._copy(batch))
+                self._done(start, len(batch), records, size)
+
+        loop = self.source.loop
+        tasks = [loop.create_task(worker()) for _ in range(self.parallel)]
+        try:
+            await asyncio.gather(*tasks)
+            # pypy #yield From(asyncio.gather(*tasks))
+        except BaseException:
+            # Stop the other workers, nothing is copied after migrate failed
+            for task in tasks:
+                task.cancel()
+            await asyncio.wait(tasks)
+            # pypy #yield From(asyncio.wait(tasks))
+            raise
+        self._save_checkpoint()
+        return self.stats()
+        # pypy #raise Return(self.stats())
+
+    async def verify(self, keys=None):
+        """Compare the value and the expiration time of the sampled keys
+        between the source and the destinations. Records changed by other
+        clients during the copy also differ.
+
+        :param keys: The keys to compare, defaults to the sampled keys.
+
+        :return: A list of (destination index, key) of the differing
+                 records.
+        """
+        keys = list(self.sample if keys is None else keys)
+        if not keys:
+            return []
+            # pypy #raise Return([])
+        recs = await self.source.get_bulk(
+        # pypy #recs = yield From(self.source.get_bulk(
+            [(key, self.db) for key in keys], priority=self.priority
+        )
+        # pypy #))
+        expected = dict((key, (val, xt)) for key, val, _, xt in recs)
+        differing = []
+        for index, dest in enumerate(self.destinations):
+            selected = [
+                key for key in keys
+                if self.shard is None or self.shard(key) == index
+            ]
+            if not selected:
+                continue
+            recs = await dest.get_bulk(
+            # pypy #recs = yield From(dest.get_bulk(
+                [(key, self.db) for key in selected], priority=self.priority
+            )
+            # pypy #))
+            found = dict((key, (val, xt)) for key, val, _, xt in recs)
+            for key in selected:
+                if found.get(key) != expected.get(key):
+                    differing.append((index, key))
+        return differing
+        # pypy #raise Return(differing)
+
+    def stats(self):
+        """Progress of the migration"""
+        return {
+            'offset': self.offset,
+            'records': self.records,
+            'bytes': self.bytes,
+            'sampled': len(self.sample),
+        }
+
+
+TrafficEntry = collections.namedtuple(
+    'TrafficEntry',
+    ('timestamp', 'latency', 'response_size', 'request'),
+)
+
+Replayed = collections.namedtuple(
+    'Replayed',
+    (
+        'timestamp',
+        'magic',
+        'recorded_latency',
+        'latency',
+        'recorded_size',
+        'size',
+        'error',
+    ),
+)
+
+
+class TrafficRecorder(object):
+    """Appends the requests of a client to a compact binary log.
+
+    Each entry holds the start time, the latency, the size of the response
+    and the request as sent, which contains the opcode, the flags and the
+    records of each frame. The log is rotated like a RotatingFileHandler:
+    when it would exceed max_bytes it is renamed to path.1, path.1 to
+    path.2 and so on, keeping at most backups old logs.
+
+    The requests are queued and written by a background thread, so the
+    event loop never waits for the file. Requests are dropped (and counted
+    in dropped) while more than max_pending bytes are queued.
+
+    Read the log with read_traffic() and replay it with replay_traffic().
+    """
+
+    def __init__(
+            self,
+            path,
+            max_bytes=64 * 2 ** 20,
+            backups=3,
+            max_pending=16 * 2 ** 20,
+    ):
+        """
+        :param path: Path of the log.
+
+        :param max_bytes: Size of the log at which it is rotated.
+
+        :param backups: Number of rotated logs to keep.
+
+        :param max_pending: Bytes of queued requests from which requests
+                            are dropped.
+        """
+        self.path          = path
+        self.max_bytes     = max_bytes
+        self.backups       = backups
+        self.max_pending   = max_pending
+        self.out           = None
+        self.size          = 0
+        self.entries       = 0
+        self.dropped       = 0
+        self.lock          = threading.Lock()
+        self.cond          = threading.Condition()
+        self.pending       = []
+        self.pending_bytes = 0
+        self.writing       = False
+        self.closing       = False
+        self._thread       = None
+
+    def _open(self):
+        """Open the log for appending"""
+        self.out  = open(self.path, "ab")
+        self.size = os.fstat(self.out.fileno()).st_size
+        if not self.size:
+            self.out.write(TRAFFIC_MAGIC)
+            self.size = len(TRAFFIC_MAGIC)
+
+    def record(self, timestamp, latency, response_size, request):
+        """Queue a request for the log"""
+        size = _TRAFFIC.size + len(request)
+        with self.cond:
+            if self.pending_bytes + size > self.max_pending:
+                self.dropped += 1
+                return
+            self.pending.append((timestamp, latency, response_size, request))
+            self.pending_bytes += size
+            self.closing = False
+            if self._thread is None:
+                self._thread = threading.Thread(target=self._write_pending)
+                self._thread.daemon = True
+                self._thread.start()
+            self.cond.notify_all()
+
+    def _write_pending(self):
+        """Background thread writing the queued requests until close"""
+        while True:
+            with self.cond:
+                while not self.pending and not self.closing:
+                    self.cond.wait()
+                if not self.pending:
+                    self._thread = None
+                    return
+                pending, self.pending = self.pending, []
+                self.pending_bytes = 0
+                self.writing = True
+            try:
+                with self.lock:
+                    for entry in pending:
+                        self._write(*entry)
+            except Exception:
+                _l().exception("Writing the traffic log failed")
+            finally:
+                with self.cond:
+                    self.writing = False
+                    self.cond.notify_all()
+
+    def _write(self, timestamp, latency, response_size, request):
+        """Append a request to the log holding the lock"""
+        if self.out is None:
+            self._open()
+        size = _TRAFFIC.size + len(request)
+        if self.size + size > self.max_bytes and (
+                self.size > len(TRAFFIC_MAGIC)
+        ):
+            self._rotate()
+        self.out.write(_TRAFFIC.pack(
+            timestamp, latency, response_size, len(request)
+        ))
+        self.out.write(request)
+        self.size    += size
+        self.entries += 1
+
+    def _wait_written(self):
+        """Wait until the queued requests are written"""
+        with self.cond:
+            while self.pending or self.writing:
+                self.cond.wait()
+
+    def rotate(self):
+        """Start a new log, keeping backups old logs"""
+        self._wait_written()
+        with self.lock:
+            self._rotate()
+
+    def _rotate(self):
+        """rotate holding the lock"""
+        self._close()
+        if self.backups:
+            for index in range(self.backups - 1, 0, -1):
+                old = "%s.%d" % (self.path, index)
+                if os.path.exists(old):
+                    os.rename(old, "%s.%d" % (self.path, index + 1))
+            os.rename(self.path, "%s.1" % self.path)
+        else:
+            os.remove(self.path)
+        self._open()
+
+    def flush(self):
+        """Write the queued requests and flush the log to the file"""
+        self._wait_written()
+        with self.lock:
+            if self.out is not None:
+                self.out.flush()
+
+    def close(self):
+        """Write the queued requests, stop the thread and close the log,
+        recording reopens it"""
+        with self.cond:
+            self.closing = True
+            self.cond.notify_all()
+        self._wait_written()
+        with self.lock:
+            self._close()
+
+    def _close(self):
+        """close holding the lock"""
+        if self.out is not None:
+            self.out.close()
+            self.out = None
+
+
+SlowRequest = collections.namedtuple(
+    'SlowRequest',
+    (
+        'timestamp',
+        'magic',
+        'records',
+        'request_size',
+        'response_size',
+        'pool_wait',
+        'connect',
+        'connection_age',
+        'write',
+        'read',
+        'latency',
+        'error',
+    ),
+)
+
+
+class FlightRecorder(object):
+    """Keeps the last requests slower than a threshold in a ring buffer.
+
+    Each SlowRequest holds the opcode and record count of the (first) frame,
+    the request and response sizes and the phases in seconds: waiting for a
+    connection slot (pool_wait), connecting if no pooled connection was free
+    (connect), writing and reading the reply. connection_age is the age of
+    the connection when it was taken. error is the repr of the exception of
+    failed requests, which are kept whatever their latency, including
+    requests that could not connect.
+
+    Fast requests only cost a few clock reads, so it can be left on.
+    """
+
+    def __init__(self, threshold=0.1, size=256):
+        """
+        :param threshold: Latency in seconds from which requests are kept.
+
+        :param size: Number of slow requests kept.
+        """
+        self.threshold = threshold
+        self.ring      = collections.deque(maxlen=size)
+        self.slow      = 0
+
+    def observe(self, start, phases, request, response_size, error=None):
+        """Keep the request if it was slow, phases are the times set by
+        KyotoTycoon._execute"""
+        end = time.time()
+        if error is None and end - start < self.threshold:
+            return
+        acquired = phases.get('acquired', end)
+        connected = phases.get('connected', acquired)
+        written = phases.get('written', end)
+        magic, _, records = struct.unpack_from('!BII', request)
+        if magic == MB_PLAY_SCRIPT:
+            records, = _COUNT.unpack_from(request, 9)
+        self.slow += 1
+        self.ring.append(SlowRequest(
+            start,
+            magic,
+            records,
+            len(request),
+            response_size,
+            acquired - start,
+            connected - acquired,
+            acquired - phases.get('created', acquired),
+            max(written - connected, 0.0),
+            max(end - written, 0.0),
+            end - start,
+            None if error is None else repr(error),
+        ))
+
+    def entries(self):
+        """The slow requests kept, oldest first"""
+        return list(self.ring)
+
+    def dump(self, out):
+        """Write the slow requests as JSON lines to the file object out
+
+        :return: Number of requests written.
+        """
+        entries = self.entries()
+        for entry in entries:
+            out.write(json.dumps(entry._asdict(), sort_keys=True))
+            out.write("\n")
+        out.flush()
+        return len(entries)
+
+    def install_signal(self, signum=None, path=None):
+        """Dump the slow requests when the process receives signum (SIGUSR1
+        by default), appending to path or logging them if path is None.
+        Has to be called from the main thread.
+
+        :return: The previous signal handler.
+        """
+        if signum is None:
+            signum = signal.SIGUSR1
+
+        def handler(signum, frame):
+            """Dump the ring"""
+            if path is None:
+                for entry in self.entries():
+                    _l().warning("Slow request: %r", entry)
+            else:
+                with open(path, "a") as out:
+                    self.dump(out)
+
+        return signal.signal(signum, handler)
+
+
+class _CountingReader(object):
+    """StreamReader proxy counting the bytes read, reading more than limit
+    bytes fails"""
+
+    def __init__(self, sr):
+        self.sr    = sr
+        self.count = 0
+        self.limit = None
+
+    async def readexactly(self, n):
+        """Read exactly n bytes"""
+        if self.limit is not None and self.count + n > self.limit:
+            raise KyotoTycoonError("Reply too large to drain")
+        data = await self.sr.readexactly(n)
+        # pypy #data = yield From(self.sr.readexactly(n))
+        self.count += len(data)
+        return data
+        # pypy #raise Return(data)
+
+    async def read(self, n):
+        """Read up to n bytes"""
+        if self.limit is not None and self.count + n > self.limit:
+            n = self.limit - self.count
+            if n <= 0:
+                raise KyotoTycoonError("Reply too large to drain")
+        data = await self.sr.read(n)
+        # pypy #data = yield From(self.sr.read(n))
+        self.count += len(data)
+        return data
+        # pypy #raise Return(data)
+
+
+class _DrainLimit(object):
+    """Limits the bytes a cancelled request may still read from its
+    StreamReader. The limit is installed as instance attributes of the
+    reader, so requests that are not cancelled read it without a proxy."""
+
+    def __init__(self, sr, limit):
+        self.left         = limit
+        self._readexactly = sr.readexactly
+        self._read        = sr.read
+        sr.readexactly    = self.readexactly
+        sr.read           = self.read
+
+    @staticmethod
+    def remove(sr):
+        """Remove the limit of sr if there is one"""
+        attrs = vars(sr)
+        if 'readexactly' in attrs:
+            del attrs['readexactly']
+            del attrs['read']
+
+    def readexactly(self, n):
+        """Read exactly n bytes"""
+        if n > self.left:
+            raise KyotoTycoonError("Reply too large to drain")
+        self.left -= n
+        return self._readexactly(n)
+
+    async def read(self, n):
+        """Read up to n bytes, at most the bytes left"""
+        if self.left <= 0:
+            raise KyotoTycoonError("Reply too large to drain")
+        data = await self._read(min(n, self.left))
+        # pypy #data = yield From(self._read(min(n, self.left)))
+        self.left -= len(data)
+        return data
+        # pypy #raise Return(data)
+
+
+class _ResponseCharge(object):
+    """Read coroutine for _execute charging the bytes of a get_bulk reply
+    beyond the expected size to the ByteBudget while they are received, so
+    large replies hold back further requests"""
+
+    def __init__(self, budget, expected, read):
+        self.budget   = budget
+        self.expected = expected
+        self.read     = read
+        self.charged  = 0
+        self.released = False
+
+    def __call__(self, sr, magic):
+        return self.read(_ChargingReader(sr, self), magic)
+
+    def add(self, size):
+        """Charge size bytes, unless the request is over (a reply drained
+        after a cancel)"""
+        if not self.released:
+            self.budget.charge(size)
+            self.charged += size
+
+    def give_back(self, size):
+        """Release up to size charged bytes, returns the released bytes"""
+        size = min(size, self.charged)
+        if size:
+            self.budget.release(size)
+            self.charged -= size
+        return size
+
+    def release(self):
+        """Release all charged bytes"""
+        self.released = True
+        self.give_back(self.charged)
+
+
+class _ChargingReader(object):
+    """StreamReader proxy charging the bytes beyond the expected size of a
+    reply to its _ResponseCharge before reading them"""
+
+    def __init__(self, sr, charge):
+        self.sr     = sr
+        self.charge = charge
+        self.left   = charge.expected
+
+    def _take(self, n):
+        """Account n bytes about to be read"""
+        self.left -= n
+        if self.left < 0:
+            self.charge.add(-self.left)
+            self.left = 0
+
+    def _give(self, n):
+        """Account n bytes taken but not read"""
+        self.left += n - self.charge.give_back(n)
+
+    async def readexactly(self, n):
+        """Read exactly n bytes"""
+        self._take(n)
+        return (await self.sr.readexactly(n))
+        # pypy #raise Return((yield From(self.sr.readexactly(n))))
+
+    async def read(self, n):
+        """Read up to n bytes"""
+        self._take(n)
+        data = await self.sr.read(n)
+        # pypy #data = yield From(self.sr.read(n))
+        self._give(n - len(data))
+        return data
+        # pypy #raise Return(data)
+
+
+class _Counters(object):
+    """Merges the increments of counters over a short window and applies
+    them with one call of the incr procedure (see LUA_PROCEDURES).
+
+    Each caller gets the value of the counter after its own increment, as if
+    the increments of the window were applied one by one in call order.
+    """
+
+    def __init__(self, client, loop, window, batch):
+        self.client  = client
+        self.loop    = loop
+        self.window  = window
+        self.batch   = batch
+        self.pending = collections.OrderedDict()
+        self.handle  = None
+        # Applies in flight and their increments
+        self.tasks   = {}
+
+    def add(self, key, delta):
+        """Queue an increment, returns a future of the new value"""
+        entry = self.pending.get(key)
+        if entry is None:
+            entry = self.pending[key] = [0, []]
+        entry[0] += delta
+        fut = asyncio.Future()
+        entry[1].append((entry[0], fut))
+        if len(self.pending) >= self.batch:
+            self.flush()
+        elif self.handle is None:
+            self.handle = self.loop.call_later(
+                self.window, self.flush
+            )
+        return fut
+
+    def flush(self):
+        """Apply the pending increments"""
+        if self.handle is not None:
+            self.handle.cancel()
+            self.handle = None
+        if self.pending:
+            pending, self.pending = self.pending, collections.OrderedDict()
+            task = self.loop.create_task(self._apply(pending))
+            self.tasks[task] = pending
+            task.add_done_callback(self._done)
+
+    def _done(self, task):
+        """Cancel the callers of an apply cancelled before it resolved
+        them, e.g. before it started"""
+        pending = self.tasks.pop(task)
+        if task.cancelled():
+            for _, callers in pending.values():
+                for _, fut in callers:
+                    fut.cancel()
+
+    def close(self):
+        """Cancel the pending increments and the calls in flight"""
+        if self.handle is not None:
+            self.handle.cancel()
+            self.handle = None
+        pending, self.pending = self.pending, collections.OrderedDict()
+        for _, callers in pending.values():
+            for _, fut in callers:
+                fut.cancel()
+        for task in list(self.tasks):
+            task.cancel()
+
+    async def _apply(self, pending):
+        """Call the incr procedure and resolve the futures"""
+        if self.client.l2_cache is not None:
+            self.client.l2_cache.discard((key, 0) for key in pending)
+        try:
+            res = await self.client.play_script(
+            # pypy #res = yield From(self.client.play_script(
+                b"incr",
+                [
+                    (key, str(total).encode("ascii"))
+                    for key, (total, _) in pending.items()
+                ],
+            )
+            # pypy #))
+            values = dict(res)
+            if len(values) != len(pending):
+                raise KyotoTycoonError("Counters missing in the reply")
+        except BaseException as exc:
+            cancelled = isinstance(exc, asyncio.CancelledError)
+            for _, callers in pending.values():
+                for _, fut in callers:
+                    if fut.done():
+                        continue
+                    if cancelled:
+                        fut.cancel()
+                    else:
+                        fut.set_exception(exc)
+            if cancelled or not isinstance(exc, Exception):
+                raise
+            return
+        for key, (total, callers) in pending.items():
+            base = int(values[key]) - total
+            for delta, fut in callers:
+                if not fut.done():
+                    fut.set_result(base + delta)
+
+
+def _scan_args(prefix, db, batch, values, ordered):
+    """Arguments of the scan procedure"""
+    args = [
+        (b"db", str(db).encode("ascii")),
+        (b"limit", str(batch).encode("ascii")),
+    ]
+    if prefix:
+        args.append((b"prefix", prefix))
+    if values:
+        args.append((b"values", b"1"))
+    if ordered:
+        args.append((b"ordered", b"1"))
+    return args
+
+
+def _scan_error(cursor, exc):
+    """Error of a scan call continuing after cursor"""
+    return KyotoTycoonError(
+        "Scan cannot continue after %r, the key was probably removed: %s" % (
+            cursor, exc
+        )
+    )
+
+
+def _scan_batch(res, values):
+    """Batch and cursor from the result of the scan procedure"""
+    res = dict(res)
+    batch = []
+    for index in range(1, len(res) + 1):
+        key = res.get(("k%d" % index).encode("ascii"))
+        if key is None:
+            break
+        if values:
+            batch.append((key, res[("v%d" % index).encode("ascii")]))
+        else:
+            batch.append(key)
+    return batch, res.get(b"cursor")
+
+
+class Scan(object):
+    """Iterates over the keys of a database using the scan procedure of
+    LUA_PROCEDURES, see KyotoTycoon.scan.
+
+    Use it as async iterator (Python 3.5+) or call next_batch() until it
+    returns an empty list. The next batch is fetched while the current one is
+    processed.
+    """
+
+    def __init__(self, client, prefix, db, batch, values, ordered, priority):
+        self.client   = client
+        self.values   = values
+        self.priority = priority
+        self.args     = _scan_args(prefix, db, batch, values, ordered)
+        self.pending  = None
+        self.done     = False
+        self.items    = collections.deque()
+
+    async def _fetch(self, cursor):
+        """Fetch the batch after cursor, returns (batch, next cursor)"""
+        args = list(self.args)
+        if cursor is not None:
+            args.append((b"cursor", cursor))
+        try:
+            res = await self.client.play_script(
+            # pypy #res = yield From(self.client.play_script(
+                "scan", args, idempotent=True, priority=self.priority
+            )
+            # pypy #))
+        except KyotoTycoonError as exc:
+            if cursor is None:
+                raise
+            raise _scan_error(cursor, exc)
+        return _scan_batch(res, self.values)
+        # pypy #raise Return(_scan_batch(res, self.values))
+
+    async def next_batch(self):
+        """The next batch of keys, or (key, value) tuples if values is set.
+        An empty list if the scan is done."""
+        while not self.done:
+            if self.pending is None:
+                fetch = self._fetch(None)
+            else:
+                fetch = self.pending
+                self.pending = None
+            batch, cursor = await fetch
+            # pypy #batch, cursor = yield From(fetch)
+            if cursor is None:
+                self.done = True
+            else:
+                self.pending = _current_loop().create_task(
+                    self._fetch(cursor)
+                )
+            if batch:
+                return batch
+                # pypy #raise Return(batch)
+        return []
+        # pypy #raise Return([])
+
+    def __aiter__(self):
+        return self
+
+    async def __anext__(self):
+        if not self.items:
+            self.items.extend((await self.next_batch()))
+            # pypy #self.items.extend((yield From(self.next_batch())))
+            if not self.items:
+                raise StopAsyncIteration  # noqa
+        return self.items.popleft()
+        # pypy #raise Return(self.items.popleft())
+
+    def close(self):
+        """Stop the scan, cancelling the prefetch"""
+        self.done = True
+        if self.pending is not None:
+            self.pending.cancel()
+            self.pending = None
+
+
+class Hedging(object):
+    """Hedged reads against a replica to cut tail latency.
+
+    If a get_bulk of the client has not completed after delay seconds, the
+    same request is sent to the replica and the first answer is used. The
+    other request is cancelled, its reply is drained in the background to
+    keep the connection (see KyotoTycoon drain_bytes). Without a fixed
+    delay the percentile of the recent read latencies is used, hedging
+    starts once enough latencies are known. At most budget hedged requests
+    per read are sent, so the load cannot double.
+    """
+
+    def __init__(
+            self,
+            replica,
+            delay=None,
+            percentile=95,
+            budget=0.05,
+            window=1000,
+            min_samples=100,
+    ):
+        """
+        :param replica: KyotoTycoon connected to a replica of the server.
+
+        :param delay: Seconds before the hedged request is sent, None learns
+                      the delay from the latencies.
+
+        :param percentile: Percentile of the latencies used as delay.
+
+        :param budget: Maximum fraction of the reads which are hedged.
+
+        :param window: Number of recent latencies kept.
+
+        :param min_samples: Latencies needed before the delay is learned.
+        """
+        self.replica     = replica
+        self.delay       = delay
+        self.percentile  = percentile
+        self.budget      = budget
+        self.min_samples = min_samples
+        self.latencies   = collections.deque(maxlen=window)
+        self.learned     = None
+        self.reads       = 0
+        self.hedges      = 0
+        self.wins        = 0
+
+    def current_delay(self):
+        """The hedging delay, None if it is not known yet"""
+        if self.delay is not None:
+            return self.delay
+        return self.learned
+
+    def observe(self, latency):
+        """Account the latency of a read"""
+        self.latencies.append(latency)
+        if len(self.latencies) >= self.min_samples and (
+                self.learned is None or self.reads % self.min_samples == 0
+        ):
+            self.learned = _percentile(self.latencies, self.percentile)
+
+    def may_hedge(self):
+        """Check the hedge budget"""
+        return self.hedges < self.budget * self.reads
+
+    async def execute(
+            self,
+            client,
+            request,
+            magic,
+            read,
+            flags=0,
+            idempotent=True,
+            priority=None,
+    ):
+        """KyotoTycoon._execute with hedging.
+
+        The delay is learned from the latency of the requests to the client
+        only, never from the replica. A request to the client that lost
+        against the replica is cancelled, the time until then is a lower
+        bound of its latency and above the current delay. Without a delay
+        or budget the request is executed directly, without a task."""
+        self.reads += 1
+        loop   = client.loop
+        start  = loop.time()
+        delay  = self.current_delay()
+        if delay is None or not self.may_hedge():
+            res = await client._execute(
+            # pypy #res = yield From(client._execute(
+                request, magic, read, flags, idempotent, priority
+            )
+            # pypy #))
+            self.observe(loop.time() - start)
+            return res
+            # pypy #raise Return(res)
+        winner  = None
+        primary = loop.create_task(client._execute(
+            request, magic, read, flags, idempotent, priority
+        ))
+        tasks   = [primary]
+        try:
+            await asyncio.wait(tasks, timeout=delay)
+            # pypy #yield From(asyncio.wait(tasks, timeout=delay))
+            if not primary.done() and self.may_hedge():
+                self.hedges += 1
+                tasks.append(loop.create_task(self.replica._execute(
+                    request, magic, read, flags, idempotent, priority
+                )))
+            pending = list(tasks)
+            while True:
+                done, pending = await asyncio.wait(
+                # pypy #done, pending = yield From(asyncio.wait(
+                    pending, return_when=asyncio.FIRST_COMPLETED
+                )
+                # pypy #))
+                winners = [task for task in done if task.exception() is None]
+                if winners:
+                    break
+                if not pending:
+                    # All failed, raise the error of the first request
+                    primary.result()
+            winner = winners[0]
+            if winner is not primary:
+                self.wins += 1
+            if not primary.done() or primary.exception() is None:
+                self.observe(loop.time() - start)
+            return winner.result()
+            # pypy #raise Return(winner.result())
+        finally:
+            # The loser drains the reply in the background or closes its
+            # connection when it is cancelled (see KyotoTycoon drain_bytes),
+            # the reply of a loser that completed too is released
+            for task in tasks:
+                if not task.done():
+                    task.cancel()
+                elif task is not winner and not task.cancelled() and (
+                        task.exception() is None
+                ):
+                    _discard_reply(task.result())
+
+    def stats(self):
+        """Metrics of the hedging"""
+        return {
+            'reads': self.reads,
+            'hedges': self.hedges,
+            'wins': self.wins,
+            'delay': self.current_delay(),
+        }
+
+
+class _LoopState(object):
+    """Connection pool and limits of a KyotoTycoon on one event loop"""
+
+    def __init__(self, client, loop):
+        self.loop         = loop
+        self.free_streams = []
+        self.lanes        = _Lanes(client.max_connections, client.lane_config)
+        self.byte_budget  = ByteBudget(client.inflight_limit)
+        self.counters     = _Counters(
+            client, loop, client.counter_window, client.counter_batch
+        )
+
+
+class _Client(object):
+    """Script registry and frame splitting shared by KyotoTycoon and
+    SyncKyotoTycoon"""
+
+    def register_script(
+            self,
+            name,
+            encode=None,
+            decode=None,
+            idempotent=False,
+    ):
+        """Predeclare a procedure of the LUA extension, see Script.
+
+        :param name: The name of the LUA function.
+
+        :param encode: Argument codec, callable returning records.
+
+        :param decode: Result codec, callable taking a list of records.
+
+        :param idempotent: If set to True, calls are retried on a fresh
+                           connection if the connection broke.
+
+        :rtype: Script
+        """
+        script = Script(name, encode, decode, idempotent)
+        self.scripts[script.name] = script
+        return script
+
+    def _script(self, name):
+        """Get the registered Script or a Script without codecs"""
+        if isinstance(name, Script):
+            return name
+        if not isinstance(name, bytes):
+            name = name.encode("UTF-8")
+        script = self.scripts.get(name)
+        if script is None:
+            script = Script(name)
+        return script
+
+    def _split(self, recs, size):
+        """Split records into frames of at most max_frame_records records
+        and max_frame_bytes bytes. size(rec) returns the encoded size of a
+        record.
+
+        :return: List of frames (lists of records) or None if splitting is
+                 disabled.
+        """
+        max_recs  = self.max_frame_records
+        max_bytes = self.max_frame_bytes
+        if max_recs is None and max_bytes is None:
+            return None
+        max_recs  = max_recs or sys.maxsize
+        max_bytes = max_bytes or sys.maxsize
+        frames     = []
+        frame      = []
+        frame_size = 0
+        for rec in recs:
+            rec_size = size(rec)
+            if frame and (
+                    len(frame) >= max_recs or
+                    frame_size + rec_size > max_bytes
+            ):
+                frames.append(frame)
+                frame      = []
+                frame_size = 0
+            frame.append(rec)
+            frame_size += rec_size
+        frames.append(frame)
+        return frames
+
+
+class KyotoTycoon(_Client):
+    """New connections are created using the constructor. A connection is
+    automatically closed when the object is destroyed. There is the factory
+    method embedded which creates a server and client connected to it.
+
+    Keys and values of database entries are python bytes. You can pickle
+    objects to bytes strings. The encoding is handled by the user when
+    converting to bytes. Usually bytes(bla, encoding="UTF-8") is safe.
+
+    A client can be shared by event loops running in different threads.
+    Each loop gets its own connection pool, lanes, byte budget and counter
+    aggregation, created on first use and dropped once the loop is closed.
+    The limits (max_connections, max_inflight_bytes) apply per loop. The
+    l2_cache and the recorder are locked. hot_keys and hedge are not, pass
+    them only to a client used from a single event loop, and register the
+    scripts before sharing the client.
+
+    """
+
+    _clients = {}
+
+    @staticmethod
+    def embedded(
+            args=None,
+            timeout=None,
+            max_connections=MAX_CONNECTIONS,
+            range_from=None,
+            range_to=None,
+            port=None,
+            name='default',
+            config=None,
+            unix_path=None,
+            socket_options=None,
+    ):
+        """Start an embedded Kyoto Tycoon server and return a client conencted
+        to it.
+
+        The servers are registered by name, calling embedded again with the
+        same name returns the existing client. Each client has its own pool.
+
+        The server is restarted immediately if it dies. The EmbeddedServer is
+        available as the attribute server of the client.
+
+        :param args: Additional arguments for the Kyoto Tycoon server.
+
+        :param timeout: Optional timeout for the socket. None means no timeout
+                        (please also look at the Python socket manual).
+
+        :param max_connections: Maximum connections for io batching.
+
+        :param range_from: Deprecated, pass port or EmbeddedConfig(port=...).
+                           Port range to select a random port from (from).
+
+        :param range_to: Deprecated, pass port or EmbeddedConfig(port=...).
+                         Port range to select a random port from (to).
+
+        :param port: Port of the server. None lets the OS pick a free port.
+
+        :param name: Name of the embedded server.
+
+        :param config: EmbeddedConfig generating the server options and the
+                       database tuning.
+
+        :param unix_path: Let the server listen on this UNIX socket and
+                          connect to it instead of TCP.
+
+        :param socket_options: SocketOptions of the pooled connections.
+
+        :rtype: KyotoTycoon
+
+        """
+        client = KyotoTycoon._clients.get(name)
+        if client:
+            return client
+        args = list(args or [])
+        temp_files = []
+        if config:
+            config_args, temp_script = config._server_args()
+            args = config_args + args
+            if temp_script is not None:
+                temp_files.append(temp_script)
+            if port is None:
+                port = config.port
+            if unix_path is None:
+                unix_path = config.unix_path
+        if range_from is not None or range_to is not None:
+            warnings.warn(
+                "range_from and range_to are deprecated, pass port or "
+                "EmbeddedConfig(port=...)",
+                DeprecationWarning,
+                stacklevel=2,
+            )
+            if port is None and unix_path is None:
+                port = _free_port_in(
+                    DEFAULT_HOST,
+                    RANGE_FROM if range_from is None else range_from,
+                    RANGE_TO if range_to is None else range_to,
+                )
+        server = EmbeddedServer(
+            args, port, unix_path=unix_path, temp_files=temp_files
+        )
+        server.start()
+        client = KyotoTycoon(
+            host=server.host,
+            port=server.port,
+            unix_path=unix_path,
+            socket_options=socket_options,
+            timeout=timeout,
+            max_connections=max_connections
+        )
+        client.server = server
+        KyotoTycoon._clients[name] = client
+        return client
+
+    def __init__(
+            self,
+            host=DEFAULT_HOST,
+            port=DEFAULT_PORT,
+            probe=False,
+            timeout=None,
+            max_connections=MAX_CONNECTIONS,
+            retries=RETRIES,
+            retry_backoff=RETRY_BACKOFF,
+            retry_backoff_max=RETRY_BACKOFF_MAX,
+            unix_path=None,
+            socket_options=None,
+            lanes=None,
+            max_inflight_bytes=None,
+            value_estimate=VALUE_ESTIMATE,
+            max_frame_records=None,
+            max_frame_bytes=None,
+            hot_keys=None,
+            counter_window=COUNTER_WINDOW,
+            counter_batch=COUNTER_BATCH,
+            recorder=None,
+            l2_cache=None,
+            hedge=None,
+            flight_recorder=None,
+            drain_bytes=DRAIN_BYTES,
+            drain_timeout=DRAIN_TIMEOUT,
+    ):
+        """
+        :param host: The hostname or IP to connect to, defaults to
+                     'localhost'.
+
+        :param port: The port number, defaults to 1978 which is the default
+                     port of Kyoto Tycoon.
+
+        :param probe: If set to True, the server connection is checked. The
+                      connections are taken from a pool. This option helps
+                      to prevent late failures.
+
+        :param timeout: Optional timeout for the socket. None means no timeout
+                        (please also look at the Python socket manual).
+
+        :param max_connections: Maximum connections for io batching.
+
+        :param retries: How many times a request failing because of a broken
+                        connection is retried on a fresh connection. Requests
+                        that are not idempotent are only retried if they
+                        have not been sent yet.
+
+        :param retry_backoff: Base delay in seconds of the jittered
+                              exponential backoff between retries.
+
+        :param retry_backoff_max: Maximum delay in seconds between retries.
+
+        :param unix_path: Connect to this UNIX socket instead of host and
+                          port. Use it for servers on the same host to avoid
+                          the loopback TCP overhead.
+
+        :param socket_options: SocketOptions applied to every pooled
+                               connection. Defaults to SocketOptions().
+
+        :param lanes: Traffic classes as list of (name, reserved connections)
+                      ordered by priority, highest first. Requests choose
+                      their lane with the priority argument, unlabelled
+                      requests use the last lane. Defaults to
+                      PRIORITY_INTERACTIVE with one reserved connection and
+                      PRIORITY_BATCH, so bulk loads cannot starve
+                      latency-sensitive requests sent with
+                      priority=PRIORITY_INTERACTIVE.
+
+        :param max_inflight_bytes: Limit of the bytes of encoded requests
+                                   and expected responses in flight. Requests
+                                   wait until they fit. None means no limit.
+                                   get_bulk values larger than
+                                   value_estimate are charged while they
+                                   are received. The metrics are available from
+                                   byte_budget.stats().
+
+        :param value_estimate: Expected value size used to reserve the
+                               response of get_bulk in the byte budget.
+
+        :param max_frame_records: Split set_bulk, get_bulk and remove_bulk
+                                  calls into frames of at most this many
+                                  records. The frames are sent concurrently
+                                  over the pool and the results are merged.
+                                  None means no limit.
+
+        :param max_frame_bytes: Split bulk calls into frames of at most this
+                                many encoded bytes. None means no limit.
+
+        :param hot_keys: HotKeys sampling the keys of bulk operations. Query
+                         the hottest keys with hot_keys.top(). None disables
+                         sampling.
+
+        :param counter_window: Increments of incr() are merged over this
+                               window in seconds.
+
+        :param counter_batch: Apply the merged increments before the window
+                              ends if this many counters are pending.
+
+        :param recorder: TrafficRecorder logging every request sent. None
+                         disables recording.
+
+        :param l2_cache: DiskCache checked by get and get_bulk_keys before
+                         the server. None disables the cache.
+
+        :param hedge: Hedging sending slow get_bulk requests also to a
+                      replica. None disables hedged reads.
+
+        :param flight_recorder: FlightRecorder keeping the phase timings of
+                                slow requests. None disables it.
+
+        :param drain_bytes: The reply of a request cancelled while it is
+                            read is drained in the background to keep the
+                            connection if at most drain_bytes are left. 0
+                            closes the connection of cancelled requests.
+
+        :param drain_timeout: Seconds after which draining is given up and
+                              the connection closed.
+        """
+        self.host              = host
+        self.port              = port
+        self.unix_path         = unix_path
+        self.socket_options    = socket_options or SocketOptions()
+        self.timeout           = timeout
+        self.socket            = None
+        self.max_connections   = max_connections
+        self.retries           = retries
+        self.retry_backoff     = retry_backoff
+        self.retry_backoff_max = retry_backoff_max
+        if lanes is None:
+            lanes = (
+                (PRIORITY_INTERACTIVE, 1 if max_connections > 1 else 0),
+                (PRIORITY_BATCH, 0),
+            )
+        self.lane_config       = lanes
+        self.inflight_limit    = max_inflight_bytes
+        self.counter_window    = counter_window
+        self.counter_batch     = counter_batch
+        self.states            = {}
+        # The state of the last event loop per thread
+        self.local             = threading.local()
+        self.states_lock       = threading.Lock()
+        self.value_estimate    = value_estimate
+        self.max_frame_records = max_frame_records
+        self.max_frame_bytes   = max_frame_bytes
+        self.hot_keys          = hot_keys
+        self.scripts           = {}
+        self.recorder          = recorder
+        self.l2_cache          = l2_cache
+        self.hedge             = hedge
+        self.flight_recorder   = flight_recorder
+        self.drain_bytes       = drain_bytes
+        self.drain_timeout     = drain_timeout
+        self.drains            = 0
+        self.drain_failures    = 0
+        self.server            = None
+        # Validate the lanes
+        _Lanes(max_connections, lanes)
+        if probe:
+            self._probe()
+
+    def _state(self):
+        """Pool and limits of the current event loop"""
+        loop = _current_loop()
+        state = getattr(self.local, 'state', None)
+        if state is not None and state.loop is loop:
+            return state
+        state = self.states.get(loop)
+        if state is None:
+            with self.states_lock:
+                self._drop_closed_loops()
+                state = self.states.get(loop)
+                if state is None:
+                    state = self.states[loop] = _LoopState(self, loop)
+        self.local.state = state
+        return state
+
+    def _drop_closed_loops(self):
+        """Drop the state of closed event loops, their transports close
+        the sockets when they are collected"""
+        for loop in list(self.states):
+            if loop.is_closed():
+                del self.states[loop]
+        state = getattr(self.local, 'state', None)
+        if state is not None and state.loop.is_closed():
+            self.local.state = None
+
+    @property
+    def loop(self):
+        """The current event loop"""
+        return self._state().loop
+
+    @property
+    def free_streams(self):
+        """Pooled streams of the current event loop"""
+        return self._state().free_streams
+
+    @property
+    def lanes(self):
+        """_Lanes of the current event loop"""
+        return self._state().lanes
+
+    @property
+    def byte_budget(self):
+        """ByteBudget of the current event loop"""
+        return self._state().byte_budget
+
+    @property
+    def counters(self):
+        """Counter aggregation of the current event loop"""
+        return self._state().counters
+
+    async def set(
+            self,
+            key,
+            val,
+            db=0,
+            expire=DEFAULT_EXPIRE,
+            flags=0,
+            priority=None,
+    ):
+        """Wrapper function around set_bulk for easily storing a single item
+        in the database.
+
+        :param key: The key of the entry,
+
+        :type key: bytes
+
+        :param val: The value of the entry
+
+        :type val: bytes
+
+        :param db: Database index to store the record in. Default to 0.
+
+        :type db: int
+
+        :param expire: Expiration time for all entries.
+                       kyototycoon.DEFAULT_EXPIRE is 0x7FFFFFFFFFFFFFFF which
+                       means that the records should never expire in the
+                       (near) future.
+
+        :param flags: If set to kyototycoon.FLAG_NOREPLY, function will not
+                      wait for an answer of the server.
+
+        :param priority: Traffic class (lane) of the request, defaults to
+                         the last lane (PRIORITY_BATCH).
+
+        :return: The number of actually stored records, or None if flags was
+                 set to kyototycoon.FLAG_NOREPLY.
+        """
+        return (await self.set_bulk(
+        # pypy #raise Return((yield From(self.set_bulk(
+            ((key, val, db, expire),), flags, priority=priority
+        ))
+        # pypy #))))
+
+    async def set_bulk_kv(
+            self,
+            kv,
+            db=0,
+            expire=DEFAULT_EXPIRE,
+            flags=0,
+            priority=None,
+    ):
+        """Wrapper function around set_bulk for simplifying the process of
+        storing multiple records with equal expiration times in the same
+        database.
+
+        :param kv: dict of key/value pairs.
+
+        :param db: database index to store the values in. defaults to 0.
+
+        :param expire: Expiration time for all entries.
+                       kyototycoon.DEFAULT_EXPIRE is 0x7FFFFFFFFFFFFFFF which
+                       means that the records should never expire in the
+                       (near) future.
+
+        :param flags: If set to kyototycoon.FLAG_NOREPLY, function will not
+                      wait for an answer of the server.
+
+        :param priority: Traffic class (lane) of the request, defaults to
+                         the last lane (PRIORITY_BATCH).
+
+        :return: The number of actually stored records, or None if flags was
+                 set to kyototycoon.FLAG_NOREPLY.
+        """
+        recs = ((key, val, db, expire) for key, val in kv.items())
+        return (await self.set_bulk(
+        # pypy #raise Return((yield From(self.set_bulk(
+            recs, flags, priority=priority
+        ))
+        # pypy #))))
+
+    async def set_bulk(self, recs, flags=0, idempotent=False, priority=None):
+        """Stores multiple records at once.
+
+        :param recs: iterable (e.g. list) of records. Each record is a
+                     list or tuple of 4 entries: key, val, db, expire
+
+        :param flags: If set to kyototycoon.FLAG_NOREPLY, function will not
+                      wait for an answer of the server.
+
+        :param idempotent: If set to True, the request is retried even if
+                           the connection broke after it was sent.
+
+        :param priority: Traffic class (lane) of the request, defaults to
+                         the last lane (PRIORITY_BATCH).
+
+        :return: The number of actually stored records, or None if flags was
+                 set to kyototycoon.FLAG_NOREPLY.
+        """
+        frames = self._split(recs, _set_size)
+        if frames is not None:
+            if len(frames) > 1:
+                counts = await asyncio.gather(*[
+                # pypy #counts = yield From(asyncio.gather(*[
+                    self.set_bulk(frame, flags, idempotent, priority)
+                    for frame in frames
+                ])
+                # pypy #]))
+                return _sum_counts(counts)
+                # pypy #raise Return(_sum_counts(counts))
+            recs = frames[0]
+        recs, reserved = await self._admit(recs, _set_size)
+        # pypy #recs, reserved = yield From(self._admit(recs, _set_size))
+        try:
+            recs = self._observe(MB_SET_BULK, recs, 2)
+            cache = self.l2_cache
+            if cache is not None:
+                # Drop the old values first, a failed request may still
+                # have been applied by the server
+                recs = list(recs)
+                cache.discard((key, db) for key, _, db, _ in recs)
+            res = await self._execute(
+            # pypy #res = yield From(self._execute(
+                _encode_set_bulk(recs, flags),
+                MB_SET_BULK,
+                self._read_count,
+                flags,
+                idempotent,
+                priority,
+            )
+            # pypy #))
+            if cache is not None:
+                cache.store(recs, relative=True)
+            return res
+            # pypy #raise Return(res)
+        finally:
+            self.byte_budget.release(reserved)
+
+    async def get(self, key, db=0, flags=0, priority=None):
+        """Wrapper function around get_bulk for easily retrieving a single
+        item from the database.
+
+
+        :param key: The key of the entry
+        :type  key: bytes
+
+        :param db: The database index. Defaults to 0.
+
+        :param flags: reserved and not used now. (defined by protocol)
+
+        :param priority: Traffic class (lane) of the request, defaults to
+                         the last lane (PRIORITY_BATCH).
+
+        :return: The value of the record, or None if the record could not be
+                 found in the database.
+
+        """
+        if self.l2_cache is not None:
+            recs = await self._get_cached(
+            # pypy #recs = yield From(self._get_cached(
+                ((key, db),), flags, priority
+            )
+            # pypy #))
+        else:
+            recs = await self.get_bulk(
+            # pypy #recs = yield From(self.get_bulk(
+                ((key, db),), flags, priority=priority
+            )
+            # pypy #))
+        if not recs:
+            return None
+            # pypy #raise Return(None)
+        return recs[0][1]
+        # pypy #raise Return(recs[0][1])
+
+    async def get_bulk_keys(
+            self,
+            keys,
+            db=0,
+            flags=0,
+            columnar=False,
+            priority=None,
+            offload=None,
+    ):
+        """Wrapper function around get_bulk for simplifying the process of
+        retrieving multiple records from the same database.
+
+        :param keys: iterable (e.g. list) of keys.
+
+        :param db: database index to store the values in. defaults to 0.
+
+        :param flags: reserved and not used now. (defined by protocol)
+
+        :param columnar: If set to True, the records are returned as
+                         ColumnarRecords instead of a dict.
+
+        :param priority: Traffic class (lane) of the request, defaults to
+                         the last lane (PRIORITY_BATCH).
+
+        :param offload: DecodePool parsing and decoding the response, see
+                        get_bulk.
+
+        :return: dict of key/value pairs.
+        """
+        recs = ((key, db) for key in keys)
+        if self.l2_cache is not None and not columnar and offload is None:
+            recs = await self._get_cached(recs, flags, priority)
+            # pypy #recs = yield From(self._get_cached(recs, flags, priority))
+        else:
+            recs = await self.get_bulk(
+            # pypy #recs = yield From(self.get_bulk(
+                recs, flags, columnar, priority, offload
+            )
+            # pypy #))
+        if columnar:
+            return recs
+            # pypy #raise Return(recs)
+        return dict(((key, val) for key, val, db, xt in recs))
+        # pypy #raise Return(dict(((key, val) for key, val, db, xt in recs)))
+
+    async def _get_cached(self, recs, flags, priority):
+        """get_bulk answering from the l2 cache first"""
+        cache = self.l2_cache
+        hits, missing = cache.lookup(recs)
+        if missing:
+            generation = cache.begin()
+            try:
+                recs = await self.get_bulk(
+                # pypy #recs = yield From(self.get_bulk(
+                    missing, flags, priority=priority
                 )
-                self._push_streams(sr, sw)
-                return recs_cnt
-                # pypy #raise Return(recs_cnt)
-            elif magic == MB_ERROR:
-                raise KyotoTycoonError(
-                    'Internal server error 0x%02x' % MB_ERROR
+                # pypy #))
+                # Skips the records written meanwhile through this client
+                cache.store(recs, since=generation)
+            finally:
+                cache.end(generation)
+            hits.extend(recs)
+        return hits
+        # pypy #raise Return(hits)
+
+    async def get_bulk(
+            self,
+            recs,
+            flags=0,
+            columnar=False,
+            priority=None,
+            offload=None,
+    ):
+        """Retrieves multiple records at once.
+
+        Failed requests are retried on a fresh connection since reading is
+        idempotent.
+
+        :param recs: iterable (e.g. list) of record descriptions. Each
+                     record is a list or tuple of 2 entries: key,db
+
+        :param flags: reserved and not used now. (defined by protocol)
+
+        :param columnar: If set to True, the records are returned as
+                         ColumnarRecords, which avoids creating objects per
+                         record.
+
+        :param priority: Traffic class (lane) of the request, defaults to
+                         the last lane (PRIORITY_BATCH).
+
+        :param offload: DecodePool. The response is received into shared
+                        memory and parsed by its processes, the values are
+                        decoded with its decode function unless columnar
+                        is set. ColumnarRecords returned keep the shared
+                        memory.
+
+        :return: A list of records. Each record is a tuple of 4 entries: (key,
+                 val, db, expire)
+        """
+        frames = self._split(recs, _key_size)
+        if frames is not None:
+            if len(frames) > 1:
+                parts = await asyncio.gather(*[
+                # pypy #parts = yield From(asyncio.gather(*[
+                    self.get_bulk(frame, flags, columnar, priority, offload)
+                    for frame in frames
+                ])
+                # pypy #]))
+                if columnar:
+                    return ColumnarRecords.concat(parts)
+                    # pypy #raise Return(ColumnarRecords.concat(parts))
+                return [rec for part in parts for rec in part]
+                # pypy #raise Return([rec for part in parts for rec in part])
+            recs = frames[0]
+        recs, reserved = await self._admit(
+        # pypy #recs, reserved = yield From(self._admit(
+            recs, _key_size, self._get_response_size
+        )
+        # pypy #))
+        charge = None
+        try:
+            recs = self._observe(MB_GET_BULK, recs, 1)
+            request = _encode_keys(MB_GET_BULK, recs, flags)
+            if offload is not None:
+                read = functools.partial(self._read_shared, offload)
+            elif columnar:
+                read = self._read_columnar
+            else:
+                read = self._read_keys
+            if reserved:
+                # Values exceeding the estimate are charged while receiving
+                charge = read = _ResponseCharge(
+                    self.byte_budget,
+                    5 + sum(self._get_response_size(rec) for rec in recs),
+                    read,
                 )
+            if self.hedge is None:
+                execute = self._execute
             else:
-                raise KyotoTycoonError('Unknown server error')
+                execute = functools.partial(self.hedge.execute, self)
+            res = await execute(
+            # pypy #res = yield From(execute(
+                request,
+                MB_GET_BULK,
+                read,
+                flags & ~FLAG_NOREPLY,
+                True,
+                priority,
+            )
+            # pypy #))
+            if offload is not None:
+                res, decoded = await offload.parse(res, columnar)
+                # pypy #res, decoded = yield From(offload.parse(res, columnar))
+            if offload is not None and not columnar:
+                res = offload.records(res, decoded)
+            return res
+            # pypy #raise Return(res)
+        finally:
+            if charge is not None:
+                charge.release()
+            self.byte_budget.release(reserved)
+
+    async def _read_keys(self, sr, magic_expect):
+        """Internal function for reading key from get_bulk"""
+        data = await sr.readexactly(5)
+        # pypy #data = yield From(sr.readexactly(5))
+        magic, = struct.unpack('!B', data[:1])
+        if magic == magic_expect:
+            recs_cnt, = struct.unpack('!I', data[1:])
+            recs_cnt -= 1
+            recs = []
+            # Reduce yields be reading key and next header at once
+            if recs_cnt >= 0:
+                data = await sr.readexactly(18)
+                # pypy #data = yield From(sr.readexactly(18))
+                pre_data = 0
+                for _ in range(recs_cnt):
+                    db, key_len, val_len, xt = struct.unpack(
+                        '!HIIq', data[pre_data:]
+                    )
+                    pre_data = key_len + val_len
+                    data = await sr.readexactly(pre_data + 18)
+                    # pypy #data = yield From(sr.readexactly(pre_data + 18))
+                    recs.append(
+                        (data[:key_len], data[key_len:pre_data], db, xt)
+                    )
+                db, key_len, val_len, xt = struct.unpack(
+                    '!HIIq', data[pre_data:]
+                )
+                pre_data = key_len + val_len
+                data = await sr.readexactly(pre_data)
+                # pypy #data = yield From(sr.readexactly(pre_data))
+                recs.append((data[:key_len], data[key_len:], db, xt))
+            return recs
+            # pypy #raise Return(recs)
+        elif magic == MB_ERROR:
+            raise KyotoTycoonError(
+                'Internal server error 0x%02x' % MB_ERROR
+            )
+        else:
+            raise KyotoTycoonError('Unknown server error')
+
+    async def _read_columnar(self, sr, magic_expect):
+        """Internal function for reading records from get_bulk into
+        ColumnarRecords"""
+        magic, = struct.unpack('!B', (await sr.readexactly(1)))
+        # pypy #magic, = struct.unpack('!B', (yield From(sr.readexactly(1))))
+        if magic == magic_expect:
+            data = await sr.readexactly(4)
+            # pypy #data = yield From(sr.readexactly(4))
+            recs_cnt, = struct.unpack('!I', data)
+            res = ColumnarRecords(bytearray())
+            buf = res.buffer
+            if recs_cnt:
+                head = await sr.readexactly(18)
+                # pypy #head = yield From(sr.readexactly(18))
+                for i in range(recs_cnt):
+                    db, key_len, val_len, xt = _HEADER.unpack(head)
+                    size = key_len + val_len
+                    # Reduce yields by reading payload and next header at once
+                    if i + 1 < recs_cnt:
+                        data = await sr.readexactly(size + 18)
+                        # pypy #data = yield From(sr.readexactly(size + 18))
+                        head = data[size:]
+                    else:
+                        data = await sr.readexactly(size)
+                        # pypy #data = yield From(sr.readexactly(size))
+                    offset = len(buf)
+                    buf += memoryview(data)[:size]
+                    res.key_offsets.append(offset)
+                    res.key_lengths.append(key_len)
+                    res.val_offsets.append(offset + key_len)
+                    res.val_lengths.append(val_len)
+                    res.xts.append(xt)
+                    res.dbs.append(db)
+            return res
+            # pypy #raise Return(res)
+        elif magic == MB_ERROR:
+            raise KyotoTycoonError(
+                'Internal server error 0x%02x' % MB_ERROR
+            )
+        else:
+            raise KyotoTycoonError('Unknown server error')
+
+    async def _read_shared(self, pool, sr, magic_expect):
+        """Internal function for reading the records of get_bulk into shared
+        memory, returns a _SharedReply for DecodePool.parse.
+
+        The reply is received in chunks of up to SHARED_CHUNK bytes and the
+        record headers are walked in place, filling the arrays of
+        ColumnarRecords without creating objects per record."""
+        data = await sr.readexactly(5)
+        # pypy #data = yield From(sr.readexactly(5))
+        magic, recs_cnt = struct.unpack('!BI', data)
+        if magic == magic_expect:
+            shm = shared_memory.SharedMemory(
+                create=True,
+                size=max(RECV_BUFFER, recs_cnt * (18 + self.value_estimate)),
+            )
+            res = ColumnarRecords(None)
+            key_offsets = res.key_offsets
+            key_lengths = res.key_lengths
+            val_offsets = res.val_offsets
+            val_lengths = res.val_lengths
+            xts = res.xts
+            dbs = res.dbs
+            unpack_from = _HEADER.unpack_from
+            try:
+                # Bytes received and start of the next record
+                size = pos = end = count = 0
+                while True:
+                    buf = shm.buf
+                    while count < recs_cnt and pos + 18 <= size:
+                        db, key_len, val_len, xt = unpack_from(buf, pos)
+                        end = pos + 18 + key_len + val_len
+                        if end > size:
+                            break
+                        key_offsets.append(pos + 18)
+                        key_lengths.append(key_len)
+                        val_offsets.append(pos + 18 + key_len)
+                        val_lengths.append(val_len)
+                        xts.append(xt)
+                        dbs.append(db)
+                        pos = end
+                        count += 1
+                    left = recs_cnt - count
+                    if not left:
+                        break
+                    # Never read beyond the reply, every record left has at
+                    # least a header
+                    if pos + 18 <= size:
+                        need = end - size + 18 * (left - 1)
+                    else:
+                        need = pos + 18 * left - size
+                    chunk = min(need, SHARED_CHUNK)
+                    data = await sr.read(chunk)
+                    # pypy #data = yield From(sr.read(chunk))
+                    if not data:
+                        raise asyncio.IncompleteReadError(data, need)
+                    if size + len(data) > len(buf):
+                        shm = _grow_shared(shm, size, size + len(data))
+                    shm.buf[size:size + len(data)] = data
+                    size += len(data)
+            except BaseException:
+                shm.close()
+                shm.unlink()
+                raise
+            return _SharedReply(shm, size, res)
+            # pypy #raise Return(_SharedReply(shm, size, res))
+        elif magic == MB_ERROR:
+            raise KyotoTycoonError(
+                'Internal server error 0x%02x' % MB_ERROR
+            )
+        else:
+            raise KyotoTycoonError('Unknown server error')
+
+    async def remove(self, key, db, flags=0, priority=None):
+        """Wrapper function around remove_bulk for easily removing a single
+        item from the database.
+
+        :param key: The key of the entry.
+        :type  key: bytes
+
+        :param db: database index to store the values in. defaults to 0.
+
+        :param flags: If set to kyototycoon.FLAG_NOREPLY, function will not
+                      wait for an answer of the server.
+
+        :param priority: Traffic class (lane) of the request, defaults to
+                         the last lane (PRIORITY_BATCH).
+
+        :return: The number of removed records, or None if flags was set to
+                 kyototycoon.FLAG_NOREPLY
+        """
+        return (await self.remove_bulk(
+        # pypy #raise Return((yield From(self.remove_bulk(
+            ((key, db),), flags, priority=priority
+        ))
+        # pypy #))))
+
+    async def remove_bulk_keys(self, keys, db, flags=0, priority=None):
+        """Wrapper function around remove_bulk for simplifying the process of
+        removing multiple records from the same database.
+
+        :param keys: iterable (e.g. list) of keys.
+
+        :param db: database index to store the values in. defaults to 0.
+
+        :param flags: If set to kyototycoon.FLAG_NOREPLY, function will not
+                      wait for an answer of the server.
+
+        :param priority: Traffic class (lane) of the request, defaults to
+                         the last lane (PRIORITY_BATCH).
+
+        :return: The number of removed records, or None if flags was set to
+                 kyototycoon.FLAG_NOREPLY
+        """
+        recs = ((key, db) for key in keys)
+        return (await self.remove_bulk(
+        # pypy #raise Return((yield From(self.remove_bulk(
+            recs, flags, priority=priority
+        ))
+        # pypy #))))
+
+    async def remove_bulk(
+            self,
+            recs,
+            flags=0,
+            idempotent=False,
+            priority=None,
+    ):
+        """Remove multiple records at once.
+
+        :param recs: iterable (e.g. list) of record descriptions. Each
+                     record is a list or tuple of 2 entries: key,db
+
+        :param flags: If set to kyototycoon.FLAG_NOREPLY, function will not
+                      wait for an answer of the server.
+
+        :param idempotent: If set to True, the request is retried even if
+                           the connection broke after it was sent. The
+                           number of removed records may then be too low.
+
+        :param priority: Traffic class (lane) of the request, defaults to
+                         the last lane (PRIORITY_BATCH).
+
+        :return: The number of removed records, or None if flags was set to
+                 kyototycoon.FLAG_NOREPLY
+        """
+        frames = self._split(recs, _key_size)
+        if frames is not None:
+            if len(frames) > 1:
+                counts = await asyncio.gather(*[
+                # pypy #counts = yield From(asyncio.gather(*[
+                    self.remove_bulk(frame, flags, idempotent, priority)
+                    for frame in frames
+                ])
+                # pypy #]))
+                return _sum_counts(counts)
+                # pypy #raise Return(_sum_counts(counts))
+            recs = frames[0]
+        recs, reserved = await self._admit(recs, _key_size)
+        # pypy #recs, reserved = yield From(self._admit(recs, _key_size))
+        try:
+            recs = self._observe(MB_REMOVE_BULK, recs, 1)
+            if self.l2_cache is not None:
+                recs = list(recs)
+                self.l2_cache.discard(recs)
+            return (await self._execute(
+            # pypy #raise Return((yield From(self._execute(
+                _encode_keys(MB_REMOVE_BULK, recs, flags),
+                MB_REMOVE_BULK,
+                self._read_count,
+                flags,
+                idempotent,
+                priority,
+            ))
+            # pypy #))))
+        finally:
+            self.byte_budget.release(reserved)
+
+    async def play_script(
+            self,
+            name,
+            recs,
+            flags=0,
+            idempotent=False,
+            priority=None,
+    ):
+        """Calls a procedure of the LUA scripting language extension.
+
+        :param name: The name of the LUA function or a Script. The codecs of
+                     registered scripts are applied.
+
+        :param recs: iterable (e.g. list) of records. Each record is a list or
+                     tuple of 2 entries: key, val. For registered scripts
+                     the arguments of the argument codec.
+
+        :param flags: If set to kyototycoon.FLAG_NOREPLY, function will not
+                      wait for an answer of the server.
+
+        :param idempotent: If set to True, the procedure is retried on a
+                           fresh connection if the connection broke.
+
+        :param priority: Traffic class (lane) of the request, defaults to
+                         the last lane (PRIORITY_BATCH).
+
+        :return: A list of records. Each record is a tuple of 2 entries: (key,
+                 val). Or None if flags was set to kyototycoon.FLAG_NOREPLY.
+                 For registered scripts the result of the result codec.
+        """
+        script = self._script(name)
+        recs, reserved = await self._admit(
+        # pypy #recs, reserved = yield From(self._admit(
+            script.encode(recs), _script_size, _script_size
+        )
+        # pypy #))
+        try:
+            res = await self._execute(
+            # pypy #res = yield From(self._execute(
+                script.request(recs, flags),
+                MB_PLAY_SCRIPT,
+                self._read_script,
+                flags,
+                idempotent or script.idempotent,
+                priority,
+            )
+            # pypy #))
         finally:
-            self._release_connection()
+            self.byte_budget.release(reserved)
+        if res is None:
+            return None
+            # pypy #raise Return(None)
+        return script.decode(res)
+        # pypy #raise Return(script.decode(res))
 
-    @asyncio.coroutine
-    def play_script(self, name, recs, flags=0):
-        """Calls a procedure of the LUA scripting language extension.
+    async def incr(self, key, delta=1):
+        """Atomically add delta to the counter key of the first database.
 
-        :param name: The name of the LUA function.
+        The increments are merged over a short window (counter_window) and
+        applied with one call of the incr procedure of LUA_PROCEDURES, which
+        the server has to load (see EmbeddedConfig scripts). The counters
+        are stored in the 8 byte big-endian format of Kyoto Tycoon.
 
-        :param recs: iterable (e.g. list) of records. Each record is a list or
-                     tuple of 2 entries: key, val
+        :param key: The key of the counter.
+
+        :type key: bytes
+
+        :param delta: Integer added to the counter.
+
+        :return: The value of the counter after this increment.
+        """
+        return (await self.counters.add(key, delta))
+        # pypy #raise Return((yield From(self.counters.add(key, delta))))
+
+    async def play_script_many(
+            self,
+            name,
+            calls,
+            flags=0,
+            idempotent=False,
+            priority=None,
+    ):
+        """Calls a procedure of the LUA scripting language extension many
+        times. The calls are pipelined: they are distributed over the pooled
+        connections and each connection sends its calls at once before the
+        replies are read.
+
+        :param name: The name of the LUA function or a Script. The codecs of
+                     registered scripts are applied.
+
+        :param calls: iterable of the records (or arguments of the argument
+                      codec) of each call.
 
         :param flags: If set to kyototycoon.FLAG_NOREPLY, function will not
                       wait for an answer of the server.
 
-        :return: A list of records. Each record is a tuple of 2 entries: (key,
-                 val). Or None if flags was set to kyototycoon.FLAG_NOREPLY.
+        :param idempotent: If set to True, the calls are retried on a fresh
+                           connection if the connection broke.
+
+        :param priority: Traffic class (lane) of the request, defaults to
+                         the last lane (PRIORITY_BATCH).
+
+        :return: A list with the result of each call, or None if flags was
+                 set to kyototycoon.FLAG_NOREPLY.
+        """
+        script = self._script(name)
+        calls = [list(script.encode(recs)) for recs in calls]
+        groups = min(len(calls), self.lanes.max_connections)
+        if not groups:
+            return []
+            # pypy #raise Return([])
+        per_group = -(-len(calls) // groups)
+        parts = await asyncio.gather(*[
+        # pypy #parts = yield From(asyncio.gather(*[
+            self._play_pipelined(
+                script,
+                calls[offset:offset + per_group],
+                flags,
+                idempotent or script.idempotent,
+                priority,
+            ) for offset in range(0, len(calls), per_group)
+        ])
+        # pypy #]))
+        if flags & FLAG_NOREPLY:
+            return None
+            # pypy #raise Return(None)
+        return [script.decode(res) for part in parts for res in part]
+        # pypy #raise Return(
+        # pypy #    [script.decode(res) for part in parts for res in part]
+        # pypy #)
+
+    def scan(
+            self,
+            prefix=None,
+            db=0,
+            batch=1000,
+            values=False,
+            ordered=False,
+            priority=None,
+    ):
+        """Iterate over the keys of a database starting with prefix.
+
+        Uses the scan procedure of LUA_PROCEDURES, which the server has to
+        load (see EmbeddedConfig scripts). Each round trip returns up to
+        batch keys and a cursor to continue from. Keys added or removed
+        during the scan may or may not be returned. If the key at the cursor
+        is removed from a hash database between two batches, the scan
+        cannot continue and raises KyotoTycoonError instead of ending early.
+
+        :param prefix: Only return keys starting with prefix (bytes).
+
+        :param db: database index to scan.
+
+        :param batch: Number of keys per round trip.
+
+        :param values: If set to True, (key, value) tuples are returned.
+
+        :param ordered: Set it for tree databases (e.g. .kct) to jump to the
+                        prefix and stop after it. Hash databases are scanned
+                        entirely.
+
+        :param priority: Traffic class (lane) of the requests, e.g.
+                         PRIORITY_BATCH.
+
+        :rtype: Scan
         """
-        sr, sw = yield from self._pop_streams()
-        # pypy #sr, sw = yield From(self._pop_streams())
+        return Scan(self, prefix, db, batch, values, ordered, priority)
+
+    async def _play_pipelined(
+            self,
+            script,
+            calls,
+            flags,
+            idempotent,
+            priority,
+    ):
+        """Send calls of script over one connection and read the replies"""
+        calls, reserved = await self._admit(
+        # pypy #calls, reserved = yield From(self._admit(
+            calls, script.size, script.size
+        )
+        # pypy #))
         try:
+            return (await self._execute(
+            # pypy #raise Return((yield From(self._execute(
+                b''.join(script.request(recs, flags) for recs in calls),
+                MB_PLAY_SCRIPT,
+                functools.partial(self._read_scripts, count=len(calls)),
+                flags,
+                idempotent,
+                priority,
+            ))
+            # pypy #))))
+        finally:
+            self.byte_budget.release(reserved)
 
-            request = [
-                struct.pack(
-                    '!BII', MB_PLAY_SCRIPT, flags, len(name)
-                ), None, name
-            ]
+    async def _read_script(self, sr, magic_expect):
+        """Internal function for reading the records of play_script"""
+        magic, = struct.unpack('!B', (
+            await sr.readexactly(1))
+        # pypy #    yield From(sr.readexactly(1)))
+        )
+        if magic == magic_expect:
+            recs_cnt, = struct.unpack('!I', (
+                await sr.readexactly(4))
+            # pypy #    yield From(sr.readexactly(4)))
+            )
+            recs = []
+            if recs_cnt:
+                head = await sr.readexactly(8)
+                # pypy #head = yield From(sr.readexactly(8))
+                for i in range(recs_cnt):
+                    key_len, val_len = _SCRIPT_HEADER.unpack(head)
+                    size = key_len + val_len
+                    # Reduce yields by reading record and next header at once
+                    if i + 1 < recs_cnt:
+                        data = await sr.readexactly(size + 8)
+                        # pypy #data = yield From(sr.readexactly(size + 8))
+                        head = data[size:]
+                    else:
+                        data = await sr.readexactly(size)
+                        # pypy #data = yield From(sr.readexactly(size))
+                    recs.append((data[:key_len], data[key_len:size]))
+            return recs
+            # pypy #raise Return(recs)
+        elif magic == MB_ERROR:
+            raise KyotoTycoonError(
+                'Internal server error 0x%02x' % MB_ERROR
+            )
+        else:
+            raise KyotoTycoonError('Unknown server error')
+
+    async def _read_replies(self, sr, magic_expect, magics):
+        """Internal function for reading the replies of the frames magics,
+        used to replay traffic"""
+        res = []
+        for magic in magics:
+            if magic == MB_GET_BULK:
+                read = self._read_keys
+            elif magic == MB_PLAY_SCRIPT:
+                read = self._read_script
+            else:
+                read = self._read_count
+            rec = await read(sr, magic)
+            # pypy #rec = yield From(read(sr, magic))
+            res.append(rec)
+        return res
+        # pypy #raise Return(res)
+
+    async def _read_scripts(self, sr, magic_expect, count):
+        """Internal function for reading the replies of pipelined
+        play_script calls"""
+        res = []
+        for _ in range(count):
+            rec = await self._read_script(sr, magic_expect)
+            # pypy #rec = yield From(self._read_script(sr, magic_expect))
+            res.append(rec)
+        return res
+        # pypy #raise Return(res)
+
+    def _observe(self, magic, recs, db_index):
+        """Sample the keys of a request if hot key detection is enabled"""
+        if self.hot_keys is None:
+            return recs
+        if not isinstance(recs, (list, tuple)):
+            recs = list(recs)
+        self.hot_keys.observe(magic, recs, db_index)
+        return recs
+
+    async def _admit(self, recs, request_size, response_size=None):
+        """Wait until the request fits into the byte budget.
+
+        request_size(rec) and response_size(rec) return the encoded size and
+        the expected response size of a record.
+
+        :return: The records as list and the reserved bytes. Release them
+                 with byte_budget.release().
+        """
+        if self.byte_budget.limit is None:
+            return recs, 0
+            # pypy #raise Return((recs, 0))
+        recs = list(recs)
+        size = HEADER_SIZE + sum(request_size(rec) for rec in recs)
+        if response_size is not None:
+            size += sum(response_size(rec) for rec in recs)
+        await self.byte_budget.acquire(size)
+        # pypy #yield From(self.byte_budget.acquire(size))
+        return recs, size
+        # pypy #raise Return((recs, size))
+
+    def _get_response_size(self, rec):
+        """Expected response size of a get_bulk record"""
+        return 18 + len(rec[0]) + self.value_estimate
 
-            cnt = 0
-            for key, val in recs:
-                request.append(struct.pack('!II', len(key), len(val)))
-                request.append(key)
-                request.append(val)
-                cnt += 1
+    async def _execute(
+            self,
+            request,
+            magic,
+            read,
+            flags=0,
+            idempotent=False,
+            priority=None,
+    ):
+        """Send a request over a pooled connection and read the reply using
+        the coroutine read(sr, magic).
 
-            request[1] = struct.pack('!I', cnt)
+        Requests failing because of a broken connection are retried on a
+        fresh connection with jittered exponential backoff. Requests that are
+        not idempotent are only retried if they were not sent."""
+        if priority is None:
+            priority = self.lanes.order[-1]
+        attempt = 0
+        while True:
+            sent = False
+            recorder = self.recorder
+            flight = self.flight_recorder
+            phases = None if flight is None else {}
+            start = None
+            try:
+                if recorder is not None or flight is not None:
+                    start = time.time()
+                try:
+                    sr, sw = await self._pop_streams(
+                    # pypy #sr, sw = yield From(self._pop_streams(
+                        priority, phases
+                    )
+                    # pypy #))
+                except BaseException as exc:
+                    if flight is not None:
+                        flight.observe(start, phases, request, 0, exc)
+                    raise
+                sent = True
+                # Written before a task is created, a caller cancelled
+                # while waiting for the connection never sends the request
+                self._send(sw, request, priority, start, phases)
+                if recorder is None and flight is None:
+                    reader = sr
+                else:
+                    reader = _CountingReader(sr)
+                roundtrip = self._roundtrip(
+                    sr,
+                    sw,
+                    reader,
+                    request,
+                    magic,
+                    read,
+                    flags,
+                    priority,
+                    start,
+                    phases,
+                )
+                if not self.drain_bytes or flags & FLAG_NOREPLY:
+                    return (await roundtrip)
+                    # pypy #raise Return((yield From(roundtrip)))
+                task = self.loop.create_task(roundtrip)
+                try:
+                    return (await asyncio.shield(task))
+                    # pypy #raise Return((yield From(asyncio.shield(task))))
+                except asyncio.CancelledError:
+                    if not task.done():
+                        self._drain(task, reader)
+                    elif not task.cancelled() and task.exception() is None:
+                        _discard_reply(task.result())
+                    raise
+            except RETRY_ERRORS as exc:
+                if sent:
+                    # The server probably restarted, the other pooled
+                    # connections are stale too
+                    self._flush_streams()
+                if attempt >= self.retries or (sent and not idempotent):
+                    raise
+                delay = random.uniform(0, min(
+                    self.retry_backoff_max,
+                    self.retry_backoff * 2 ** attempt
+                ))
+                attempt += 1
+                _l().warning(
+                    "Retrying request 0x%02x in %.3fs: %r",
+                    magic,
+                    delay,
+                    exc,
+                )
+                await asyncio.sleep(delay)
+                # pypy #yield From(asyncio.sleep(delay))
 
-            yield from sw.write(''.join(request))
-            # pypy #yield From(sw.write(''.join(request)))
+    def _send(self, sw, request, priority, start, phases):
+        """Write the request to a popped connection. It is closed and its
+        lane slot released on errors."""
+        try:
+            sw.write(request)
+        except BaseException as exc:
+            sw.close()
+            self._release_connection(priority)
+            if self.flight_recorder is not None:
+                self.flight_recorder.observe(start, phases, request, 0, exc)
+            raise
+        if phases is not None:
+            phases['written'] = time.time()
 
+    async def _roundtrip(
+            self,
+            sr,
+            sw,
+            reader,
+            request,
+            magic,
+            read,
+            flags,
+            priority,
+            start,
+            phases,
+    ):
+        """Read the reply of a request written to a popped connection, then
+        return the connection to the pool. It is closed on errors."""
+        recorder = self.recorder
+        flight = self.flight_recorder
+        try:
             if flags & FLAG_NOREPLY:
-                self._push_streams(sr, sw)
-                return None
-                # pypy #raise Return(None)
+                res = None
+            else:
+                res = await read(reader, magic)
+                # pypy #res = yield From(read(reader, magic))
+        except BaseException as exc:
+            sw.close()
+            self._release_connection(priority)
+            if flight is not None:
+                flight.observe(start, phases, request, reader.count, exc)
+            raise
+        # Pool the connection before releasing its slot, so the request
+        # woken by the release reuses it instead of opening another one
+        _DrainLimit.remove(sr)
+        self._push_streams(sr, sw)
+        self._release_connection(priority)
+        if recorder is not None:
+            recorder.record(
+                start, time.time() - start, reader.count, request
+            )
+        if flight is not None:
+            flight.observe(start, phases, request, reader.count)
+        return res
+        # pypy #raise Return(res)
+
+    def _drain(self, task, reader):
+        """Let the task of a cancelled request read the rest of the reply in
+        the background, so the connection returns to the pool. The
+        connection is closed if more than drain_bytes are left or it takes
+        longer than drain_timeout."""
+        self.drains += 1
+        if isinstance(reader, _CountingReader):
+            reader.limit = reader.count + self.drain_bytes
+        else:
+            _DrainLimit(reader, self.drain_bytes)
+        handle = self.loop.call_later(self.drain_timeout, task.cancel)
+
+        def done(task):
+            """Stop the timeout, retrieve the error and release the reply"""
+            handle.cancel()
+            if task.cancelled() or task.exception() is not None:
+                self.drain_failures += 1
+            else:
+                _discard_reply(task.result())
 
-            magic, = struct.unpack(
-                '!B', (yield from sr.readexactly(1))
-            # pypy #    '!B', (yield From(sr.readexactly(1)))
+        task.add_done_callback(done)
+
+    async def _read_count(self, sr, magic_expect):
+        """Internal function for reading the count of set_bulk or
+        remove_bulk"""
+        magic, = struct.unpack('!B', (
+            await sr.readexactly(1))
+        # pypy #    yield From(sr.readexactly(1)))
+        )
+        if magic == magic_expect:
+            recs_cnt, = struct.unpack('!I', (
+                await sr.readexactly(4))
+            # pypy #    yield From(sr.readexactly(4)))
             )
-            res = yield from self._read_keys(sr, MB_PLAY_SCRIPT)
-            # pypy #res = yield From(self._read_keys(sr, MB_PLAY_SCRIPT))
-            self._push_streams(sr, sw)
-            return res
-            # pypy #raise Return(res)
-        finally:
-            self._release_connection()
+            return recs_cnt
+            # pypy #raise Return(recs_cnt)
+        elif magic == MB_ERROR:
+            raise KyotoTycoonError(
+                'Internal server error 0x%02x' % MB_ERROR
+            )
+        else:
+            raise KyotoTycoonError('Unknown server error')
 
     def close(self):
-        """Close the sockets"""
-        while self.free_streams:
-            _, sw = self.free_streams.pop()
+        """Close the sockets of the current event loop, cancel its pending
+        counter increments and drop the pools of closed event loops"""
+        state = self._existing_state()
+        if state is not None and not state.loop.is_closed():
+            state.counters.close()
+        self._flush_streams()
+        with self.states_lock:
+            self._drop_closed_loops()
+        if self.recorder is not None:
+            self.recorder.close()
+        if self.l2_cache is not None:
+            self.l2_cache.sync()
+
+    def _existing_state(self):
+        """State of the current event loop if there is one, does not create
+        it"""
+        try:
+            return self.states.get(_current_loop())
+        except RuntimeError:
+            # No event loop in this thread
+            return None
+
+    def _flush_streams(self):
+        """Close all pooled streams of the current event loop"""
+        state = self._existing_state()
+        if state is None:
+            return
+        while state.free_streams:
+            _, sw = state.free_streams.pop()
             sw.close()
 
     def _probe(self):
         """Probe the server"""
-        sock = socket.create_connection(
-            (self.host, self.port),
-            self.timeout
-        )
+        sock = _connect(self.host, self.port, self.unix_path, self.timeout)
         sock.close()
 
     def __del__(self):
         """Cleanup on the delete"""
-        self.close()
+        if getattr(self, 'states', None):
+            self.close()
 
-    @asyncio.coroutine
-    def _pop_streams(self):
+    async def _pop_streams(self, priority, phases=None):
         """Get a new stream. It will block (async) when max_connections is
-        reached"""
-        yield from self.semaphore.acquire()
-        # pypy #yield From(self.semaphore.acquire())
-        if self.free_streams:
-            return self.free_streams.pop()
-            # pypy #raise Return(self.free_streams.pop())
-        else:
-            return (yield from asyncio.open_connection(
-            # pypy #raise Return((yield From(asyncio.open_connection(
-                self.host,
-                self.port,
-            ))
-            # pypy #))))
+        reached or the remaining connections are reserved for other
+        priorities.
+
+        If phases is a dict the times of acquiring the slot, connecting and
+        creating the connection are set for the FlightRecorder."""
+        state = self._state()
+        await state.lanes.acquire(priority)
+        # pypy #yield From(state.lanes.acquire(priority))
+        if phases is not None:
+            phases['acquired'] = time.time()
+        while state.free_streams:
+            sr, sw = state.free_streams.pop()
+            if not sr.at_eof() and sr.exception() is None:
+                if phases is not None:
+                    phases['created'] = getattr(
+                        sw, 'ktasync_created', phases['acquired']
+                    )
+                return sr, sw
+                # pypy #raise Return((sr, sw))
+            # The server closed the connection while it was pooled, it
+            # probably restarted
+            sw.close()
+            self._flush_streams()
+        options = self.socket_options
+        sw = None
+        try:
+            if self.unix_path is not None:
+                sr, sw = await asyncio.open_unix_connection(
+                # pypy #sr, sw = yield From(asyncio.open_unix_connection(
+                    self.unix_path,
+                    **options.stream_kwargs()
+                )
+                # pypy #))
+            else:
+                sr, sw = await asyncio.open_connection(
+                # pypy #sr, sw = yield From(asyncio.open_connection(
+                    self.host,
+                    self.port,
+                    **options.stream_kwargs()
+                )
+                # pypy #))
+            options.apply(sw)
+        except BaseException:
+            if sw is not None:
+                sw.close()
+            self._release_connection(priority)
+            if phases is not None:
+                phases['connected'] = time.time()
+            raise
+        sw.ktasync_created = time.time()
+        if phases is not None:
+            phases['connected'] = phases['created'] = sw.ktasync_created
+        return sr, sw
+        # pypy #raise Return((sr, sw))
 
-    def _release_connection(self):
-        """Release the semaphore
+    def _release_connection(self, priority):
+        """Release the connection slot of priority
 
         If a connection dies, we won't return it. Therefore release is an
         extra method."""
-        self.semaphore.release()
+        self.lanes.release(priority)
 
     def _push_streams(self, sr, sw):
         """Return used stream."""
         self.free_streams.append((sr, sw))
+
+
+class _Connection(object):
+    """Blocking connection with a preallocated receive buffer.
+
+    Replies are received with recv_into into the buffer and the headers are
+    parsed out of it, so a single recv usually covers many records. A buffer
+    grown for a large reply is shrunk again once it is consumed.
+    """
+
+    def __init__(self, sock, buffer_size):
+        self.sock  = sock
+        self.size  = buffer_size
+        self.buf   = bytearray(buffer_size)
+        self.view  = memoryview(self.buf)
+        self.start = 0
+        self.end   = 0
+        self.sendmsg = getattr(sock, "sendmsg", None)
+
+    def send(self, parts):
+        """Send a request given as list of parts. Large requests are sent
+        with scatter-gather sendmsg instead of joining the parts."""
+        size = sum(len(part) for part in parts)
+        if self.sendmsg is None or size < SENDMSG_MIN:
+            self.sock.sendall(b''.join(parts))
+            return
+        pending = collections.deque(part for part in parts if len(part))
+        while pending:
+            sent = self.sendmsg(
+                [pending[i] for i in range(min(IOV_MAX, len(pending)))]
+            )
+            while sent:
+                head = pending[0]
+                if sent >= len(head):
+                    sent -= len(head)
+                    pending.popleft()
+                else:
+                    pending[0] = memoryview(head)[sent:]
+                    sent = 0
+
+    def fill(self, size):
+        """Make sure size bytes are buffered"""
+        buffered = self.end - self.start
+        if buffered >= size:
+            return
+        if self.start + size > len(self.buf):
+            rest = self.view[self.start:self.end].tobytes()
+            if size > len(self.buf):
+                self.buf  = bytearray(max(size, 2 * len(self.buf)))
+                self.view = memoryview(self.buf)
+            self.buf[:buffered] = rest
+            self.start = 0
+            self.end   = buffered
+        while self.end - self.start < size:
+            received = self.sock.recv_into(self.view[self.end:])
+            if not received:
+                raise socket.error("Connection closed by the server")
+            self.end += received
+
+    def shrink(self):
+        """Replace a grown receive buffer by one of the initial size, if
+        nothing is buffered"""
+        if len(self.buf) > self.size and self.start == self.end:
+            self.buf   = bytearray(self.size)
+            self.view  = memoryview(self.buf)
+            self.start = 0
+            self.end   = 0
+
+    def _count(self, magic_expect):
+        """Read the magic and the record count of a reply"""
+        self.fill(1)
+        magic = self.buf[self.start]
+        if magic != magic_expect:
+            self.start += 1
+            if magic == MB_ERROR:
+                raise KyotoTycoonError(
+                    'Internal server error 0x%02x' % MB_ERROR
+                )
+            raise KyotoTycoonError('Unknown server error')
+        self.fill(5)
+        cnt, = _COUNT.unpack_from(self.buf, self.start + 1)
+        self.start += 5
+        return cnt
+
+    def read_count(self, magic_expect):
+        """Read the reply of set_bulk or remove_bulk"""
+        return self._count(magic_expect)
+
+    def read_records(self, magic_expect):
+        """Read the records of get_bulk"""
+        recs = []
+        for _ in range(self._count(magic_expect)):
+            self.fill(18)
+            db, key_len, val_len, xt = _HEADER.unpack_from(
+                self.buf, self.start
+            )
+            self.fill(18 + key_len + val_len)
+            start = self.start + 18
+            end   = start + key_len + val_len
+            recs.append((
+                self.view[start:start + key_len].tobytes(),
+                self.view[start + key_len:end].tobytes(),
+                db,
+                xt,
+            ))
+            self.start = end
+        return recs
+
+    def read_script(self, magic_expect):
+        """Read the records of play_script"""
+        recs = []
+        for _ in range(self._count(magic_expect)):
+            self.fill(8)
+            key_len, val_len = _SCRIPT_HEADER.unpack_from(
+                self.buf, self.start
+            )
+            self.fill(8 + key_len + val_len)
+            start = self.start + 8
+            end   = start + key_len + val_len
+            recs.append((
+                self.view[start:start + key_len].tobytes(),
+                self.view[start + key_len:end].tobytes(),
+            ))
+            self.start = end
+        return recs
+
+    def close(self):
+        """Close the socket"""
+        self.sock.close()
+
+
+class SyncKyotoTycoon(_Client):
+    """Blocking client with the API of KyotoTycoon, a faster replacement of
+    files/kyototycoon_orig.py.
+
+    The client is thread-safe: each request takes a connection from a pool
+    of at most max_connections connections. Replies are parsed out of a
+    preallocated receive buffer filled with recv_into. Bulk calls split into
+    frames (max_frame_records, max_frame_bytes) are pipelined over one
+    connection.
+    """
+
+    def __init__(
+            self,
+            host=DEFAULT_HOST,
+            port=DEFAULT_PORT,
+            timeout=None,
+            max_connections=MAX_CONNECTIONS,
+            retries=RETRIES,
+            retry_backoff=RETRY_BACKOFF,
+            retry_backoff_max=RETRY_BACKOFF_MAX,
+            unix_path=None,
+            socket_options=None,
+            buffer_size=RECV_BUFFER,
+            max_frame_records=None,
+            max_frame_bytes=None,
+            pipeline_depth=PIPELINE_DEPTH,
+    ):
+        """
+        :param host: The hostname or IP to connect to, defaults to
+                     'localhost'.
+
+        :param port: The port number, defaults to 1978 which is the default
+                     port of Kyoto Tycoon.
+
+        :param timeout: Optional timeout for the socket. None means no timeout
+                        (please also look at the Python socket manual).
+
+        :param max_connections: Maximum connections of the pool. Threads
+                                wait for a free connection.
+
+        :param retries: How many times a request failing because of a broken
+                        connection is retried on a fresh connection. Requests
+                        that are not idempotent are only retried if they
+                        have not been sent yet.
+
+        :param retry_backoff: Base delay in seconds of the jittered
+                              exponential backoff between retries.
+
+        :param retry_backoff_max: Maximum delay in seconds between retries.
+
+        :param unix_path: Connect to this UNIX socket instead of host and
+                          port.
+
+        :param socket_options: SocketOptions applied to every pooled
+                               connection. Defaults to SocketOptions().
+
+        :param buffer_size: Initial size of the receive buffer of each
+                            connection. It grows for larger records.
+
+        :param max_frame_records: Split bulk calls into frames of at most
+                                  this many records, which are pipelined.
+                                  None means no limit.
+
+        :param max_frame_bytes: Split bulk calls into frames of at most this
+                                many encoded bytes. None means no limit.
+
+        :param pipeline_depth: Frames sent before the first reply is read.
+        """
+        self.host              = host
+        self.port              = port
+        self.unix_path         = unix_path
+        self.timeout           = timeout
+        self.socket_options    = socket_options or SocketOptions()
+        self.max_connections   = max_connections
+        self.retries           = retries
+        self.retry_backoff     = retry_backoff
+        self.retry_backoff_max = retry_backoff_max
+        self.buffer_size       = buffer_size
+        self.max_frame_records = max_frame_records
+        self.max_frame_bytes   = max_frame_bytes
+        self.pipeline_depth    = max(1, pipeline_depth)
+        self.scripts           = {}
+        self.free_connections  = []
+        self.lock              = threading.Lock()
+        self.slots             = threading.BoundedSemaphore(max_connections)
+
+    def set(self, key, val, db=0, expire=DEFAULT_EXPIRE, flags=0):
+        """Store a single item, see KyotoTycoon.set"""
+        return self.set_bulk(((key, val, db, expire),), flags)
+
+    def set_bulk_kv(self, kv, db=0, expire=DEFAULT_EXPIRE, flags=0):
+        """Store the items of the dict kv, see KyotoTycoon.set_bulk_kv"""
+        recs = ((key, val, db, expire) for key, val in kv.items())
+        return self.set_bulk(recs, flags)
+
+    def set_bulk(self, recs, flags=0, idempotent=False):
+        """Store records (key, val, db, expire), see KyotoTycoon.set_bulk
+
+        :return: The number of actually stored records, or None if flags was
+                 set to kyototycoon.FLAG_NOREPLY.
+        """
+        counts = self._execute(
+            [
+                _set_bulk_parts(frame, flags)
+                for frame in self._frames(recs, _set_size)
+            ],
+            lambda conn: conn.read_count(MB_SET_BULK),
+            flags,
+            idempotent,
+        )
+        return _sum_counts(counts) if counts is not None else None
+
+    def get(self, key, db=0, flags=0):
+        """Get a single value, see KyotoTycoon.get"""
+        recs = self.get_bulk(((key, db),), flags)
+        if not recs:
+            return None
+        return recs[0][1]
+
+    def get_bulk_keys(self, keys, db=0, flags=0):
+        """Get the values of keys as dict, see KyotoTycoon.get_bulk_keys"""
+        recs = self.get_bulk(((key, db) for key in keys), flags)
+        return dict(((key, val) for key, val, db, xt in recs))
+
+    def get_bulk(self, recs, flags=0):
+        """Get records (key, db), see KyotoTycoon.get_bulk
+
+        :return: A list of records. Each record is a tuple of 4 entries:
+                 (key, val, db, expire)
+        """
+        parts = self._execute(
+            [
+                _keys_parts(MB_GET_BULK, frame, flags)
+                for frame in self._frames(recs, _key_size)
+            ],
+            lambda conn: conn.read_records(MB_GET_BULK),
+            flags & ~FLAG_NOREPLY,
+            True,
+        )
+        return [rec for part in parts for rec in part]
+
+    def remove(self, key, db, flags=0):
+        """Remove a single item, see KyotoTycoon.remove"""
+        return self.remove_bulk(((key, db),), flags)
+
+    def remove_bulk_keys(self, keys, db, flags=0):
+        """Remove keys of db, see KyotoTycoon.remove_bulk_keys"""
+        recs = ((key, db) for key in keys)
+        return self.remove_bulk(recs, flags)
+
+    def remove_bulk(self, recs, flags=0, idempotent=False):
+        """Remove records (key, db), see KyotoTycoon.remove_bulk
+
+        :return: The number of removed records, or None if flags was set to
+                 kyototycoon.FLAG_NOREPLY
+        """
+        counts = self._execute(
+            [
+                _keys_parts(MB_REMOVE_BULK, frame, flags)
+                for frame in self._frames(recs, _key_size)
+            ],
+            lambda conn: conn.read_count(MB_REMOVE_BULK),
+            flags,
+            idempotent,
+        )
+        return _sum_counts(counts) if counts is not None else None
+
+    def play_script(self, name, recs, flags=0, idempotent=False):
+        """Call a procedure of the LUA extension, see
+        KyotoTycoon.play_script"""
+        script = self._script(name)
+        res = self._execute(
+            [script.parts(script.encode(recs), flags)],
+            lambda conn: conn.read_script(MB_PLAY_SCRIPT),
+            flags,
+            idempotent or script.idempotent,
+        )
+        if res is None:
+            return None
+        return script.decode(res[0])
+
+    def play_script_many(self, name, calls, flags=0, idempotent=False):
+        """Call a procedure of the LUA extension many times, pipelined over
+        one connection, see KyotoTycoon.play_script_many"""
+        script = self._script(name)
+        requests = [
+            script.parts(script.encode(recs), flags) for recs in calls
+        ]
+        if not requests:
+            return []
+        res = self._execute(
+            requests,
+            lambda conn: conn.read_script(MB_PLAY_SCRIPT),
+            flags,
+            idempotent or script.idempotent,
+        )
+        if res is None:
+            return None
+        return [script.decode(recs) for recs in res]
+
+    def incr(self, key, delta=1):
+        """Atomically add delta to the counter key of the first database, see
+        KyotoTycoon.incr. Each call is one call of the incr procedure, the
+        increments are not merged.
+
+        :return: The value of the counter after this increment.
+        """
+        res = self.play_script(b"incr", [(key, str(delta).encode("ascii"))])
+        return int(dict(res)[key])
+
+    def scan(
+            self,
+            prefix=None,
+            db=0,
+            batch=1000,
+            values=False,
+            ordered=False,
+    ):
+        """Generator over the keys of a database starting with prefix, see
+        KyotoTycoon.scan"""
+        args = _scan_args(prefix, db, batch, values, ordered)
+        cursor = None
+        while True:
+            if cursor is None:
+                res = self.play_script("scan", args, idempotent=True)
+            else:
+                try:
+                    res = self.play_script(
+                        "scan", args + [(b"cursor", cursor)], idempotent=True
+                    )
+                except KyotoTycoonError as exc:
+                    raise _scan_error(cursor, exc)
+            recs, cursor = _scan_batch(res, values)
+            for rec in recs:
+                yield rec
+            if cursor is None:
+                return
+
+    def _frames(self, recs, size):
+        """The frames of a bulk call"""
+        frames = self._split(recs, size)
+        if frames is None:
+            return [recs]
+        return frames
+
+    def _execute(self, requests, read, flags=0, idempotent=False):
+        """Send requests (lists of parts) pipelined over a pooled connection
+        and read each reply with read(connection).
+
+        Requests failing because of a broken connection are retried like in
+        KyotoTycoon._execute.
+
+        :return: The list of replies or None if flags was set to
+                 kyototycoon.FLAG_NOREPLY.
+        """
+        attempt = 0
+        while True:
+            sent = []
+            try:
+                return self._send(requests, read, flags, sent)
+            except RETRY_ERRORS as exc:
+                if sent:
+                    self._flush_connections()
+                if attempt >= self.retries or (sent and not idempotent):
+                    raise
+                delay = random.uniform(0, min(
+                    self.retry_backoff_max,
+                    self.retry_backoff * 2 ** attempt
+                ))
+                attempt += 1
+                _l().warning("Retrying request in %.3fs: %r", delay, exc)
+                time.sleep(delay)
+
+    def _send(self, requests, read, flags, sent):
+        """One attempt of _execute, appends to sent once data was sent"""
+        with self.slots:
+            conn = self._pop_connection()
+            try:
+                replies = []
+                pending = 0
+                for request in requests:
+                    if not sent:
+                        sent.append(True)
+                    conn.send(request)
+                    if flags & FLAG_NOREPLY:
+                        continue
+                    pending += 1
+                    if pending >= self.pipeline_depth:
+                        replies.append(read(conn))
+                        pending -= 1
+                for _ in range(pending):
+                    replies.append(read(conn))
+            except BaseException:
+                conn.close()
+                raise
+            conn.shrink()
+            self._push_connection(conn)
+        if flags & FLAG_NOREPLY:
+            return None
+        return replies
+
+    def _pop_connection(self):
+        """Get a pooled connection or connect"""
+        with self.lock:
+            if self.free_connections:
+                return self.free_connections.pop()
+        sock = _connect(self.host, self.port, self.unix_path, self.timeout)
+        try:
+            self.socket_options.apply_socket(sock)
+        except BaseException:
+            sock.close()
+            raise
+        return _Connection(sock, self.buffer_size)
+
+    def _push_connection(self, conn):
+        """Return a used connection"""
+        with self.lock:
+            self.free_connections.append(conn)
+
+    def _flush_connections(self):
+        """Close the pooled connections"""
+        with self.lock:
+            conns, self.free_connections = self.free_connections, []
+        for conn in conns:
+            conn.close()
+
+    def close(self):
+        """Close the sockets"""
+        self._flush_connections()
+
+
+def read_traffic(path):
+    """Read the entries of a traffic log written by TrafficRecorder.
+
+    :param path: Path of the log.
+
+    :return: Iterator of TrafficEntry.
+    """
+    with open(path, "rb") as log:
+        if log.read(len(TRAFFIC_MAGIC)) != TRAFFIC_MAGIC:
+            raise KyotoTycoonError("%s is not a traffic log" % path)
+        while True:
+            head = log.read(_TRAFFIC.size)
+            if len(head) < _TRAFFIC.size:
+                break
+            timestamp, latency, response_size, size = _TRAFFIC.unpack(head)
+            request = log.read(size)
+            if len(request) < size:
+                break
+            yield TrafficEntry(timestamp, latency, response_size, request)
+
+
+def _split_frames(request):
+    """Split a recorded request into its frames, returns a list of
+    (magic, flags)"""
+    frames = []
+    offset = 0
+    while offset < len(request):
+        magic, flags, cnt = struct.unpack_from('!BII', request, offset)
+        offset += 9
+        if magic == MB_PLAY_SCRIPT:
+            name_size = cnt
+            cnt, = struct.unpack_from('!I', request, offset)
+            offset += 4 + name_size
+            for _ in range(cnt):
+                key_len, val_len = _SCRIPT_HEADER.unpack_from(request, offset)
+                offset += 8 + key_len + val_len
+        elif magic == MB_SET_BULK:
+            for _ in range(cnt):
+                _, key_len, val_len, _ = _HEADER.unpack_from(request, offset)
+                offset += 18 + key_len + val_len
+        elif magic in (MB_GET_BULK, MB_REMOVE_BULK):
+            for _ in range(cnt):
+                _, key_len = struct.unpack_from('!HI', request, offset)
+                offset += 6 + key_len
+        else:
+            raise KyotoTycoonError("Unknown request 0x%02x" % magic)
+        frames.append((magic, flags))
+    return frames
+
+
+async def _replay_entry(client, entry):
+    """Re-issue a recorded request"""
+    frames  = _split_frames(entry.request)
+    magics  = [magic for magic, flags in frames if not flags & FLAG_NOREPLY]
+    readers = []
+
+    async def read(sr, magic):
+        """Read the replies counting the bytes"""
+        reader = _CountingReader(sr)
+        readers.append(reader)
+        return (await client._read_replies(reader, magic, magics))
+        # pypy #raise Return((yield From(
+        # pypy #    client._read_replies(reader, magic, magics)
+        # pypy #)))
+
+    error = None
+    start = time.time()
+    try:
+        await client._execute(
+        # pypy #yield From(client._execute(
+            entry.request,
+            frames[0][0],
+            read,
+            0 if magics else FLAG_NOREPLY,
+        )
+        # pypy #))
+    except (KyotoTycoonError,) + RETRY_ERRORS as exc:
+        error = repr(exc)
+    return Replayed(
+    # pypy #raise Return(Replayed(
+        entry.timestamp,
+        frames[0][0],
+        entry.latency,
+        time.time() - start,
+        entry.response_size,
+        readers[-1].count if readers else 0,
+        error,
+    )
+    # pypy #))
+
+
+async def replay_traffic(client, paths, speed=1.0):
+    """Re-issue recorded traffic against the server of client.
+
+    :param client: KyotoTycoon connected to the target server.
+
+    :param paths: Paths of the traffic logs, oldest first.
+
+    :param speed: Replay at the recorded timing sped up by this factor,
+                  None sends the requests as fast as the pool allows.
+
+    :return: A list of Replayed comparing the recorded and the replayed
+             latency and response size of each request.
+    """
+    tasks = []
+    first = None
+    for path in paths:
+        for entry in read_traffic(path):
+            if speed:
+                if first is None:
+                    first = entry.timestamp
+                    start = client.loop.time()
+                delay = (
+                    start + (entry.timestamp - first) / speed -
+                    client.loop.time()
+                )
+                if delay > 0:
+                    await asyncio.sleep(delay)
+                    # pypy #yield From(asyncio.sleep(delay))
+            tasks.append(client.loop.create_task(
+                _replay_entry(client, entry)
+            ))
+    return list((await asyncio.gather(*tasks)))
+    # pypy #raise Return(list((yield From(asyncio.gather(*tasks)))))
+
+
+def summarize_replay(results):
+    """Compare the recorded and replayed latencies per opcode.
+
+    :param results: The result of replay_traffic.
+
+    :return: A dict mapping the opcode to a dict with the number of
+             requests, errors and the recorded and replayed p50 and p99
+             latencies in seconds.
+    """
+    by_magic = collections.defaultdict(list)
+    for res in results:
+        by_magic[res.magic].append(res)
+    summary = {}
+    for magic, replayed in by_magic.items():
+        recorded = [res.recorded_latency for res in replayed]
+        latency  = [res.latency for res in replayed]
+        summary[magic] = {
+            'count': len(replayed),
+            'errors': sum(1 for res in replayed if res.error),
+            'recorded_p50': _percentile(recorded, 50),
+            'recorded_p99': _percentile(recorded, 99),
+            'p50': _percentile(latency, 50),
+            'p99': _percentile(latency, 99),
+        }
+    return summary
+
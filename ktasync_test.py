@@ -33,6 +33,14 @@ except ImportError:  # pragma: no cover
 # except ImportError:  # pragma: no cover
 #     import mock
 
+import os
+import json
+import signal
+import socket
+import struct
+import tempfile
+import threading
+import warnings
 import ktasync
 try:
     import asyncio
@@ -49,6 +57,12 @@ class KtasyncTest(unittest.TestCase):
     def test_just_connect(self):
         self.assertIsInstance(self.client, ktasync.KyotoTycoon)
 
+    def test_embedded_ready(self):
+        server = self.client.server
+        self.assertIsInstance(server, ktasync.EmbeddedServer)
+        self.assertIsNotNone(server.startup_time)
+        self.assertIsNone(server.proc.poll())
+
     def test_set(self):
         self.assertIsInstance(self.client, ktasync.KyotoTycoon)
         self.loop.run_until_complete(
@@ -65,4 +79,1078 @@ class KtasyncTest(unittest.TestCase):
         )
         self.assertEqual(val, b"best")
 
+    def test_socket_options(self):
+        client = ktasync.KyotoTycoon(
+            host=self.client.host,
+            port=self.client.port,
+            socket_options=ktasync.SocketOptions(
+                rcvbuf=2 ** 20, keepalive=True, limit=2 ** 20
+            ),
+        )
+        self.loop.run_until_complete(client.set(b"huhu", b"opts", 0))
+        _, sw = client.free_streams[0]
+        sock = sw.get_extra_info("socket")
+        self.assertTrue(
+            sock.getsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY)
+        )
+        self.assertTrue(
+            sock.getsockopt(socket.SOL_SOCKET, socket.SO_KEEPALIVE)
+        )
+        client.close()
+
+    def test_socket_options_failed(self):
+        class Failing(ktasync.SocketOptions):
+            def apply(self, sw):
+                self.sw = sw
+                raise OSError("apply failed")
+
+        options = Failing()
+        client = ktasync.KyotoTycoon(
+            host=self.client.host,
+            port=self.client.port,
+            socket_options=options,
+            retries=0,
+        )
+        with self.assertRaises(OSError):
+            self.loop.run_until_complete(client.set(b"huhu", b"opts", 0))
+        self.assertTrue(options.sw.is_closing())
+        self.assertEqual(client.lanes.total, 0)
+        client.close()
+
+    def test_get_bulk(self):
+        self.loop.run_until_complete(
+            self.client.set_bulk_kv({b"bulk1": b"one", b"bulk2": b"two"}, 0)
+        )
+        res = self.loop.run_until_complete(
+            self.client.get_bulk_keys([b"bulk1", b"bulk2", b"nope"], 0)
+        )
+        self.assertEqual(res, {b"bulk1": b"one", b"bulk2": b"two"})
+
+    def test_byte_budget(self):
+        client = ktasync.KyotoTycoon(
+            host=self.client.host,
+            port=self.client.port,
+            max_inflight_bytes=2 ** 16,
+        )
+        recs = [(b"budget", b"x" * 2 ** 15, 0, ktasync.DEFAULT_EXPIRE)]
+        self.loop.run_until_complete(asyncio.gather(
+            *[client.set_bulk(recs) for _ in range(4)]
+        ))
+        stats = client.byte_budget.stats()
+        self.assertEqual(stats["in_flight"], 0)
+        self.assertLessEqual(stats["peak"], 2 ** 16)
+        self.assertGreater(stats["waits"], 0)
+        client.close()
+
+    def test_split(self):
+        client = ktasync.KyotoTycoon(
+            host=self.client.host,
+            port=self.client.port,
+            max_frame_records=2,
+        )
+        keys = [("split%d" % i).encode() for i in range(5)]
+        count = self.loop.run_until_complete(
+            client.set_bulk_kv(dict((key, key) for key in keys), 0)
+        )
+        self.assertEqual(count, 5)
+        recs = self.loop.run_until_complete(
+            client.get_bulk((key, 0) for key in keys)
+        )
+        self.assertEqual([rec[0] for rec in recs], keys)
+        recs = self.loop.run_until_complete(
+            client.get_bulk(((key, 0) for key in keys), columnar=True)
+        )
+        self.assertEqual([bytes(rec[1]) for rec in recs], keys)
+        count = self.loop.run_until_complete(
+            client.remove_bulk_keys(keys, 0)
+        )
+        self.assertEqual(count, 5)
+        client.close()
+
+    def test_hot_keys(self):
+        client = ktasync.KyotoTycoon(
+            host=self.client.host,
+            port=self.client.port,
+            hot_keys=ktasync.HotKeys(sample_every=1),
+        )
+        for _ in range(3):
+            self.loop.run_until_complete(client.get(b"hot", 0))
+        self.loop.run_until_complete(client.set(b"hot", b"x", 0))
+        top = client.hot_keys.top(magic=ktasync.MB_GET_BULK)
+        self.assertEqual(top[0].key, b"hot")
+        self.assertEqual(top[0].count, 3)
+        client.close()
+
+    def test_play_script(self):
+        client = ktasync.KyotoTycoon.embedded(
+            name='scripts',
+            config=ktasync.EmbeddedConfig(records=1000, scripts=True),
+        )
+        res = self.loop.run_until_complete(
+            client.play_script("echo", [(b"a", b"1"), (b"b", b"2")])
+        )
+        self.assertEqual(sorted(res), [(b"a", b"1"), (b"b", b"2")])
+        client.register_script(
+            "echo", ktasync.encode_dict, ktasync.decode_dict, True
+        )
+        calls = [
+            {("k%d" % i).encode(): str(i).encode()} for i in range(10)
+        ]
+        res = self.loop.run_until_complete(
+            client.play_script_many("echo", calls)
+        )
+        self.assertEqual(res, calls)
+        client.close()
+
+    def test_incr(self):
+        client = ktasync.KyotoTycoon.embedded(
+            name='scripts',
+            config=ktasync.EmbeddedConfig(records=1000, scripts=True),
+        )
+        res = self.loop.run_until_complete(asyncio.gather(
+            client.incr(b"counter"),
+            client.incr(b"counter", 5),
+            client.incr(b"other", 2),
+            client.incr(b"counter", -1),
+        ))
+        self.assertEqual(res, [1, 6, 2, 5])
+        val = self.loop.run_until_complete(client.get(b"counter", 0))
+        self.assertEqual(val, b"\x00" * 7 + b"\x05")
+        client.close()
+
+    def test_incr_close(self):
+        server = ktasync.KyotoTycoon.embedded(
+            name='scripts',
+            config=ktasync.EmbeddedConfig(records=1000, scripts=True),
+        )
+        client = ktasync.KyotoTycoon(
+            host=server.host, port=server.port, counter_window=10
+        )
+        # Pending in the window
+        task = self.loop.create_task(client.incr(b"closed"))
+        self.loop.run_until_complete(asyncio.sleep(0))
+        client.close()
+        self.loop.run_until_complete(asyncio.sleep(0))
+        self.assertTrue(task.cancelled())
+        # In flight
+        task = self.loop.create_task(client.incr(b"closed"))
+        self.loop.run_until_complete(asyncio.sleep(0))
+        client.counters.flush()
+        self.assertEqual(len(client.counters.tasks), 1)
+        client.close()
+        self.loop.run_until_complete(asyncio.sleep(0.01))
+        self.assertTrue(task.cancelled())
+        self.assertEqual(client.counters.tasks, {})
+
+    def test_scan(self):
+        client = ktasync.KyotoTycoon.embedded(
+            name='scripts',
+            config=ktasync.EmbeddedConfig(records=1000, scripts=True),
+        )
+        kv = dict(
+            (("scan%02d" % i).encode(), str(i).encode()) for i in range(25)
+        )
+        self.loop.run_until_complete(client.set_bulk_kv(kv, 0))
+        self.loop.run_until_complete(client.set(b"other", b"x", 0))
+        scan = client.scan(b"scan", batch=10)
+        batches = []
+        while True:
+            batch = self.loop.run_until_complete(scan.next_batch())
+            if not batch:
+                break
+            batches.append(batch)
+        self.assertEqual([len(batch) for batch in batches], [10, 10, 5])
+        self.assertEqual(sorted(sum(batches, [])), sorted(kv))
+        scan = client.scan(b"scan", batch=7, values=True, ordered=True)
+        recs = self.loop.run_until_complete(scan.next_batch())
+        self.assertEqual(recs[0], (b"scan00", b"0"))
+        scan.close()
+        sync = ktasync.SyncKyotoTycoon(host=client.host, port=client.port)
+        self.assertEqual(
+            dict(sync.scan(b"scan", batch=7, values=True)), kv
+        )
+        sync.close()
+        client.close()
+
+    def test_scan_removed_cursor(self):
+        client = ktasync.KyotoTycoon.embedded(
+            name='scan_removed',
+            config=ktasync.EmbeddedConfig(records=1000, scripts=True),
+        )
+        kv = dict(
+            (("lost%02d" % i).encode(), str(i).encode()) for i in range(25)
+        )
+        self.loop.run_until_complete(client.set_bulk_kv(kv, 0))
+        scan = client.scan(batch=10)
+        self.loop.run_until_complete(scan.next_batch())
+        self.loop.run_until_complete(client.remove_bulk_keys(list(kv), 0))
+        with self.assertRaises(ktasync.KyotoTycoonError):
+            while self.loop.run_until_complete(scan.next_batch()):
+                pass
+        self.loop.run_until_complete(client.set_bulk_kv(kv, 0))
+        sync = ktasync.SyncKyotoTycoon(host=client.host, port=client.port)
+        keys = sync.scan(batch=10)
+        first = [next(keys) for _ in range(10)]
+        sync.remove_bulk_keys(first, 0)
+        with self.assertRaises(ktasync.KyotoTycoonError):
+            list(keys)
+        sync.close()
+        client.close()
+
+    def test_replay(self):
+        fd, path = tempfile.mkstemp(prefix="ktasync", suffix=".log")
+        os.close(fd)
+        client = ktasync.KyotoTycoon(
+            host=self.client.host,
+            port=self.client.port,
+            recorder=ktasync.TrafficRecorder(path),
+        )
+        self.loop.run_until_complete(client.set(b"rec", b"val", 0))
+        self.loop.run_until_complete(client.get(b"rec", 0))
+        client.close()
+        entries = list(ktasync.read_traffic(path))
+        self.assertEqual(len(entries), 2)
+        self.assertEqual(entries[1].response_size, 5 + 18 + 6)
+        res = self.loop.run_until_complete(
+            ktasync.replay_traffic(self.client, [path], speed=10)
+        )
+        os.remove(path)
+        self.assertEqual(
+            [r.magic for r in res],
+            [ktasync.MB_SET_BULK, ktasync.MB_GET_BULK],
+        )
+        self.assertEqual(res[1].size, 5 + 18 + 6)
+        self.assertIsNone(res[1].error)
+        summary = ktasync.summarize_replay(res)
+        self.assertEqual(summary[ktasync.MB_GET_BULK]["count"], 1)
+
+    def test_l2_cache(self):
+        tmp = tempfile.mkdtemp(prefix="ktasync")
+        cache = ktasync.DiskCache(os.path.join(tmp, "cache"))
+        client = ktasync.KyotoTycoon(
+            host=self.client.host, port=self.client.port, l2_cache=cache
+        )
+        self.loop.run_until_complete(client.set(b"l2", b"one", 0))
+        self.loop.run_until_complete(
+            self.client.set(b"l2", b"changed elsewhere", 0)
+        )
+        val = self.loop.run_until_complete(client.get(b"l2", 0))
+        self.assertEqual(val, b"one")
+        self.assertEqual(cache.stats()["hits"], 1)
+        self.loop.run_until_complete(client.remove(b"l2", 0))
+        val = self.loop.run_until_complete(client.get(b"l2", 0))
+        self.assertIsNone(val)
+        client.close()
+        cache.close()
+        for name in os.listdir(tmp):
+            os.remove(os.path.join(tmp, name))
+        os.rmdir(tmp)
+
+    def test_flight_recorder(self):
+        flight = ktasync.FlightRecorder(threshold=0, size=2)
+        client = ktasync.KyotoTycoon(
+            host=self.client.host,
+            port=self.client.port,
+            flight_recorder=flight,
+        )
+        self.loop.run_until_complete(client.set(b"flight", b"val", 0))
+        self.loop.run_until_complete(
+            client.get_bulk_keys([b"flight", b"nope"], 0)
+        )
+        self.loop.run_until_complete(client.get(b"flight", 0))
+        entries = flight.entries()
+        self.assertEqual(flight.slow, 3)
+        self.assertEqual(len(entries), 2)
+        self.assertEqual(entries[0].magic, ktasync.MB_GET_BULK)
+        self.assertEqual(entries[0].records, 2)
+        self.assertEqual(entries[0].connect, 0)
+        self.assertEqual(entries[1].response_size, 5 + 18 + 6 + 3)
+        self.assertGreater(entries[1].connection_age, 0)
+        self.assertIsNone(entries[1].error)
+        fd, path = tempfile.mkstemp(prefix="ktasync", suffix=".json")
+        os.close(fd)
+        old = flight.install_signal(signal.SIGUSR1, path)
+        try:
+            os.kill(os.getpid(), signal.SIGUSR1)
+        finally:
+            signal.signal(signal.SIGUSR1, old)
+        with open(path) as dump:
+            lines = [json.loads(line) for line in dump]
+        os.remove(path)
+        self.assertEqual(lines[1]["records"], 1)
+        client.close()
+
+    def test_flight_recorder_connect(self):
+        flight = ktasync.FlightRecorder(threshold=60)
+        client = ktasync.KyotoTycoon(
+            host=self.client.host,
+            port=ktasync._free_port(self.client.host),
+            flight_recorder=flight,
+            retries=0,
+        )
+        with self.assertRaises(OSError):
+            self.loop.run_until_complete(client.get(b"flight", 0))
+        entry, = flight.entries()
+        self.assertIn("Error", entry.error)
+        self.assertEqual(entry.response_size, 0)
+        self.assertEqual(entry.read, 0)
+        self.assertEqual(client.lanes.total, 0)
+        client.close()
+
+    def test_offload(self):
+        pool = ktasync.DecodePool(processes=2, decode=int, min_records=4)
+        kv = dict(
+            (("off%d" % i).encode(), str(i).encode()) for i in range(10)
+        )
+        self.loop.run_until_complete(self.client.set_bulk_kv(kv, 0))
+        for keys in (sorted(kv)[:3], sorted(kv)):
+            res = self.loop.run_until_complete(
+                self.client.get_bulk_keys(keys, 0, offload=pool)
+            )
+            self.assertEqual(res, dict((key, int(kv[key])) for key in keys))
+        res = self.loop.run_until_complete(self.client.get_bulk_keys(
+            sorted(kv), 0, columnar=True, offload=pool
+        ))
+        self.assertIsInstance(res, ktasync.ColumnarRecords)
+        self.assertEqual(
+            dict((bytes(key), bytes(val)) for key, val, _, _ in res), kv
+        )
+        del res
+        # Replies larger than the shared memory estimate and the chunks
+        big = dict(
+            (("big%d" % i).encode(), str(i).encode() * 2 ** 17)
+            for i in range(1, 10)
+        )
+        self.loop.run_until_complete(self.client.set_bulk_kv(big, 0))
+        res = self.loop.run_until_complete(self.client.get_bulk_keys(
+            sorted(big), 0, columnar=True, offload=pool
+        ))
+        self.assertEqual(
+            dict((bytes(key), bytes(val)) for key, val, _, _ in res), big
+        )
+        del res
+        pool.close()
+
+    def _cancel_written(self, client, task):
+        """Cancel task once its request is written, before the reply is
+        read in its own task"""
+        roundtrip = client._roundtrip
+
+        def cancel(*args):
+            task.cancel()
+            return roundtrip(*args)
+
+        client._roundtrip = cancel
+
+    def test_cancel_before_write(self):
+        client = ktasync.KyotoTycoon(
+            host=self.client.host, port=self.client.port
+        )
+        sent = []
+        client._send = lambda *args: sent.append(args)
+        task = self.loop.create_task(client.get_bulk_keys([b"drain"]))
+        # Cancel while the connection is opened
+        self.loop.run_until_complete(asyncio.sleep(0))
+        task.cancel()
+        self.loop.run_until_complete(asyncio.sleep(0.05))
+        self.assertTrue(task.cancelled())
+        self.assertEqual(sent, [])
+        self.assertEqual(client.drains, 0)
+        self.assertEqual(client.lanes.total, 0)
+        client.close()
+
+    def test_default_lane(self):
+        client = ktasync.KyotoTycoon(
+            host=self.client.host, port=self.client.port
+        )
+        lanes = client.lanes
+        acquired = []
+        acquire = lanes.acquire
+        lanes.acquire = lambda lane: acquired.append(lane) or acquire(lane)
+        self.loop.run_until_complete(client.get(b"lane"))
+        self.loop.run_until_complete(client.get(
+            b"lane", priority=ktasync.PRIORITY_INTERACTIVE
+        ))
+        self.assertEqual(
+            acquired, [ktasync.PRIORITY_BATCH, ktasync.PRIORITY_INTERACTIVE]
+        )
+        client.close()
+
+    def test_cancel_drains(self):
+        keys = [("drain%d" % i).encode() for i in range(20)]
+        self.loop.run_until_complete(self.client.set_bulk_kv(
+            dict((key, b"x" * 2 ** 14) for key in keys)
+        ))
+        for drain_bytes, streams, failures in ((2 ** 20, 1, 0), (16, 0, 1)):
+            client = ktasync.KyotoTycoon(
+                host=self.client.host,
+                port=self.client.port,
+                drain_bytes=drain_bytes,
+            )
+            task = self.loop.create_task(client.get_bulk_keys(keys))
+            self._cancel_written(client, task)
+            self.loop.run_until_complete(asyncio.sleep(0.05))
+            self.assertTrue(task.cancelled())
+            self.assertEqual(client.drains, 1)
+            self.assertEqual(client.drain_failures, failures)
+            self.assertEqual(len(client.free_streams), streams)
+            self.assertEqual(client.lanes.total, 0)
+            client.close()
+
+    @unittest.skipUnless(os.path.isdir("/dev/shm"), "needs /dev/shm")
+    def test_cancel_offload(self):
+        def segments():
+            return set(
+                name for name in os.listdir("/dev/shm")
+                if name.startswith("psm_")
+            )
+
+        keys = [("drain%d" % i).encode() for i in range(20)]
+        self.loop.run_until_complete(self.client.set_bulk_kv(
+            dict((key, b"x" * 2 ** 10) for key in keys)
+        ))
+        pool = ktasync.DecodePool(processes=1)
+        client = ktasync.KyotoTycoon(
+            host=self.client.host, port=self.client.port
+        )
+        before = segments()
+        task = self.loop.create_task(client.get_bulk_keys(keys, offload=pool))
+        self._cancel_written(client, task)
+        self.loop.run_until_complete(asyncio.sleep(0.05))
+        self.assertTrue(task.cancelled())
+        self.assertEqual(client.drains, 1)
+        self.assertEqual(len(client.free_streams), 1)
+        self.assertEqual(segments(), before)
+        client.close()
+        pool.close()
+
+    def test_loops(self):
+        client = ktasync.KyotoTycoon(
+            host=self.client.host, port=self.client.port
+        )
+        self.loop.run_until_complete(client.set(b"loops", b"main", 0))
+        result = {}
+
+        def other():
+            loop = asyncio.new_event_loop()
+            asyncio.set_event_loop(loop)
+            result["val"] = loop.run_until_complete(client.get(b"loops", 0))
+            result["lanes"] = client.lanes
+            result["streams"] = len(client.free_streams)
+            client.close()
+            loop.close()
+            asyncio.set_event_loop(None)
+
+        thread = threading.Thread(target=other)
+        thread.start()
+        thread.join()
+        self.assertEqual(result["val"], b"main")
+        self.assertEqual(result["streams"], 1)
+        self.assertIsNot(result["lanes"], client.lanes)
+        self.assertEqual(len(client.free_streams), 1)
+        self.assertEqual(len(client.states), 2)
+        # The other thread did not replace the cached state of this one
+        self.assertIs(client.local.state.loop, self.loop)
+        client.close()
+        self.assertEqual(list(client.states), [self.loop])
+        client.close()
+
+    def test_get_bulk_columnar(self):
+        self.loop.run_until_complete(
+            self.client.set_bulk_kv({b"col1": b"one", b"col2": b"two"}, 0)
+        )
+        res = self.loop.run_until_complete(
+            self.client.get_bulk_keys(
+                [b"col1", b"col2", b"nope"], 0, columnar=True
+            )
+        )
+        self.assertIsInstance(res, ktasync.ColumnarRecords)
+        self.assertEqual(len(res), 2)
+        self.assertEqual(
+            sorted((bytes(key), bytes(val)) for key, val, _, _ in res),
+            [(b"col1", b"one"), (b"col2", b"two")]
+        )
+        self.assertIsInstance(res.value(0), memoryview)
+
+
+class UnixSocketTest(unittest.TestCase):
+    def setUp(self):
+        self.loop = asyncio.get_event_loop()
+        self.path = os.path.join(tempfile.mkdtemp(), "ktserver.sock")
+        self.client = ktasync.KyotoTycoon.embedded(
+            name="test_unix", unix_path=self.path
+        )
+
+    def tearDown(self):
+        self.client.close()
+
+    def test_set_get(self):
+        self.assertEqual(self.client.unix_path, self.path)
+        self.loop.run_until_complete(
+            self.client.set(b"huhu", b"unix", 0)
+        )
+        val = self.loop.run_until_complete(
+            self.client.get(b"huhu", 0)
+        )
+        self.assertEqual(val, b"unix")
+
+
+class EmbeddedConfigTest(unittest.TestCase):
+    def test_memhash(self):
+        config = ktasync.EmbeddedConfig(
+            records=1000, memory=2 ** 20, threads=4
+        )
+        self.assertEqual(
+            config.server_args(),
+            ['-th', '4', '*#bnum=2000#capsiz=1048576']
+        )
+
+    def test_tree(self):
+        config = ktasync.EmbeddedConfig(
+            'tree', path='data', records=1000, memory=2 ** 20, opts='c'
+        )
+        self.assertEqual(
+            config.db_spec(),
+            'data.kct#bnum=100#msiz=524288#pccap=524288#opts=c'
+        )
+
+    def test_invalid(self):
+        with self.assertRaises(ktasync.KyotoTycoonError):
+            ktasync.EmbeddedConfig('btree')
+        with self.assertRaises(ktasync.KyotoTycoonError):
+            ktasync.EmbeddedConfig('hash')
+
+    def test_scripts(self):
+        config = ktasync.EmbeddedConfig(threads=4, scripts=True)
+        args = config.server_args()
+        self.assertEqual(args[2], '-scr')
+        with open(args[3]) as script:
+            self.assertEqual(script.read(), ktasync.LUA_PROCEDURES)
+        os.remove(args[3])
+        self.assertIs(config.scripts, True)
+
+    def test_scripts_removed(self):
+        client = ktasync.KyotoTycoon.embedded(
+            name="test_scripts",
+            config=ktasync.EmbeddedConfig(scripts=True),
+        )
+        script, = client.server.temp_files
+        self.assertTrue(os.path.exists(script))
+        client.close()
+        client.server.stop()
+        self.assertFalse(os.path.exists(script))
+
+    def test_named(self):
+        client = ktasync.KyotoTycoon.embedded(
+            name="test_tree",
+            config=ktasync.EmbeddedConfig('memtree', records=100),
+        )
+        self.assertIs(
+            ktasync.KyotoTycoon.embedded(name="test_tree"), client
+        )
+        self.assertIsNot(ktasync.KyotoTycoon.embedded(), client)
+        client.close()
+
+    def test_port_range(self):
+        with warnings.catch_warnings(record=True) as caught:
+            warnings.simplefilter("always")
+            client = ktasync.KyotoTycoon.embedded(
+                name="test_range",
+                range_from=ktasync.RANGE_FROM,
+                range_to=ktasync.RANGE_TO,
+            )
+        self.assertIn(DeprecationWarning, [
+            warning.category for warning in caught
+            if "range_from" in str(warning.message)
+        ])
+        self.assertTrue(
+            ktasync.RANGE_FROM <= client.port <= ktasync.RANGE_TO
+        )
+        client.close()
+        client.server.stop()
+
+
+class LanesTest(unittest.TestCase):
+    def setUp(self):
+        self.loop = asyncio.get_event_loop()
+        self.lanes = ktasync._Lanes(2, (
+            (ktasync.PRIORITY_INTERACTIVE, 1),
+            (ktasync.PRIORITY_BATCH, 0),
+        ))
+
+    def acquire(self, lane):
+        return asyncio.ensure_future(self.lanes.acquire(lane))
+
+    def spin(self):
+        self.loop.run_until_complete(asyncio.sleep(0))
+
+    def test_reserved(self):
+        batch = [self.acquire(ktasync.PRIORITY_BATCH) for _ in range(2)]
+        self.spin()
+        self.assertTrue(batch[0].done())
+        self.assertFalse(batch[1].done())
+        inter = self.acquire(ktasync.PRIORITY_INTERACTIVE)
+        self.spin()
+        self.assertTrue(inter.done())
+        self.lanes.release(ktasync.PRIORITY_BATCH)
+        self.spin()
+        self.assertTrue(batch[1].done())
+
+    def test_priority_order(self):
+        batch = [self.acquire(ktasync.PRIORITY_BATCH)]
+        inter = [self.acquire(ktasync.PRIORITY_INTERACTIVE) for _ in range(2)]
+        self.spin()
+        batch.append(self.acquire(ktasync.PRIORITY_BATCH))
+        self.spin()
+        self.assertEqual(
+            self.lanes.waiting(),
+            {ktasync.PRIORITY_INTERACTIVE: 1, ktasync.PRIORITY_BATCH: 1}
+        )
+        self.lanes.release(ktasync.PRIORITY_BATCH)
+        self.spin()
+        self.assertTrue(inter[1].done())
+        self.assertFalse(batch[1].done())
+        batch[1].cancel()
+        self.spin()
+        self.assertEqual(self.lanes.waiting()[ktasync.PRIORITY_BATCH], 0)
+
+    def test_starve(self):
+        with self.assertRaises(ktasync.KyotoTycoonError):
+            ktasync._Lanes(1, (("a", 1), ("b", 0)))
+        with self.assertRaises(ktasync.KyotoTycoonError):
+            ktasync._Lanes(4, (("a", 2), ("b", 2), ("c", 0)))
+
+    def test_over_reserved(self):
+        with self.assertRaises(ktasync.KyotoTycoonError):
+            ktasync._Lanes(2, (("a", 2), ("b", 2)))
+        with self.assertRaises(ktasync.KyotoTycoonError):
+            ktasync._Lanes(4, (("a", 3), ("b", 3)))
+        lanes = ktasync._Lanes(4, (("a", 2), ("b", 2)))
+        self.assertEqual(lanes.reserved, {"a": 2, "b": 2})
+
+
+class SplitTest(unittest.TestCase):
+    def test_split(self):
+        client = ktasync.KyotoTycoon(max_frame_records=3, max_frame_bytes=30)
+        frames = client._split(
+            ((b"k", b"v" * size) for size in (1, 1, 1, 1, 15, 1)),
+            lambda rec: len(rec[1]),
+        )
+        self.assertEqual(
+            [[len(rec[1]) for rec in frame] for frame in frames],
+            [[1, 1, 1], [1, 15, 1]]
+        )
+
+    def test_disabled(self):
+        client = ktasync.KyotoTycoon()
+        self.assertIsNone(client._split([], len))
+
+
+class MigratorTest(unittest.TestCase):
+    def setUp(self):
+        self.loop = asyncio.get_event_loop()
+        self.source = ktasync.KyotoTycoon.embedded(name="migrate_source")
+        self.dests = [
+            ktasync.KyotoTycoon.embedded(
+                name="%s_%d" % (self._testMethodName, i)
+            )
+            for i in range(2)
+        ]
+        self.keys = [("migrate%d" % i).encode() for i in range(50)]
+        self.loop.run_until_complete(self.source.set_bulk_kv(
+            dict((key, key * 2) for key in self.keys), 0
+        ))
+        self.tmp = tempfile.mkdtemp(prefix="ktasync")
+        self.checkpoint = os.path.join(self.tmp, "checkpoint")
+
+    def tearDown(self):
+        if os.path.exists(self.checkpoint):
+            os.remove(self.checkpoint)
+        os.rmdir(self.tmp)
+
+    def _migrator(self, **kwargs):
+        return ktasync.Migrator(
+            self.source,
+            self.dests,
+            shard=lambda key: len(key) % 2,
+            batch=7,
+            checkpoint=self.checkpoint,
+            sample_rate=1.0,
+            **kwargs
+        )
+
+    def test_migrate(self):
+        migrator = self._migrator(chunk_bytes=100)
+        stats = self.loop.run_until_complete(migrator.migrate(self.keys))
+        self.assertEqual(stats["offset"], 50)
+        self.assertEqual(stats["records"], 50)
+        self.assertEqual(
+            self.loop.run_until_complete(migrator.verify()), []
+        )
+        key = self.keys[-1]
+        val = self.loop.run_until_complete(
+            self.dests[len(key) % 2].get(key, 0)
+        )
+        self.assertEqual(val, key * 2)
+
+    def test_resume(self):
+        migrator = self._migrator()
+        migrator.offset = 21
+        migrator.records = 21
+        migrator._save_checkpoint()
+        stats = self.loop.run_until_complete(
+            self._migrator().migrate(self.keys)
+        )
+        self.assertEqual(stats["offset"], 50)
+        self.assertEqual(stats["records"], 50)
+        val = self.loop.run_until_complete(
+            self.dests[0].get(self.keys[0], 0)
+        )
+        self.assertIsNone(val)
+
+    def test_failure(self):
+        def shard(key):
+            if key == self.keys[20]:
+                raise ValueError(key)
+            return len(key) % 2
+
+        migrator = self._migrator()
+        migrator.shard = shard
+        with self.assertRaises(ValueError):
+            self.loop.run_until_complete(migrator.migrate(self.keys))
+        stats = migrator.stats()
+        # The other workers stopped with migrate
+        self.loop.run_until_complete(asyncio.sleep(0.05))
+        self.assertEqual(migrator.stats(), stats)
+        self.assertLessEqual(stats["offset"], 14)
+        self.assertEqual(stats["records"], stats["offset"])
+        if os.path.exists(self.checkpoint):
+            with open(self.checkpoint) as state_file:
+                state = json.load(state_file)
+            self.assertEqual(state["records"], state["offset"])
+
+
+class HotKeysTest(unittest.TestCase):
+    def test_space_saving(self):
+        sketch = ktasync.SpaceSaving(2)
+        for key in (b"a", b"a", b"b", b"c", b"a"):
+            sketch.add(key, 1)
+        self.assertEqual(sketch.top(1), [(b"a", 3, 0, 3)])
+        self.assertEqual(sketch.top(2)[1], (b"c", 2, 1, 1))
+
+    def test_observe(self):
+        hot = ktasync.HotKeys(sample_every=2, capacity=4)
+        recs = [(b"hot", 0), (b"cold", 1)] * 5
+        hot.observe(ktasync.MB_GET_BULK, recs, 1)
+        top = hot.top(2)
+        self.assertEqual(top[0].key, b"hot")
+        self.assertEqual(top[0].count, 10)
+        self.assertEqual(top[0].bytes, 30)
+        self.assertEqual(hot.top(db=1), [])
+        self.assertEqual(hot.top(magic=ktasync.MB_SET_BULK), [])
+
+
+class ByteBudgetTest(unittest.TestCase):
+    def setUp(self):
+        self.loop = asyncio.get_event_loop()
+        self.budget = ktasync.ByteBudget(100)
+
+    def spin(self):
+        self.loop.run_until_complete(asyncio.sleep(0))
+
+    def test_wait(self):
+        first = asyncio.ensure_future(self.budget.acquire(80))
+        second = asyncio.ensure_future(self.budget.acquire(30))
+        self.spin()
+        self.assertTrue(first.done())
+        self.assertFalse(second.done())
+        self.assertEqual(self.budget.stats()["waiting"], 1)
+        self.budget.release(80)
+        self.spin()
+        self.assertTrue(second.done())
+        self.assertEqual(self.budget.in_flight, 30)
+        self.assertEqual(self.budget.peak, 80)
+
+    def test_oversized(self):
+        self.loop.run_until_complete(self.budget.acquire(500))
+        self.assertEqual(self.budget.in_flight, 500)
+        self.budget.release(500)
+        self.assertEqual(self.budget.stats()["waits"], 0)
+
+    def test_response_charge(self):
+        client = ktasync.KyotoTycoon()
+        sr = asyncio.StreamReader()
+        sr.feed_data(
+            struct.pack('!BI', ktasync.MB_GET_BULK, 1) +
+            struct.pack('!HIIq', 0, 1, 64, 0) + b"k" + b"v" * 64
+        )
+        # The reply is 48 bytes larger than expected
+        charge = ktasync._ResponseCharge(
+            self.budget, 5 + 18 + 1 + 16, client._read_keys
+        )
+        res = self.loop.run_until_complete(
+            charge(sr, ktasync.MB_GET_BULK)
+        )
+        self.assertEqual(res, [(b"k", b"v" * 64, 0, 0)])
+        self.assertEqual(self.budget.in_flight, 48)
+        charge.release()
+        self.assertEqual(self.budget.in_flight, 0)
+        charge.add(10)
+        self.assertEqual(self.budget.in_flight, 0)
+
+
+class HedgingTest(unittest.TestCase):
+    def setUp(self):
+        self.loop = asyncio.get_event_loop()
+
+    def test_learned_delay(self):
+        hedge = ktasync.Hedging(None, min_samples=10)
+        self.assertIsNone(hedge.current_delay())
+        for i in range(100):
+            hedge.observe(i / 1000.0)
+        self.assertEqual(hedge.current_delay(), 0.095)
+        self.assertFalse(hedge.may_hedge())
+
+    def test_without_delay(self):
+        replica = ktasync.KyotoTycoon.embedded()
+        client = ktasync.KyotoTycoon(
+            host=replica.host,
+            port=replica.port,
+            hedge=ktasync.Hedging(replica),
+        )
+        tasks = []
+        create_task = self.loop.create_task
+        self.loop.create_task = lambda coro: tasks.append(
+            coro.__name__
+        ) or create_task(coro)
+        try:
+            self.loop.run_until_complete(client.get(b"hedged", 0))
+        finally:
+            del self.loop.create_task
+        self.assertNotIn("_execute", tasks)
+        self.assertEqual(len(client.hedge.latencies), 1)
+        client.close()
+
+    def test_stalled_primary(self):
+        # Connections wait in the backlog, requests are never answered
+        stalled = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+        stalled.bind(("127.0.0.1", 0))
+        stalled.listen(8)
+        port = stalled.getsockname()[1]
+        replica = ktasync.KyotoTycoon.embedded()
+        self.loop.run_until_complete(replica.set(b"hedged", b"val", 0))
+        client = ktasync.KyotoTycoon(
+            host="127.0.0.1",
+            port=port,
+            hedge=ktasync.Hedging(replica, delay=0.01, budget=1.0),
+            drain_timeout=0.05,
+        )
+        val = self.loop.run_until_complete(client.get(b"hedged", 0))
+        self.assertEqual(val, b"val")
+        self.assertEqual(client.hedge.stats()["wins"], 1)
+        # The cancelled primary took at least the delay
+        latency, = client.hedge.latencies
+        self.assertGreaterEqual(latency, 0.01)
+        # The loser drains until the timeout closes its connection
+        self.assertEqual(client.lanes.total, 1)
+        self.loop.run_until_complete(asyncio.sleep(0.1))
+        self.assertEqual(client.lanes.total, 0)
+        self.assertEqual(client.free_streams, [])
+        self.assertEqual(client.drain_failures, 1)
+        stalled.close()
+
+
+class SyncTest(unittest.TestCase):
+    def setUp(self):
+        embedded = ktasync.KyotoTycoon.embedded()
+        self.client = ktasync.SyncKyotoTycoon(
+            host=embedded.host,
+            port=embedded.port,
+            max_frame_records=3,
+            pipeline_depth=2,
+        )
+
+    def tearDown(self):
+        self.client.close()
+
+    def test_get(self):
+        self.assertEqual(self.client.set(b"sync", b"val"), 1)
+        self.assertEqual(self.client.get(b"sync"), b"val")
+        self.assertIsNone(self.client.get(b"sync-missing"))
+
+    def test_pipelined(self):
+        kv = dict(
+            (("sync%d" % i).encode(), b"x" * i) for i in range(10)
+        )
+        self.assertEqual(self.client.set_bulk_kv(kv), 10)
+        self.assertEqual(self.client.get_bulk_keys(list(kv)), kv)
+        self.assertEqual(self.client.remove_bulk_keys(list(kv), 0), 10)
+
+
+    def test_scripts(self):
+        embedded = ktasync.KyotoTycoon.embedded(
+            name='scripts',
+            config=ktasync.EmbeddedConfig(records=1000, scripts=True),
+        )
+        client = ktasync.SyncKyotoTycoon(
+            host=embedded.host, port=embedded.port, pipeline_depth=2
+        )
+        client.register_script(
+            "echo", ktasync.encode_dict, ktasync.decode_dict, True
+        )
+        calls = [
+            {("k%d" % i).encode(): str(i).encode()} for i in range(5)
+        ]
+        self.assertEqual(client.play_script_many("echo", calls), calls)
+        self.assertEqual(client.play_script_many("echo", []), [])
+        self.assertEqual(client.incr(b"sync-counter"), 1)
+        self.assertEqual(client.incr(b"sync-counter", 5), 6)
+        client.close()
+
+
+class ConnectionTest(unittest.TestCase):
+    def test_read_records(self):
+        left, right = socket.socketpair()
+        conn = ktasync._Connection(left, 16)
+        reply = [b"\xba", b"\x00\x00\x00\x02"]
+        for key, val in ((b"key", b"v" * 40), (b"k2", b"")):
+            reply.append(ktasync._HEADER.pack(1, len(key), len(val), 7))
+            reply.append(key + val)
+        right.sendall(b"".join(reply) + b"\xbf")
+        self.assertEqual(
+            conn.read_records(ktasync.MB_GET_BULK),
+            [(b"key", b"v" * 40, 1, 7), (b"k2", b"", 1, 7)]
+        )
+        with self.assertRaises(ktasync.KyotoTycoonError):
+            conn.read_count(ktasync.MB_SET_BULK)
+        # The buffer grew for the first record
+        self.assertGreater(len(conn.buf), 16)
+        conn.shrink()
+        self.assertEqual(len(conn.buf), 16)
+        conn.close()
+        right.close()
+
+
+class DiskCacheTest(unittest.TestCase):
+    def setUp(self):
+        self.dir = tempfile.mkdtemp(prefix="ktasync")
+        self.path = os.path.join(self.dir, "cache")
+
+    def tearDown(self):
+        for name in os.listdir(self.dir):
+            os.remove(os.path.join(self.dir, name))
+        os.rmdir(self.dir)
+
+    def test_persistent(self):
+        cache = ktasync.DiskCache(self.path)
+        cache.store([
+            (b"key", b"val", 0, ktasync.DEFAULT_EXPIRE),
+            (b"old", b"val", 0, 1),
+        ], relative=True)
+        cache.store([(b"gone", b"val", 0, 1)])
+        cache.close()
+        cache = ktasync.DiskCache(self.path)
+        hits, missing = cache.lookup([(b"key", 0), (b"key", 1), (b"gone", 0)])
+        self.assertEqual(hits, [(b"key", b"val", 0, ktasync.DEFAULT_EXPIRE)])
+        self.assertEqual(missing, [(b"key", 1), (b"gone", 0)])
+        cache.close()
+
+    def test_evict(self):
+        cache = ktasync.DiskCache(self.path, max_bytes=120)
+        for key in (b"a", b"b", b"c"):
+            cache.store([(key, b"x" * 20, 0, ktasync.DEFAULT_EXPIRE)])
+        cache.lookup([(b"a", 0)])
+        cache.store([(b"d", b"x" * 20, 0, ktasync.DEFAULT_EXPIRE)])
+        _, missing = cache.lookup([(b"a", 0), (b"b", 0), (b"c", 0)])
+        self.assertEqual(missing, [(b"b", 0)])
+        self.assertEqual(cache.stats()["evictions"], 1)
+        cache.close()
+
+    def test_get_interleaved_with_set(self):
+        cache = ktasync.DiskCache(self.path)
+        # A get misses and fetches, a set_bulk completes meanwhile
+        _, missing = cache.lookup([(b"key", 0), (b"other", 0)])
+        generation = cache.begin()
+        cache.discard([(b"key", 0)])
+        cache.store([(b"key", b"new", 0, 60)], relative=True)
+        cache.store([
+            (b"key", b"old", 0, ktasync.DEFAULT_EXPIRE),
+            (b"other", b"val", 0, ktasync.DEFAULT_EXPIRE),
+        ], since=generation)
+        cache.end(generation)
+        self.assertEqual(cache.written, {})
+        hits, _ = cache.lookup(missing)
+        self.assertEqual(
+            [(key, val) for key, val, _, _ in hits],
+            [(b"key", b"new"), (b"other", b"val")],
+        )
+        cache.close()
+
+
+class TrafficRecorderTest(unittest.TestCase):
+    def setUp(self):
+        fd, self.path = tempfile.mkstemp(prefix="ktasync", suffix=".log")
+        os.close(fd)
+
+    def tearDown(self):
+        for path in (self.path, self.path + ".1", self.path + ".2"):
+            if os.path.exists(path):
+                os.remove(path)
+
+    def test_rotate(self):
+        recorder = ktasync.TrafficRecorder(
+            self.path, max_bytes=100, backups=1
+        )
+        for i in range(5):
+            recorder.record(i, 0.001, 5, b"x" * 40)
+        recorder.close()
+        self.assertTrue(os.path.exists(self.path + ".1"))
+        self.assertFalse(os.path.exists(self.path + ".2"))
+        entries = list(ktasync.read_traffic(self.path))
+        self.assertEqual([e.timestamp for e in entries], [4])
+        self.assertEqual(entries[0].request, b"x" * 40)
+
+    def test_dropped(self):
+        recorder = ktasync.TrafficRecorder(self.path, max_pending=100)
+        # The writer thread waits for the file lock, requests queue up
+        with recorder.lock:
+            for i in range(5):
+                recorder.record(i, 0.001, 5, b"x" * 40)
+        recorder.close()
+        self.assertGreater(recorder.dropped, 0)
+        entries = list(ktasync.read_traffic(self.path))
+        self.assertEqual(len(entries) + recorder.dropped, 5)
+        self.assertEqual(recorder.entries, len(entries))
+
+    def test_split_frames(self):
+        request = b"".join(
+            ktasync.Script("echo").request([(b"k", b"v")])
+            for _ in range(2)
+        )
+        self.assertEqual(
+            ktasync._split_frames(request),
+            [(ktasync.MB_PLAY_SCRIPT, 0)] * 2
+        )
+
+
+class RetryTest(unittest.TestCase):
+    def setUp(self):
+        self.loop = asyncio.get_event_loop()
+        sock = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+        sock.bind(("127.0.0.1", 0))
+        self.port = sock.getsockname()[1]
+        sock.close()
+
+    def test_retry_refused(self):
+        client = ktasync.KyotoTycoon(
+            host="127.0.0.1",
+            port=self.port,
+            max_connections=2,
+            retries=2,
+            retry_backoff=0.001,
+        )
+        with self.assertRaises(socket.error):
+            self.loop.run_until_complete(client.get(b"huhu", 0))
+        self.assertEqual(client.lanes.total, 0)
+
 # pylama:ignore=E0611,C0111
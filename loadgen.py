@@ -0,0 +1,410 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+# Copyright (c) 2014 Jean-Louis Fuchs
+#
+# Permission is hereby granted, free of charge, to any person obtaining a
+# copy of this software and associated documentation files (the "Software"),
+# to deal in the Software without restriction, including without limitation
+# the rights to use, copy, modify, merge, publish, distribute, sublicense,
+# and/or sell copies of the Software, and to permit persons to whom the
+# Software is furnished to do so, subject to the following conditions:
+#
+# The above copyright notice and this permission notice shall be included in
+# all copies or substantial portions of the Software.
+#
+# THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR
+# IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY,
+# FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL
+# THE AUTHORS OR COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER
+# LIABILITY, WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING
+# FROM, OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER
+# DEALINGS IN THE SOFTWARE.
+
+"""Open-loop load generator for ktasync
+
+Requests are issued at a fixed or Poisson arrival rate, independent of the
+responses, and the latency is measured from the intended start time of each
+request. Queueing delay in the client is therefore part of the latency
+(no coordinated omission). Example::
+
+    python loadgen.py --embedded --saturate --distribution zipfian
+"""
+
+import argparse
+import bisect
+import collections
+import os
+import random
+import ktasync
+try:
+    import asyncio
+except ImportError:
+    import trollius as asyncio
+    from trollius import From, Return
+
+PERCENTILES = (50, 90, 99, 99.9, 99.99)
+
+
+class Histogram(object):
+    """HDR style latency histogram with constant relative precision.
+
+    Values are recorded in microseconds. Each power of two is split into
+    2 ** (sub_bits - 1) buckets, the error is below 2 ** (1 - sub_bits).
+    """
+
+    def __init__(self, sub_bits=8):
+        self.sub_bits = sub_bits
+        self.half     = 1 << (sub_bits - 1)
+        self.counts   = []
+        self.count    = 0
+        self.total    = 0
+        self.max      = 0
+
+    def _index(self, value):
+        """Bucket of value"""
+        exp = max(0, value.bit_length() - self.sub_bits)
+        return exp * self.half + (value >> exp)
+
+    def _value(self, index):
+        """Highest value of bucket index"""
+        exp = max(0, (index >> (self.sub_bits - 1)) - 1)
+        return ((index - exp * self.half + 1) << exp) - 1
+
+    def record(self, seconds):
+        """Record a latency in seconds"""
+        value = max(0, int(seconds * 1e6))
+        index = self._index(value)
+        if index >= len(self.counts):
+            self.counts.extend([0] * (index + 1 - len(self.counts)))
+        self.counts[index] += 1
+        self.count += 1
+        self.total += value
+        self.max    = max(self.max, value)
+
+    def merge(self, other):
+        """Add the values of other"""
+        if len(other.counts) > len(self.counts):
+            self.counts.extend([0] * (len(other.counts) - len(self.counts)))
+        for index, count in enumerate(other.counts):
+            self.counts[index] += count
+        self.count += other.count
+        self.total += other.total
+        self.max    = max(self.max, other.max)
+
+    def percentile(self, pct):
+        """Latency in seconds at percentile pct"""
+        if not self.count:
+            return 0.0
+        rank = max(1, int(round(self.count * pct / 100.0)))
+        seen = 0
+        for index, count in enumerate(self.counts):
+            seen += count
+            if seen >= rank:
+                return min(self._value(index), self.max) / 1e6
+        return self.max / 1e6
+
+    def mean(self):
+        """Mean latency in seconds"""
+        return self.total / 1e6 / max(1, self.count)
+
+
+class Workload(object):
+    """Generates the operations: keys, values and the operation mix"""
+
+    OPERATIONS = ('get', 'set', 'get_bulk', 'set_bulk')
+
+    def __init__(
+            self,
+            keys=100000,
+            distribution='uniform',
+            zipf_s=0.99,
+            value_size=(100, 100),
+            mix=(('get', 0.9), ('set', 0.1)),
+            bulk=50,
+    ):
+        """
+        :param keys: Number of distinct keys.
+
+        :param distribution: Key distribution 'uniform' or 'zipfian'.
+
+        :param zipf_s: Exponent of the zipfian distribution.
+
+        :param value_size: Range (min, max) of the value sizes.
+
+        :param mix: Operations with their weight as list of (name, weight).
+
+        :param bulk: Records of get_bulk and set_bulk operations.
+        """
+        for name, _ in mix:
+            if name not in self.OPERATIONS:
+                raise ValueError("Unknown operation %s" % name)
+        if distribution not in ('uniform', 'zipfian'):
+            raise ValueError("Unknown distribution %s" % distribution)
+        self.names      = [("key%d" % i).encode("ascii") for i in range(keys)]
+        self.value_size = value_size
+        self.data       = os.urandom(value_size[1])
+        self.bulk       = bulk
+        self.ops        = [name for name, _ in mix]
+        self.op_cdf     = _cumulative(weight for _, weight in mix)
+        self.key_cdf    = None
+        if distribution == 'zipfian':
+            self.key_cdf = _cumulative(
+                1.0 / (rank + 1) ** zipf_s for rank in range(keys)
+            )
+
+    def key(self):
+        """Draw a key"""
+        if self.key_cdf is None:
+            return self.names[random.randrange(len(self.names))]
+        return self.names[_draw(self.key_cdf)]
+
+    def value(self):
+        """Draw a value"""
+        return self.data[:random.randint(*self.value_size)]
+
+    def request(self, client):
+        """Draw an operation, returns the coroutine issuing it"""
+        op = self.ops[_draw(self.op_cdf)]
+        if op == 'get':
+            return client.get(self.key())
+        elif op == 'set':
+            return client.set(self.key(), self.value())
+        elif op == 'get_bulk':
+            return client.get_bulk_keys(
+                [self.key() for _ in range(self.bulk)], 0
+            )
+        return client.set_bulk_kv(
+            dict((self.key(), self.value()) for _ in range(self.bulk)), 0
+        )
+
+
+def _cumulative(weights):
+    """Cumulative distribution of weights"""
+    cdf   = []
+    total = 0.0
+    for weight in weights:
+        total += weight
+        cdf.append(total)
+    return cdf
+
+
+def _draw(cdf):
+    """Draw an index from a cumulative distribution"""
+    return min(
+        len(cdf) - 1, bisect.bisect_right(cdf, random.random() * cdf[-1])
+    )
+
+
+LoadResult = collections.namedtuple(
+    'LoadResult',
+    ('rate', 'achieved', 'requests', 'errors', 'histogram'),
+)
+
+
+async def _issue(client, coro, intended, hist, errors):
+    """Issue a request and record its latency from the intended start"""
+    try:
+        await coro
+        # pypy #yield From(coro)
+    except (ktasync.KyotoTycoonError,) + ktasync.RETRY_ERRORS:
+        errors.append(intended)
+    hist.record(client.loop.time() - intended)
+
+
+async def preload(client, workload, chunk=1000):
+    """Store a value for every key of workload"""
+    names = workload.names
+    for offset in range(0, len(names), chunk):
+        await client.set_bulk_kv(dict(
+        # pypy #yield From(client.set_bulk_kv(dict(
+            (name, workload.value()) for name in names[offset:offset + chunk]
+        ), 0, priority=ktasync.PRIORITY_BATCH)
+        # pypy #), 0, priority=ktasync.PRIORITY_BATCH))
+
+
+async def run(client, workload, rate, duration, arrivals='poisson'):
+    """Issue requests of workload at rate per second for duration seconds.
+
+    :param arrivals: 'fixed' intervals or 'poisson' (exponential intervals).
+
+    :rtype: LoadResult
+    """
+    loop     = client.loop
+    hist     = Histogram()
+    errors   = []
+    tasks    = []
+    start    = loop.time()
+    intended = start
+    while intended < start + duration:
+        delay = intended - loop.time()
+        if delay > 0:
+            await asyncio.sleep(delay)
+            # pypy #yield From(asyncio.sleep(delay))
+        tasks.append(loop.create_task(_issue(
+            client, workload.request(client), intended, hist, errors
+        )))
+        if arrivals == 'fixed':
+            intended += 1.0 / rate
+        else:
+            intended += random.expovariate(rate)
+    await asyncio.gather(*tasks)
+    # pypy #yield From(asyncio.gather(*tasks))
+    elapsed = loop.time() - start
+    return LoadResult(
+    # pypy #raise Return(LoadResult(
+        rate, len(tasks) / elapsed, len(tasks), len(errors), hist
+    )
+    # pypy #))
+
+
+async def saturate(
+        client,
+        workload,
+        rate=1000.0,
+        duration=2.0,
+        arrivals='poisson',
+        factor=1.5,
+        max_p99=None,
+        max_rate=1e7,
+):
+    """Increase the rate by factor until the client cannot keep up: the
+    achieved rate falls below 90% of the target or the p99 latency exceeds
+    max_p99 seconds.
+
+    :return: The highest sustained rate and the LoadResult of each step.
+    """
+    results   = []
+    sustained = None
+    while rate <= max_rate:
+        res = await run(
+        # pypy #res = yield From(run(
+            client, workload, rate, duration, arrivals
+        )
+        # pypy #))
+        results.append(res)
+        report(res)
+        if res.achieved < 0.9 * rate or (
+                max_p99 is not None and res.histogram.percentile(99) > max_p99
+        ):
+            break
+        sustained = rate
+        rate *= factor
+    return sustained, results
+    # pypy #raise Return((sustained, results))
+
+
+def report(res):
+    """Print a LoadResult"""
+    hist = res.histogram
+    print(
+        "rate %.0f/s achieved %.0f/s requests %d errors %d mean %.3fms %s "
+        "max %.3fms" % (
+            res.rate,
+            res.achieved,
+            res.requests,
+            res.errors,
+            hist.mean() * 1000,
+            " ".join(
+                "p%s %.3fms" % (pct, hist.percentile(pct) * 1000)
+                for pct in PERCENTILES
+            ),
+            hist.max / 1000.0,
+        )
+    )
+
+
+def _parse_mix(text):
+    """Parse get=90,set=10"""
+    mix = []
+    for part in text.split(","):
+        name, _, weight = part.partition("=")
+        mix.append((name, float(weight or 1)))
+    return mix
+
+
+def main(argv=None):
+    """Open-loop load generator for ktasync"""
+    parser = argparse.ArgumentParser(description=main.__doc__)
+    parser.add_argument("--host", default="127.0.0.1")
+    parser.add_argument("--port", type=int, default=ktasync.DEFAULT_PORT)
+    parser.add_argument("--unix-path", default=None)
+    parser.add_argument(
+        "--embedded", action="store_true", help="start an embedded server"
+    )
+    parser.add_argument(
+        "--connections", type=int, default=ktasync.MAX_CONNECTIONS
+    )
+    parser.add_argument("--rate", type=float, default=1000.0)
+    parser.add_argument("--duration", type=float, default=5.0)
+    parser.add_argument(
+        "--arrivals", choices=("fixed", "poisson"), default="poisson"
+    )
+    parser.add_argument("--keys", type=int, default=100000)
+    parser.add_argument(
+        "--distribution", choices=("uniform", "zipfian"), default="uniform"
+    )
+    parser.add_argument("--zipf-s", type=float, default=0.99)
+    parser.add_argument(
+        "--value-size", default="100", help="size or range min:max"
+    )
+    parser.add_argument("--mix", default="get=90,set=10")
+    parser.add_argument("--bulk", type=int, default=50)
+    parser.add_argument("--no-preload", action="store_true")
+    parser.add_argument(
+        "--saturate",
+        action="store_true",
+        help="increase the rate until the client cannot keep up",
+    )
+    parser.add_argument("--factor", type=float, default=1.5)
+    parser.add_argument(
+        "--max-p99", type=float, default=None, help="p99 limit in ms"
+    )
+    args = parser.parse_args(argv)
+
+    sizes = [int(size) for size in args.value_size.split(":")]
+    workload = Workload(
+        keys=args.keys,
+        distribution=args.distribution,
+        zipf_s=args.zipf_s,
+        value_size=(sizes[0], sizes[-1]),
+        mix=_parse_mix(args.mix),
+        bulk=args.bulk,
+    )
+    if args.embedded:
+        client = ktasync.KyotoTycoon.embedded(
+            max_connections=args.connections
+        )
+    else:
+        client = ktasync.KyotoTycoon(
+            host=args.host,
+            port=args.port,
+            unix_path=args.unix_path,
+            max_connections=args.connections,
+        )
+    loop = client.loop
+    if not args.no_preload:
+        loop.run_until_complete(preload(client, workload))
+    if args.saturate:
+        sustained, _ = loop.run_until_complete(saturate(
+            client,
+            workload,
+            args.rate,
+            args.duration,
+            args.arrivals,
+            args.factor,
+            args.max_p99 / 1000.0 if args.max_p99 else None,
+        ))
+        if sustained is None:
+            print("saturated below %.0f/s" % args.rate)
+        else:
+            print("saturation point: %.0f/s" % sustained)
+    else:
+        report(loop.run_until_complete(
+            run(client, workload, args.rate, args.duration, args.arrivals)
+        ))
+    client.close()
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,241 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+# Copyright (c) 2014 Jean-Louis Fuchs
+#
+# Permission is hereby granted, free of charge, to any person obtaining a
+# copy of this software and associated documentation files (the "Software"),
+# to deal in the Software without restriction, including without limitation
+# the rights to use, copy, modify, merge, publish, distribute, sublicense,
+# and/or sell copies of the Software, and to permit persons to whom the
+# Software is furnished to do so, subject to the following conditions:
+#
+# The above copyright notice and this permission notice shall be included in
+# all copies or substantial portions of the Software.
+#
+# THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR
+# IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY,
+# FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL
+# THE AUTHORS OR COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER
+# LIABILITY, WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING
+# FROM, OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER
+# DEALINGS IN THE SOFTWARE.
+
+"""Microbenchmarks of the request encoders and reply decoders of ktasync
+
+No server is needed: requests are encoded from prepared records and the
+decoders read replies built beforehand from a StreamReader. Reports the
+time per record and, using tracemalloc, the retained blocks and the peak
+memory per record. Example::
+
+    python microbench.py --counts 10,1000 --sizes 16:100,64:10000
+"""
+
+import argparse
+import os
+import struct
+import time
+import ktasync
+try:
+    import asyncio
+except ImportError:
+    import trollius as asyncio
+try:
+    import tracemalloc
+except ImportError:
+    tracemalloc = None
+
+timer = getattr(time, "perf_counter", time.time)
+
+COUNTS = (1, 10, 100, 1000)
+SIZES = ((16, 100), (64, 1000), (64, 10000))
+# Records encoded or decoded per timing run
+RECORDS_PER_RUN = 200000
+
+
+def _drive(coro):
+    """Run a coroutine which does not wait, without an event loop"""
+    try:
+        coro.send(None)
+    except StopIteration as stop:
+        return stop.value
+    raise RuntimeError("The coroutine waited for data")
+
+
+def _reader(data):
+    """StreamReader holding data"""
+    sr = asyncio.StreamReader()
+    sr.feed_data(data)
+    sr.feed_eof()
+    return sr
+
+
+def _records(count, key_size, val_size):
+    """Records with distinct keys"""
+    val = os.urandom(val_size)
+    return [
+        (("%%0%dd" % key_size % i).encode("ascii")[-key_size:], val)
+        for i in range(count)
+    ]
+
+
+def _get_bulk_reply(recs):
+    """get_bulk reply of recs"""
+    reply = [struct.pack('!BI', ktasync.MB_GET_BULK, len(recs))]
+    for key, val in recs:
+        reply.append(struct.pack(
+            '!HIIq', 0, len(key), len(val), ktasync.DEFAULT_EXPIRE
+        ))
+        reply.append(key)
+        reply.append(val)
+    return b''.join(reply)
+
+
+def _script_reply(recs):
+    """play_script reply of recs"""
+    reply = [struct.pack('!BI', ktasync.MB_PLAY_SCRIPT, len(recs))]
+    for key, val in recs:
+        reply.append(struct.pack('!II', len(key), len(val)))
+        reply.append(key)
+        reply.append(val)
+    return b''.join(reply)
+
+
+def cases(client, recs):
+    """The benchmarked operations as list of (name, prepare, run). prepare()
+    returns the argument of run(), it is not measured."""
+    set_recs = [
+        (key, val, 0, ktasync.DEFAULT_EXPIRE) for key, val in recs
+    ]
+    key_recs = [(key, 0) for key, _ in recs]
+    script = ktasync.Script("echo")
+    get_reply = _get_bulk_reply(recs)
+    script_reply = _script_reply(recs)
+    return [
+        (
+            "encode set_bulk",
+            lambda: set_recs,
+            lambda arg: ktasync._encode_set_bulk(arg, 0),
+        ),
+        (
+            "encode get_bulk",
+            lambda: key_recs,
+            lambda arg: ktasync._encode_keys(ktasync.MB_GET_BULK, arg, 0),
+        ),
+        (
+            "encode remove_bulk",
+            lambda: key_recs,
+            lambda arg: ktasync._encode_keys(ktasync.MB_REMOVE_BULK, arg, 0),
+        ),
+        (
+            "encode play_script",
+            lambda: recs,
+            lambda arg: script.request(arg),
+        ),
+        (
+            "decode get_bulk",
+            lambda: _reader(get_reply),
+            lambda sr: _drive(client._read_keys(sr, ktasync.MB_GET_BULK)),
+        ),
+        (
+            "decode get_bulk columnar",
+            lambda: _reader(get_reply),
+            lambda sr: _drive(
+                client._read_columnar(sr, ktasync.MB_GET_BULK)
+            ),
+        ),
+        (
+            "decode play_script",
+            lambda: _reader(script_reply),
+            lambda sr: _drive(
+                client._read_script(sr, ktasync.MB_PLAY_SCRIPT)
+            ),
+        ),
+    ]
+
+
+def measure_time(prepare, run, count, repeat=3):
+    """Best time per record in nanoseconds"""
+    iterations = max(1, RECORDS_PER_RUN // count)
+    best = None
+    for _ in range(repeat):
+        args = [prepare() for _ in range(iterations)]
+        start = timer()
+        for arg in args:
+            run(arg)
+        duration = timer() - start
+        if best is None or duration < best:
+            best = duration
+    return best * 1e9 / (iterations * count)
+
+
+def measure_memory(prepare, run, count):
+    """Blocks allocated and kept by one run and its peak bytes per record"""
+    arg = prepare()
+    tracemalloc.start()
+    before = tracemalloc.take_snapshot()
+    if hasattr(tracemalloc, "reset_peak"):
+        tracemalloc.reset_peak()
+    start, _ = tracemalloc.get_traced_memory()
+    res = run(arg)
+    _, peak = tracemalloc.get_traced_memory()
+    peak -= start
+    after = tracemalloc.take_snapshot()
+    tracemalloc.stop()
+    # Ignore the blocks of the before snapshot itself
+    own = (tracemalloc.Filter(False, tracemalloc.__file__),)
+    blocks = sum(
+        stat.count_diff
+        for stat in after.filter_traces(own).compare_to(
+            before.filter_traces(own), "filename"
+        )
+    )
+    del res
+    return blocks / float(count), peak / float(count)
+
+
+def main(argv=None):
+    """Microbenchmarks of the encoders and decoders of ktasync"""
+    parser = argparse.ArgumentParser(description=main.__doc__)
+    parser.add_argument(
+        "--counts",
+        default=",".join(str(count) for count in COUNTS),
+        help="records per request",
+    )
+    parser.add_argument(
+        "--sizes",
+        default=",".join("%d:%d" % size for size in SIZES),
+        help="key:value sizes",
+    )
+    parser.add_argument("--only", default=None, help="substring of names")
+    args = parser.parse_args(argv)
+
+    client = ktasync.KyotoTycoon()
+    counts = [int(count) for count in args.counts.split(",")]
+    sizes = [
+        tuple(int(size) for size in pair.split(":"))
+        for pair in args.sizes.split(",")
+    ]
+    for key_size, val_size in sizes:
+        for count in counts:
+            recs = _records(count, key_size, val_size)
+            for name, prepare, run in cases(client, recs):
+                if args.only and args.only not in name:
+                    continue
+                nanos = measure_time(prepare, run, count)
+                if tracemalloc is not None:
+                    memory = " %.1f blocks/record %.0f peak bytes/record" % (
+                        measure_memory(prepare, run, count)
+                    )
+                else:
+                    memory = ""
+                print(
+                    "%s records %d key %d value %d: %.0fns/record%s" % (
+                        name, count, key_size, val_size, nanos, memory
+                    )
+                )
+    client.close()
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,81 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+# Copyright (c) 2014 Jean-Louis Fuchs
+#
+# Permission is hereby granted, free of charge, to any person obtaining a
+# copy of this software and associated documentation files (the "Software"),
+# to deal in the Software without restriction, including without limitation
+# the rights to use, copy, modify, merge, publish, distribute, sublicense,
+# and/or sell copies of the Software, and to permit persons to whom the
+# Software is furnished to do so, subject to the following conditions:
+#
+# The above copyright notice and this permission notice shall be included in
+# all copies or substantial portions of the Software.
+#
+# THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR
+# IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY,
+# FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL
+# THE AUTHORS OR COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER
+# LIABILITY, WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING
+# FROM, OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER
+# DEALINGS IN THE SOFTWARE.
+
+"""Replay traffic logs written by ktasync.TrafficRecorder
+
+The requests are sent with the recorded timing, optionally sped up, and the
+latencies are compared with the recorded ones per opcode. Example::
+
+    python replay.py traffic.log --host target --speed 10
+"""
+
+import argparse
+import ktasync
+
+
+def main(argv=None):
+    """Replay traffic logs: python replay.py LOG [LOG ...]"""
+    parser = argparse.ArgumentParser(description=main.__doc__)
+    parser.add_argument("logs", nargs="+", help="traffic logs, oldest first")
+    parser.add_argument("--host", default=ktasync.DEFAULT_HOST)
+    parser.add_argument("--port", type=int, default=ktasync.DEFAULT_PORT)
+    parser.add_argument("--unix-path", default=None)
+    parser.add_argument(
+        "--speed",
+        type=float,
+        default=1.0,
+        help="speed-up of the recorded timing, 0 replays without delays",
+    )
+    parser.add_argument(
+        "--connections", type=int, default=ktasync.MAX_CONNECTIONS
+    )
+    args = parser.parse_args(argv)
+    client = ktasync.KyotoTycoon(
+        host=args.host,
+        port=args.port,
+        unix_path=args.unix_path,
+        max_connections=args.connections,
+    )
+    results = client.loop.run_until_complete(
+        ktasync.replay_traffic(client, args.logs, args.speed or None)
+    )
+    client.close()
+    summary = ktasync.summarize_replay(results)
+    for magic in sorted(summary):
+        stats = summary[magic]
+        print(
+            "0x%02x: %d requests, %d errors, p50 %.3fms (recorded %.3fms), "
+            "p99 %.3fms (recorded %.3fms)" % (
+                magic,
+                stats['count'],
+                stats['errors'],
+                stats['p50'] * 1000,
+                stats['recorded_p50'] * 1000,
+                stats['p99'] * 1000,
+                stats['recorded_p99'] * 1000,
+            )
+        )
+
+
+if __name__ == "__main__":
+    main()
@@ -6,6 +6,7 @@ from setuptools import setup
 from setuptools.command.install import install
 
 is_cp2  = not sys.version_info[0] > 2
+is_cp34 = sys.version_info[:2] == (3, 4)
 is_pypy = '__pypy__' in sys.builtin_module_names
 
 install_requires = []
@@ -21,6 +22,11 @@ class CustomInstallCommand(install):
                 with open("ktasync.py", "w") as out:
                     for line in templ:
                         out.write(line.replace("# pypy #", ""))
+        elif is_cp34:
+            with open("ktasync.pyt") as templ:
+                with open("ktasync.py", "w") as out:
+                    for line in templ:
+                        out.write(line.replace("# cp #", ""))
 
         install.run(self)
 
@@ -57,6 +63,7 @@ setup(
         "License :: OSI Approved :: MIT License",
         "Programming Language :: Python :: 2.7",
         "Programming Language :: Python :: 3.4",
+        "Programming Language :: Python :: 3.5",
         "Programming Language :: Python :: Implementation :: CPython",
         "Programming Language :: Python :: Implementation :: PyPy",
     ],